@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Compare the BeautifulSoup (html.parser) and streaming (lxml iterparse) feed
+parsers on a large synthetic feed, built by repeating the entries of the
+test feeds.
+
+Usage: python benchmarks/parser_benchmark.py [size in MB]
+"""
+
+import re
+import sys
+import time
+
+from feedspora.generic_feed import GenericFeed
+
+
+def make_feed(filename, tag, size):
+    '''
+    Build a feed of about size bytes out of the entries of filename
+    :param filename:
+    :param tag: name of the entry elements
+    :param size:
+    '''
+    with open(filename, encoding='utf-8') as feed_file:
+        content = feed_file.read()
+    head = content[:content.index('<' + tag + '>')]
+    tail = content[content.rindex('</' + tag + '>') + len(tag) + 3:]
+    entries = re.findall(r'<%s>.*?</%s>' % (tag, tag), content, re.DOTALL)
+    body = []
+    length = 0
+    count = 0
+    while length < size:
+        entry = entries[count % len(entries)]
+        body.append(entry)
+        length += len(entry)
+        count += 1
+    return head + ''.join(body) + tail, count
+
+
+def timed(label, parse, feed_content, count):
+    '''
+    Time a parser and report its throughput
+    :param label:
+    :param parse:
+    :param feed_content:
+    :param count:
+    '''
+    start = time.perf_counter()
+    entries = parse(feed_content)
+    elapsed = time.perf_counter() - start
+    assert len(entries) == count
+    print("  %-12s %8.2fs %10.0f entries/s" % (label, elapsed,
+                                               count / elapsed))
+    return entries
+
+
+def main():
+    '''Entry point if called as an executable'''
+    size = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for filename, tag in (('tests/feed.rss', 'item'),
+                          ('tests/feed.atom', 'entry')):
+        feed_content, count = make_feed(filename, tag, size * 1024 * 1024)
+        print("%s x %d entries (%.1f MB)" % (filename, count,
+                                             len(feed_content) / 1048576))
+        soup_feed = GenericFeed({'path': filename, 'parser': 'html.parser'})
+        lxml_feed = GenericFeed({'path': filename, 'parser': 'lxml'})
+        soup_entries = timed('html.parser', soup_feed.parse_entries,
+                             feed_content, count)
+        lxml_entries = timed('lxml', lxml_feed.parse_entries, feed_content,
+                             count)
+        assert [vars(entry) for entry in soup_entries] == \
+            [vars(entry) for entry in lxml_entries]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Compare the insert and lookup throughput of the storages of published
+entries, for growing numbers of identifiers.
+
+Usage: python benchmarks/storage_benchmark.py [number of identifiers...]
+"""
+
+import sys
+import tempfile
+import time
+
+from feedspora.key_value_storage import DbmStorage, MemoryStorage
+from feedspora.sqlite_storage import SqliteStorage
+
+STORAGES = [('sqlite', SqliteStorage, False),
+            ('sqlite+bloom', SqliteStorage, True),
+            ('dbm', DbmStorage, False),
+            ('memory', MemoryStorage, False),
+           ]
+
+
+def identifier(index):
+    '''
+    Identifier of a synthetic entry
+    :param index:
+    '''
+    return 'https://example.org/%d/entry Sat, 28 Oct 2017 11:21:29 +0200' % \
+        index
+
+
+def rate(count, elapsed):
+    '''
+    Operations per second
+    :param count:
+    :param elapsed:
+    '''
+    return count / max(elapsed, 1e-9)
+
+
+def benchmark(storage_class, use_bloom_filters, count, directory):
+    '''
+    Insert count identifiers, then look up as many published and
+    unpublished ones after reopening the storage, and return the insert,
+    open and lookup throughputs
+    :param storage_class:
+    :param use_bloom_filters:
+    :param count:
+    :param directory:
+    '''
+    db_file = '%s/feedspora.db' % directory
+    storage = storage_class(db_file)
+    storage.set_bloom_filters(use_bloom_filters)
+    storage.open(['client'])
+    start = time.perf_counter()
+    for index in range(count):
+        storage.add_published(identifier(index), 'client', posted=False)
+    storage.close()
+    insert = time.perf_counter() - start
+
+    if storage_class is not MemoryStorage:
+        storage = storage_class(db_file)
+        storage.set_bloom_filters(use_bloom_filters)
+        start = time.perf_counter()
+        storage.open(['client'])
+        opening = time.perf_counter() - start
+    else:
+        storage.open(['client'])
+        for index in range(count):
+            storage.add_published(identifier(index), 'client', posted=False)
+        opening = 0
+    start = time.perf_counter()
+    for index in range(count):
+        assert storage.is_published(identifier(index), 'client')
+        assert not storage.is_published(identifier(count + index), 'client')
+    lookup = time.perf_counter() - start
+    storage.close()
+    return rate(count, insert), opening, rate(2 * count, lookup)
+
+
+def main():
+    '''
+    Run the benchmark for each storage and size
+    '''
+    counts = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000]
+    print("%-14s %9s %14s %9s %14s" % ("storage", "entries", "inserts/s",
+                                       "open (s)", "lookups/s"))
+    for count in counts:
+        for name, storage_class, use_bloom_filters in STORAGES:
+            with tempfile.TemporaryDirectory() as directory:
+                insert, opening, lookup = benchmark(
+                    storage_class, use_bloom_filters, count, directory)
+            print("%-14s %9d %14.0f %9.2f %14.0f" % (name, count, insert,
+                                                     opening, lookup))
+
+
+if __name__ == '__main__':
+    main()
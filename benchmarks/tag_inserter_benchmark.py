@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Compare inserting tags compiled into a single pattern with inserting them
+one at a time, on a synthetic text mentioning some of them.
+
+Usage: python benchmarks/tag_inserter_benchmark.py [number of tags...]
+"""
+
+import random
+import string
+import sys
+import timeit
+
+from feedspora.tag_inserter import TagInserter
+
+
+def make_text(tags, size):
+    '''
+    Build a text of about size characters, mentioning some of the tags
+    :param tags:
+    :param size:
+    '''
+    words = list(tags) + ['lorem', 'ipsum', 'dolor', 'sit', 'amet']
+    pieces = []
+    length = 0
+    while length < size:
+        piece = random.choice(words) + random.choice([' ', ', ', '. '])
+        pieces.append(piece)
+        length += len(piece)
+    return ''.join(pieces)
+
+
+def insert(inserter, text):
+    '''
+    Insert the tags into the text, then append the others
+    :param inserter:
+    :param text:
+    '''
+    to_return, extra_tags = inserter.insert(text)
+    return inserter.append(to_return, ' |', extra_tags)
+
+
+def timed(inserter, text):
+    '''
+    Return the best time of an insertion, in milliseconds
+    :param inserter:
+    :param text:
+    '''
+    return min(timeit.repeat(lambda: insert(inserter, text), number=10,
+                             repeat=3)) * 100
+
+
+def main():
+    '''Entry point if called as an executable'''
+    counts = [int(arg) for arg in sys.argv[1:]] or [10, 100, 1000]
+    random.seed(0)
+    print("%6s %10s %14s %16s" % ("tags", "characters", "compiled (ms)",
+                                  "one by one (ms)"))
+    for count in counts:
+        tags = tuple(''.join(random.choice(string.ascii_lowercase)
+                             for _ in range(random.randint(3, 10)))
+                     for _ in range(count))
+        text = make_text(tags, 10000)
+        compiled = TagInserter(tags)
+        slow = TagInserter(tags)
+        # pylint: disable=protected-access
+        slow._pattern = None
+        # pylint: enable=protected-access
+        assert insert(compiled, text) == insert(slow, text)
+        print("%6d %10d %14.2f %16.2f" % (count, len(text),
+                                          timed(compiled, text),
+                                          timed(slow, text)))
+
+
+if __name__ == '__main__':
+    main()
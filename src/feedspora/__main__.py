@@ -12,9 +12,12 @@ from feedspora.diaspora_client import DiaspyClient  # @UnusedImport
 from feedspora.facebook_client import FacebookClient  # @UnusedImport
 from feedspora.feedspora_runner import FeedSpora
 from feedspora.generic_feed import GenericFeed
+from feedspora import http_session
 from feedspora.linkedin_client import LinkedInClient  # @UnusedImport
 from feedspora.mastodon_client import MastodonClient  # @UnusedImport
+from feedspora import media_cache
 from feedspora.shaarpy_client import ShaarpyClient  # @UnusedImport
+from feedspora import short_url_cache
 from feedspora.tweepy_client import TweepyClient  # @UnusedImport
 from feedspora.wordpress_client import WPClient  # @UnusedImport
 
@@ -75,7 +78,98 @@ def main():
         const='feedspora',
         default=None,
         help='execute test runs; no actual posting done')
+    parser.add_argument(
+        '--fetch-workers',
+        type=int,
+        default=4,
+        help='number of feeds retrieved concurrently (default: 4)')
+    parser.add_argument(
+        '--publish-workers',
+        type=int,
+        default=1,
+        help='number of clients an entry is posted to concurrently '
+        '(default: 1)')
+    parser.add_argument(
+        '--shorten-workers',
+        type=int,
+        default=4,
+        help='number of links shortened concurrently before posting '
+        '(default: 4)')
+    parser.add_argument(
+        '--http-timeout',
+        type=float,
+        default=30,
+        help='timeout of HTTP requests, in seconds (default: 30)')
+    parser.add_argument(
+        '--media-cache-size',
+        type=float,
+        default=100,
+        help='size of the media downloaded to MEDIA_DIR past which the least '
+        'recently used are evicted, in MB (default: 100)')
+    parser.add_argument(
+        '--max-media-size',
+        type=float,
+        default=20,
+        help='size past which media are not downloaded nor posted, in MB '
+        '(default: 20)')
+    parser.add_argument(
+        '--short-url-ttl',
+        type=float,
+        default=None,
+        help='how long short URLs are kept in the database, in days '
+        '(default: for ever)')
+    parser.add_argument(
+        '--storage',
+        choices=['sqlite', 'dbm', 'memory'],
+        default=None,
+        help='storage of published entries and feed states (default: '
+        'sqlite, memory when testing)')
+    parser.add_argument(
+        '--bloom-filters',
+        action='store_true',
+        help='look up published entries through Bloom filters stored next '
+        'to the database, rather than loading them in memory')
+    parser.add_argument(
+        '--debug-identifiers',
+        action='store_true',
+        help='store the identifiers of published entries along with their '
+        'digests, for debugging purposes')
+    parser.add_argument(
+        '--outbox',
+        action='store_true',
+        help='queue rendered entries in the database, then deliver them, '
+        'attempting failed deliveries again in later runs')
+    parser.add_argument(
+        '--deliver',
+        action='store_true',
+        help='instead of publishing, only deliver the entries queued with '
+        '--outbox')
+    parser.add_argument(
+        '--retry-failed',
+        action='store_true',
+        help='attempt the deliveries given up again, when delivering the '
+        'entries queued with --outbox')
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        help='instead of publishing, delete the published entries that '
+        'left the feeds more than --retention-days ago and compact the '
+        'database')
+    parser.add_argument(
+        '--retention-days',
+        type=int,
+        default=365,
+        help='how long published entries are kept after they left the '
+        'feeds, with --compact, which must run more often than that since '
+        'it is what notices entries still in the feeds (default: 365)')
     args = parser.parse_args()
+    http_session.configure(timeout=args.http_timeout,
+                           pool_maxsize=max(16, args.fetch_workers))
+    media_cache.configure(
+        max_size=int(args.media_cache_size * 1024 * 1024),
+        max_media_size=int(args.max_media_size * 1024 * 1024))
+    if args.short_url_ttl is not None:
+        short_url_cache.configure(ttl=args.short_url_ttl * 86400)
 
     # root name of config and DB files, optionally modified by the --testing
     # argument value (if present)
@@ -93,7 +187,23 @@ def main():
             connect_client(account, args.testing)
     feedspora.set_db_file(root_name + '.db')
     feedspora.set_testing(args.testing is not None)
-    feedspora.run()
+    feedspora.set_fetch_workers(args.fetch_workers)
+    feedspora.set_publish_workers(args.publish_workers)
+    feedspora.set_shorten_workers(args.shorten_workers)
+    if args.storage:
+        feedspora.set_storage(args.storage)
+    elif args.testing is not None:
+        feedspora.set_storage('memory')
+    feedspora.set_bloom_filters(args.bloom_filters)
+    feedspora.set_debug_identifiers(args.debug_identifiers)
+    feedspora.set_outbox(args.outbox)
+    feedspora.set_retry_failed(args.retry_failed)
+    if args.compact:
+        feedspora.compact(args.retention_days)
+    elif args.deliver:
+        feedspora.deliver()
+    else:
+        feedspora.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,145 @@
+"""
+BloomFilter: compact, file-backed set of (byte) strings answering "definitely
+not in the set" or "maybe in the set".
+"""
+
+import hashlib
+import math
+import os
+import struct
+
+
+class BloomFilter:
+    '''
+    Bloom filter of strings or byte strings, sized for a given capacity and
+    false positive rate, which can be saved to and loaded from a file.
+    '''
+    _magic = b'FSBLOOM1'
+    # magic, size in bits, number of hashes, capacity, count, last row id and
+    # digest of its item
+    _header = struct.Struct('<8sQQQQq16s')
+
+    def __init__(self, capacity, error_rate=0.001):
+        '''
+        Initialize an empty filter
+        :param capacity: number of items the filter is sized for
+        :param error_rate: false positive rate at capacity
+        '''
+        self.capacity = max(1024, capacity)
+        self.size = int(math.ceil(-self.capacity * math.log(error_rate) /
+                                  math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / self.capacity *
+                                       math.log(2))))
+        # Number of distinct items added, and last database row they cover
+        self.count = 0
+        self.last_id = 0
+        self._last_digest = bytes(16)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    @staticmethod
+    def _digest(item):
+        '''
+        128-bit digest of an item
+        :param item:
+        '''
+        if isinstance(item, str):
+            item = item.encode('utf-8')
+        return hashlib.blake2b(item, digest_size=16).digest()
+
+    def _positions(self, item):
+        '''
+        Generate the bit positions of an item (double hashing)
+        :param item:
+        '''
+        digest = self._digest(item)
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        for index in range(self.hashes):
+            yield (first + index * second) % self.size
+
+    def add(self, item):
+        '''
+        Add an item to the filter
+        :param item:
+        '''
+        added = False
+        for position in self._positions(item):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                self._bits[position >> 3] |= 1 << (position & 7)
+                added = True
+        if added:
+            # Items already in the filter aren't counted again
+            self.count += 1
+
+    def __contains__(self, item):
+        '''
+        Is the item possibly in the filter? False means it's definitely not.
+        :param item:
+        '''
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+    def set_last_row(self, row_id, item):
+        '''
+        Record the last database row added to the filter
+        :param row_id:
+        :param item:
+        '''
+        self.last_id = row_id
+        self._last_digest = self._digest(item)
+
+    def is_last_row(self, item):
+        '''
+        Is the item the one of the last database row added to the filter?
+        Tells a filter apart from one built from another database.
+        :param item:
+        '''
+        return self._digest(item) == self._last_digest
+
+    def is_saturated(self):
+        '''
+        Have more items than its capacity been added to the filter?
+        '''
+        return self.count > self.capacity
+
+    def save(self, path):
+        '''
+        Write the filter to a file, atomically
+        :param path:
+        '''
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as bloom_file:
+            bloom_file.write(self._header.pack(
+                self._magic, self.size, self.hashes, self.capacity,
+                self.count, self.last_id, self._last_digest))
+            bloom_file.write(self._bits)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Read a filter from a file. Returns None if the file is missing or
+        invalid.
+        :param path:
+        '''
+        try:
+            with open(path, 'rb') as bloom_file:
+                header = bloom_file.read(cls._header.size)
+                bits = bloom_file.read()
+        except OSError:
+            return None
+        if len(header) != cls._header.size:
+            return None
+        magic, size, hashes, capacity, count, last_id, last_digest = \
+            cls._header.unpack(header)
+        if magic != cls._magic or len(bits) != (size + 7) // 8:
+            return None
+        bloom_filter = cls.__new__(cls)
+        bloom_filter.size = size
+        bloom_filter.hashes = hashes
+        bloom_filter.capacity = capacity
+        bloom_filter.count = count
+        bloom_filter.last_id = last_id
+        bloom_filter._last_digest = last_digest
+        bloom_filter._bits = bytearray(bits)
+        return bloom_filter
@@ -49,17 +49,16 @@ class DiaspyClient(GenericClient):
             "media": kwargs['photo']
         }
 
-    def post(self, feed, entry):
+    def render(self, feed, entry):
         '''
-        Post entry to Diaspora.
+        Render entry for Diaspora.
         :param feed:
         :param entry:
         '''
 
         text = self.resolve_option(feed, 'post_prefix') + \
-               '['+entry.title +']('+self.shorten_url(feed, entry.link)+')'
-        stripped_html = self.strip_html(feed, entry.content) \
-                        if entry.content else None
+               '['+entry.title +']('+self.shorten_entry_link(feed, entry)+')'
+        stripped_html = self.strip_entry_content(feed, entry)
         if self.resolve_option(feed, 'post_include_content') and stripped_html:
             text += ": " + stripped_html
         text += self.resolve_option(feed, 'post_suffix')
@@ -69,18 +68,30 @@ class DiaspyClient(GenericClient):
             text += ' |'+post_tags
 
         media_path = None
+        media_url = None
         if self.resolve_option(feed, 'post_include_media') and entry.media_url:
             # Need to download image from that URL in order to post it!
             media_path = self.download_media(entry.media_url)
+            media_url = entry.media_url
 
-        post_params = {'text': text,
-                       'photo': media_path,
-                       'aspect_ids': 'public',
-                       'provider_display_name': 'FeedSpora'
-                       }
+        return {'post_params': {'text': text,
+                                'photo': media_path,
+                                'aspect_ids': 'public',
+                                'provider_display_name': 'FeedSpora'
+                                },
+                'media_url': media_url}
+
+    def deliver(self, payload):
+        '''
+        Post rendered entry to Diaspora.
+        :param payload:
+        '''
+        post_params = dict(payload['post_params'])
 
         to_return = False
         if self.stream:
+            post_params['photo'] = self.refresh_media(post_params['photo'],
+                                                      payload['media_url'])
             to_return = self.stream.post(**post_params)
         elif self.is_testing():
             self.accumulate_testing_output(self.get_dict_output(**post_params))
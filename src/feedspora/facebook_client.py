@@ -40,17 +40,16 @@ class FacebookClient(GenericClient):
             "message": kwargs['attachment']['message']
         }
 
-    def post(self, feed, entry):
+    def render(self, feed, entry):
         '''
-        Post entry to Facebook.
+        Render entry for Facebook.
         :param feed:
         :param entry:
         '''
         # "Only owners of the URL have the ability to specify the picture,
         #  name, thumbnail or description params." -- Facebook Law
         # This greatly limits what we can reliably do/provide, obviously
-        stripped_html = self.strip_html(feed, entry.content) \
-                        if entry.content else None
+        stripped_html = self.strip_entry_content(feed, entry)
         text = ''
         if self.resolve_option(feed, 'post_include_content') and \
            stripped_html or \
@@ -71,7 +70,7 @@ class FacebookClient(GenericClient):
         text += ''.join([' #{}'.format(k)
                          for k in self.filter_tags(feed, entry)])
         if not self.resolve_option(feed, 'post_include_media'):
-            text += ' '+self.shorten_url(feed, entry.link)
+            text += ' '+self.shorten_entry_link(feed, entry)
         # Just in case...
         text = text.strip()
 
@@ -80,10 +79,20 @@ class FacebookClient(GenericClient):
         if self.resolve_option(feed, 'post_include_media'):
             # In this case, specify the link, which will include its media
             # (and the title as the link text, as previously mentioned)
-            attachment['link'] = self.shorten_url(feed, entry.link)
+            attachment['link'] = self.shorten_entry_link(feed, entry)
         else:
             attachment['link'] = None
 
+        return {'text': text, 'attachment': attachment}
+
+    def deliver(self, payload):
+        '''
+        Post rendered entry to Facebook.
+        :param payload:
+        '''
+        text = payload['text']
+        attachment = payload['attachment']
+
         to_return = False
         if self.is_testing():
             self.accumulate_testing_output(
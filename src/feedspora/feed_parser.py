@@ -0,0 +1,212 @@
+"""
+Streaming feed parser: an lxml iterparse-based alternative to parsing the
+whole feed document with BeautifulSoup.
+
+Elements are named the way BeautifulSoup's html.parser names them (lowercase,
+with their namespace prefix as written in the document), so that feeds parsed
+by both engines produce the same entries.
+"""
+
+import io
+import re
+
+from lxml import etree
+
+# Constructs for which the text seen by html.parser can't be reproduced:
+# carriage returns and multi-line attribute values (normalized by XML
+# parsers), whitespace-preserving or raw text elements, whitespace-only CDATA
+# sections and DTD internal subsets
+UNSUPPORTED_PATTERN = re.compile(
+    r'\r|<(?:script|style|pre|textarea)[\s/>]|<!\[CDATA\[[ \t\n\f]*\]\]>|'
+    r'<!DOCTYPE[^>]*\[|=\s*"[^"<]*[\t\n][^"<]*"|=\s*\'[^\'<]*[\t\n][^\'<]*\'',
+    re.IGNORECASE)
+# Whitespace between markup and a CDATA section
+WHITESPACE_BEFORE_CDATA = re.compile(r'(?<=>)[ \t\n\f]+(?=<!\[CDATA\[)')
+WHITESPACE_AFTER_CDATA = re.compile(r'(?<=\]\]>)[ \t\n\f]+(?=<)')
+TAG_PATTERN = re.compile(r'<[^<>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^<>"\']*)*>')
+ASCII_SPACES = ' \t\n\r\f'
+
+
+class UnsupportedFeed(Exception):
+    '''
+    Raised when the streaming parser can't guarantee the same result as the
+    BeautifulSoup parser for a feed, which should then be parsed with the
+    latter.
+    '''
+
+
+def element_name(element):
+    '''
+    Return the name of an element, as html.parser would name it
+    :param element:
+    '''
+    local_name = etree.QName(element).localname
+    if element.prefix:
+        local_name = element.prefix + ':' + local_name
+    return local_name.lower()
+
+
+def collapse_whitespace(text):
+    '''
+    Replace whitespace-only text the way BeautifulSoup does: by a newline if
+    it holds one, by a space otherwise
+    :param text:
+    '''
+    if text.strip(ASCII_SPACES):
+        return text
+    return '\n' if '\n' in text else ' '
+
+
+def element_text(element):
+    '''
+    Return the text of an element and all its descendants
+    :param element:
+    '''
+    return ''.join(collapse_whitespace(text) for text in element.itertext())
+
+
+def prepare_content(content):
+    '''
+    Check that the feed content can be parsed the same way as html.parser
+    does, and collapse the whitespace around CDATA sections, which the XML
+    parser merges with them.
+    :param content:
+    '''
+    unsupported = UNSUPPORTED_PATTERN.search(content)
+    if unsupported:
+        raise UnsupportedFeed("Unsupported construct %r" %
+                              unsupported.group(0))
+
+    if '<![CDATA[' in content:
+        def collapse_before(match):
+            '''
+            Only collapse whitespace following actual markup
+            '''
+            markup = content[content.rfind('<', 0, match.start()):
+                             match.start()]
+            if not (markup.endswith(('-->', '?>', ']]>')) or
+                    TAG_PATTERN.fullmatch(markup)):
+                raise UnsupportedFeed("Text before CDATA section")
+            return collapse_whitespace(match.group(0))
+
+        content = WHITESPACE_BEFORE_CDATA.sub(collapse_before, content)
+        content = WHITESPACE_AFTER_CDATA.sub(
+            lambda match: collapse_whitespace(match.group(0)), content)
+
+    return content
+
+
+class ParsedEntry:
+    '''
+    Fields of an Atom entry or RSS item, indexed in a single pass over its
+    descendants. Only valid until the parser moves on to the next entry.
+    '''
+
+    def __init__(self, element):
+        '''
+        Initialize
+        :param element:
+        '''
+        self.kind = element_name(element)
+        self._first = dict()
+        self._categories = []
+        for child in element.iterdescendants():
+            if not isinstance(child.tag, str):
+                # Comment or processing instruction
+                continue
+            name = element_name(child)
+            if name == 'category':
+                self._categories.append(child)
+            if name not in self._first:
+                self._first[name] = child
+
+    @staticmethod
+    def _attributes(element):
+        '''
+        Return the attributes of an element, with html.parser names
+        :param element:
+        '''
+        return {etree.QName(key).localname.lower(): value
+                for key, value in element.attrib.items()}
+
+    def has(self, name):
+        '''
+        Is there a descendant with that name?
+        :param name:
+        '''
+        return name in self._first
+
+    def text(self, name):
+        '''
+        Text of the first descendant with that name
+        :param name:
+        '''
+        if name not in self._first:
+            raise UnsupportedFeed("No %s in %s" % (name, self.kind))
+        return element_text(self._first[name])
+
+    def attribute(self, name, attribute):
+        '''
+        Attribute value of the first descendant with that name
+        :param name:
+        :param attribute:
+        '''
+        attributes = self._attributes(self._first[name]) \
+            if name in self._first else {}
+        if attribute not in attributes:
+            raise UnsupportedFeed("No %s[%s] in %s" % (name, attribute,
+                                                       self.kind))
+        return attributes[attribute]
+
+    def has_children(self, name):
+        '''
+        Does the first descendant with that name hold elements?
+        :param name:
+        '''
+        return name in self._first and len(self._first[name]) > 0
+
+    def category_texts(self):
+        '''
+        Texts of all category descendants
+        '''
+        return [element_text(category) for category in self._categories]
+
+    def category_attributes(self, attribute):
+        '''
+        Attribute values of all category descendants
+        :param attribute:
+        '''
+        to_return = []
+        for category in self._categories:
+            attributes = self._attributes(category)
+            if attribute not in attributes:
+                raise UnsupportedFeed("No category[%s] in %s" % (attribute,
+                                                                self.kind))
+            to_return.append(attributes[attribute])
+        return to_return
+
+
+def iterparse_entries(content):
+    '''
+    Generate a ParsedEntry for each Atom entry and RSS item of the feed
+    content, in document order, freeing the document as it goes.
+    Raises etree.XMLSyntaxError if the content isn't well-formed XML, and
+    UnsupportedFeed if it can't be parsed the same way as html.parser does.
+    :param content: the feed, as text
+    '''
+    # Decode the same way as for BeautifulSoup, regardless of any encoding
+    # declared in the document
+    source = io.BytesIO(prepare_content(content).encode('utf-8'))
+    for _, element in etree.iterparse(source, events=('end',),
+                                      tag=('{*}entry', '{*}item'),
+                                      encoding='utf-8',
+                                      resolve_entities=False,
+                                      huge_tree=True):
+        if element.prefix:
+            # e.g. atom:entry isn't an entry for html.parser
+            continue
+        yield ParsedEntry(element)
+        # Free what has been parsed so far
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
@@ -14,10 +14,16 @@ It currently supports Facebook, Twitter, Diaspora, Wordpress and Mastodon.
 @contact:    aurelien.grosdidier@gmail.com
 '''
 
+import collections
+import functools
 import json
 import logging
-import os
-import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from feedspora.generic_feed import date_timestamp
+from feedspora.key_value_storage import DbmStorage, MemoryStorage
+from feedspora import short_url_cache
+from feedspora.sqlite_storage import SqliteStorage
 
 class FeedSpora:
     ''' FeedSpora itself. '''
@@ -25,8 +31,25 @@ class FeedSpora:
     _client = None
     _feed = None
     _db_file = "feedspora.db"
-    _conn = None
-    _cur = None
+    _storage = None
+    _storage_name = 'sqlite'
+    _storages = {'sqlite': SqliteStorage,
+                 'dbm': DbmStorage,
+                 'memory': MemoryStorage,
+                }
+    _fetch_workers = 4
+    _publish_workers = 1
+    _publish_executor = None
+    _shorten_workers = 4
+    _use_bloom_filters = False
+    _use_outbox = False
+    # Failed deliveries are attempted again after a delay doubling each
+    # time, up to a maximum number of attempts
+    _delivery_attempts = 8
+    _retry_delay = 300
+    _max_retry_delay = 86400
+    _retry_failed = False
+    _debug_identifiers = False
 
     def __init__(self):
         '''
@@ -35,6 +58,9 @@ class FeedSpora:
         logging.basicConfig(level=logging.INFO)
         self._testing = False
         self._testing_accumulator = None
+        self._stats = None
+        # (client, entry record) deferred by rate limits waited for
+        self._deferred = []
 
     def set_db_file(self, db_file):
         '''
@@ -43,6 +69,70 @@ class FeedSpora:
         '''
         self._db_file = db_file
 
+    def set_fetch_workers(self, fetch_workers):
+        '''
+        Set the number of feeds retrieved concurrently
+        :param fetch_workers:
+        '''
+        self._fetch_workers = max(1, fetch_workers)
+
+    def set_publish_workers(self, publish_workers):
+        '''
+        Set the number of clients an entry is posted to concurrently
+        :param publish_workers:
+        '''
+        self._publish_workers = max(1, publish_workers)
+
+    def set_shorten_workers(self, shorten_workers):
+        '''
+        Set the number of links shortened concurrently before posting
+        :param shorten_workers:
+        '''
+        self._shorten_workers = max(1, shorten_workers)
+
+    def set_storage(self, storage_name):
+        '''
+        Set how published entries and feed states are stored: 'sqlite' (in
+        the database file), 'dbm' (in a dbm file next to it) or 'memory'
+        (not stored, for testing)
+        :param storage_name:
+        '''
+        if storage_name not in self._storages:
+            raise ValueError("Unknown storage: %s" % storage_name)
+        self._storage_name = storage_name
+
+    def set_bloom_filters(self, use_bloom_filters):
+        '''
+        Look up published entries through Bloom filters stored next to the
+        database, rather than loading them all in memory (SQLite storage)
+        :param use_bloom_filters:
+        '''
+        self._use_bloom_filters = use_bloom_filters
+
+    def set_outbox(self, use_outbox):
+        '''
+        Queue rendered entries in an outbox stored in the database, then
+        deliver them in a separate stage, attempting failed deliveries again
+        in later runs, rather than posting entries as they're processed
+        :param use_outbox:
+        '''
+        self._use_outbox = use_outbox
+
+    def set_retry_failed(self, retry_failed):
+        '''
+        Attempt the deliveries given up again, when delivering the outbox
+        :param retry_failed:
+        '''
+        self._retry_failed = retry_failed
+
+    def set_debug_identifiers(self, debug_identifiers):
+        '''
+        Store the identifiers of published entries along with their digests,
+        for debugging purposes
+        :param debug_identifiers:
+        '''
+        self._debug_identifiers = debug_identifiers
+
     def connect_client(self, client):
         '''
         Connects to your client.
@@ -63,22 +153,40 @@ class FeedSpora:
             self._feed = []
         self._feed.append(feed)
 
-    def _init_db(self):
+    def _init_db(self, load_published=True):
         '''
-        Initialize the connection to the database.
-        It also creates the table if the file does not exist yet.
+        Initialize the storage of published entries and feed states.
+        :param load_published: prepare the lookup of published entries
         '''
-        should_init = not os.path.exists(self._db_file)
-        self._conn = sqlite3.connect(self._db_file)
-        self._cur = self._conn.cursor()
-
-        if should_init:
-            logging.info("Creating new database file %s", self._db_file)
-            sql = "CREATE table posts (id INTEGER PRIMARY KEY, " \
-                  "feedspora_id, client_id TEXT)"
-            self._cur.execute(sql)
-        else:
-            logging.info("Found database file %s", self._db_file)
+        self._storage = self._storages[self._storage_name](self._db_file)
+        self._storage.set_bloom_filters(self._use_bloom_filters)
+        self._storage.set_debug_identifiers(self._debug_identifiers)
+        self._storage.open([client.get_config()['name']
+                            for client in self._client or []],
+                           load_published)
+        for client in self._client or []:
+            rate_limiter = client.get_rate_limiter()
+            if rate_limiter is not None:
+                state = self._storage.load_client_state(
+                    client.get_config()['name'])
+                if state and 'rate_limiter' in state:
+                    rate_limiter.set_state(state['rate_limiter'])
+        short_url_cache.get_cache().set_storage(self._storage)
+
+    def _close_db(self):
+        '''
+        Make everything stored durable and close the storage.
+        '''
+        if self._storage is not None:
+            short_url_cache.get_cache().set_storage(None)
+            # Rate limits hold across runs
+            for client in self._client or []:
+                rate_limiter = client.get_rate_limiter()
+                if rate_limiter is not None:
+                    self._storage.save_client_state(
+                        client.get_config()['name'],
+                        {'rate_limiter': rate_limiter.get_state()})
+            self._storage.close()
 
     def set_testing(self, testing):
         '''
@@ -104,6 +212,71 @@ class FeedSpora:
         return to_return
     # pylint: enable=no-self-use
 
+    def _clients_signature(self):
+        '''
+        Identify the set of connected clients, so that feed states recorded
+        with a different set of clients can be discarded
+        '''
+        return json.dumps(sorted(client.get_config()['name']
+                                 for client in self._client))
+
+    def _is_seeding(self, feed):
+        '''
+        Is the published DB being seeded for this feed? Seeding depends on
+        the position of entries in the whole feed.
+        :param feed:
+        '''
+        return feed.get_config()['max_posts'] < 0 or \
+            any(client.get_config()['max_posts'] < 0
+                for client in self._client)
+
+    def _load_feed_state(self, feed):
+        '''
+        Provide the feed with the HTTP cache validators and content digest
+        recorded the last time it was entirely processed with the same
+        clients, and with its high-water mark.
+        :param feed:
+        '''
+        state = self._storage.load_feed_state(feed.get_path(),
+                                              self._clients_signature())
+        if state:
+            feed.set_validators(state['etag'], state['last_modified'])
+            feed.set_content_hash(state['content_hash'])
+            if state['seen'] and not self._is_seeding(feed):
+                feed.set_high_water_mark(
+                    state['seen'][:feed.get_high_water_mark_size()],
+                    self.entry_identifier)
+
+    def _save_feed_state(self, feed, settled_entries, feed_settled):
+        '''
+        Record the high-water mark of a processed feed, and its HTTP cache
+        validators and content digest if it has been entirely processed.
+        :param feed:
+        :param settled_entries: (identifier, timestamp) of the entries
+                                settled in a row, in publishing order
+        :param feed_settled:
+        '''
+        mark = []
+        identifiers = set()
+        for identifier, timestamp in settled_entries[::-1] + \
+                feed.get_high_water_mark():
+            if identifier not in identifiers:
+                identifiers.add(identifier)
+                mark.append((identifier, timestamp))
+        mark = mark[:feed.get_high_water_mark_size()]
+        # Parsing can only stop at the mark if new entries are listed first
+        timestamps = [timestamp for _, timestamp in mark]
+        if None in timestamps or timestamps != sorted(timestamps,
+                                                      reverse=True):
+            mark = []
+
+        validators = None
+        if feed_settled:
+            validators = feed.get_validators() + (feed.get_content_hash(),)
+        self._storage.save_feed_state(feed.get_path(),
+                                      self._clients_signature(), mark,
+                                      validators)
+
     def is_already_published(self, entry, client):
         '''
         Checks if a FeedSporaEntry has already been published.
@@ -112,13 +285,8 @@ class FeedSpora:
         :param client:
         '''
         pub_item = self.entry_identifier(entry)
-        sql = "SELECT id from posts WHERE feedspora_id=:feedspora_id AND "\
-              "client_id=:client_id"
-        self._cur.execute(sql, {
-            "feedspora_id": pub_item,
-            "client_id": client.get_config()['name']
-        })
-        already_published = self._cur.fetchone() is not None
+        already_published = self._storage.is_published(
+            pub_item, client.get_config()['name'])
 
         if already_published:
             logging.info('Skipping already published entry in %s: %s',
@@ -129,22 +297,98 @@ class FeedSpora:
 
         return already_published
 
-    def add_to_published_entries(self, entry, client):
+    def add_to_published_entries(self, entry, client, feed=None,
+                                 posted=True):
         '''
         Add a FeedSporaEntries to the database of published items.
+        Entries actually posted are made durable at once, so that they can't
+        be posted again; seeded ones may be made durable later.
         :param entry:
         :param client:
+        :param feed: feed the entry comes from
+        :param posted: was the entry posted, rather than seeded?
         '''
         pub_item = self.entry_identifier(entry)
         logging.info('Storing in database of published items: %s', pub_item)
-        self._cur.execute(
-            "INSERT INTO posts (feedspora_id, client_id) "
-            "values (?,?)", (pub_item, client.get_config()['name']))
-        self._conn.commit()
+        self._storage.add_published(pub_item, client.get_config()['name'],
+                                    feed.get_path() if feed else None,
+                                    posted)
+
+    def claim_entry(self, entry, client, feed=None):
+        '''
+        Claim an unpublished FeedSporaEntry before publishing it, so that
+        runs sharing the database don't publish it too.
+        Returns False if another run published or claimed it meanwhile.
+        :param entry:
+        :param client:
+        :param feed: feed the entry comes from
+        '''
+        return self._storage.claim(self.entry_identifier(entry),
+                                   client.get_config()['name'],
+                                   feed.get_path() if feed else None)
+
+    def queue_entry(self, entry, client, payload, feed=None):
+        '''
+        Queue a FeedSporaEntry rendered for a client in the outbox, and add
+        it to the database of published items at the same time
+        :param entry:
+        :param client:
+        :param payload:
+        :param feed: feed the entry comes from
+        '''
+        logging.info('Queuing for delivery to %s: %s',
+                     client.get_config()['name'], entry.title)
+        self._storage.enqueue(self.entry_identifier(entry),
+                              client.get_config()['name'], payload,
+                              feed.get_path() if feed else None)
+
+    def release_entry(self, entry, client):
+        '''
+        Release the claim on a FeedSporaEntry that hasn't been published
+        :param entry:
+        :param client:
+        '''
+        self._storage.release(self.entry_identifier(entry),
+                              client.get_config()['name'])
+
+    def _is_queuing(self):
+        '''
+        Are entries queued in the outbox? Never when testing, as the output
+        of each feed is collected once it's processed.
+        '''
+        return self._use_outbox and not self._testing
+
+    def _post_to_client(self, entry, client, feed):
+        '''
+        Post a FeedSporaEntry to a client, within its limits, or render it
+        for the outbox.
+        Returns whether it was posted (the payload, if queuing), or None if
+        posting failed.
+        :param entry:
+        :param client:
+        :param feed:
+        '''
+        # pylint: disable=broad-except
+        try:
+            if self._is_queuing():
+                return client.render_within_limits(entry, feed) or False
+            return client.post_within_limits(entry, feed)
+        except Exception as error:
+            logging.error(
+                "Error while publishing '%s' to client"
+                " '%s' : %s",
+                entry.title,
+                client.__class__.__name__,
+                format(error),
+                exc_info=True)
+            return None
+        # pylint: enable=broad-except
 
     def _publish_entry(self, entry, entry_count, feed, feed_count):
         '''
         Publish a FeedSporaEntry to your all your registered account.
+        Returns whether or not the entry is now recorded as published for
+        every client.
         :param entry:
         :param entry_count:
         :param feed:
@@ -155,45 +399,159 @@ class FeedSpora:
             logging.error(
                 "No client found, aborting publication", exc_info=True)
 
-            return
+            return False
         logging.info('Publishing: %s', entry.title)
 
         entry_published = False
+        entry_settled = True
+        # Clients the entry is to be posted to, and whether it's claimed
+        pending = []
+        # Clients waiting for their rate limit to post the entry
+        deferred_to = []
         for client in self._client:
             if not self.is_already_published(entry, client):
+                # Nothing is posted beyond the limits (or while seeding),
+                # so there's nothing to claim
+                claimed = client.is_within_limits(feed)
+                if claimed and not self.claim_entry(entry, client, feed):
+                    entry_settled = False
+                    continue
+                pending.append((client, claimed))
+
+        # Clients are posted to concurrently, if configured to, and the
+        # next entry waits for all of them: each client gets entries in
+        # order, and limits are checked against exact post counts
+        post = functools.partial(self._post_to_client, entry, feed=feed)
+        if self._publish_executor is not None and len(pending) > 1:
+            results = self._publish_executor.map(
+                post, [client for client, _ in pending])
+        else:
+            results = map(post, [client for client, _ in pending])
+
+        for (client, claimed), posted_to_client in zip(pending, results):
+            if posted_to_client is None:
+                entry_settled = False
+                if claimed:
+                    self.release_entry(entry, client)
+                continue
+
+            if posted_to_client:
+                entry_published = True
+
+            if posted_to_client or \
+               client.seeding_published_db(entry_count, feed, feed_count):
                 # pylint: disable=broad-except
                 try:
-                    posted_to_client = client.post_within_limits(entry, feed)
+                    if posted_to_client and self._is_queuing():
+                        self.queue_entry(entry, client, posted_to_client,
+                                         feed)
+                    else:
+                        self.add_to_published_entries(
+                            entry, client, feed,
+                            posted=bool(posted_to_client))
                 except Exception as error:
                     logging.error(
-                        "Error while publishing '%s' to client"
-                        " '%s' : %s",
+                        "Error while storing '%s' to client"
+                        "'%s' : %s",
                         entry.title,
                         client.__class__.__name__,
                         format(error),
                         exc_info=True)
-
-                    continue
-
-                if posted_to_client:
-                    entry_published = True
-
-                if posted_to_client or \
-                   client.seeding_published_db(entry_count, feed, feed_count):
-                    try:
-                        self.add_to_published_entries(entry, client)
-                    except Exception as error:
-                        logging.error(
-                            "Error while storing '%s' to client"
-                            "'%s' : %s",
-                            entry.title,
-                            client.__class__.__name__,
-                            format(error),
-                            exc_info=True)
+                    entry_settled = False
                 # pylint: enable=broad-except
-
+            else:
+                # Left for a later run (limits reached), or for the end of
+                # this one if the client waits for its rate limit
+                entry_settled = False
+                if claimed:
+                    self.release_entry(entry, client)
+                    if client.is_rate_limited() and \
+                       client.waits_for_token():
+                        deferred_to.append(client)
+
+        # Clients only record short URLs in memory from other threads
+        short_url_cache.get_cache().flush()
         if entry_published:
             feed.increment_posts_done()
+        if deferred_to:
+            # Shared by the clients, so that the entry counts once for the
+            # feed
+            record = {'entry': entry, 'feed': feed,
+                      'counted': entry_published}
+            self._deferred.extend((client, record) for client in deferred_to)
+
+        return entry_settled
+
+    def _plan_posts(self, entries, feed):
+        '''
+        Return the (entry, client) pairs to be posted, as far as can be told
+        before posting: entries not published to the client yet, within the
+        limits of both client and feed, to clients that haven't reached
+        their rate limit
+        :param entries:
+        :param feed:
+        '''
+        feed_max_posts = feed.get_config()['max_posts']
+        feed_posts = feed.get_posts_done() if feed_max_posts else 0
+        client_posts = [client.get_posts_done()
+                        if client.get_config()['max_posts'] else 0
+                        for client in self._client]
+        # Rate limited clients post nothing more until the end of the run,
+        # if they wait for their rate limit at all
+        clients = [(index, client) for index, client in
+                   enumerate(self._client) if not client.is_rate_limited()]
+        planned = []
+        for entry in entries:
+            if feed_max_posts and feed_posts >= feed_max_posts:
+                break
+            identifier = self.entry_identifier(entry)
+            posted = False
+            for index, client in clients:
+                max_posts = client.get_config()['max_posts']
+                if (max_posts and client_posts[index] >= max_posts) or \
+                   self._storage.is_published(identifier,
+                                              client.get_config()['name']):
+                    continue
+                planned.append((entry, client))
+                client_posts[index] += 1
+                posted = True
+            if posted:
+                feed_posts += 1
+        return planned
+
+    def _prefetch_short_urls(self, entries, feed):
+        '''
+        Shorten the links of the entries about to be posted concurrently,
+        once per link and URL shortener configuration, so that clients
+        find them shortened rather than waiting for each in turn. Links
+        already shortened are looked up in the storage beforehand, from
+        this thread, and the new short URLs saved afterwards, so that
+        clients posting from other threads find them too.
+        :param entries:
+        :param feed:
+        '''
+        if not self._client:
+            return
+        tasks = dict()
+        for entry, client in self._plan_posts(entries, feed):
+            key = client.url_shortener_key(feed)
+            if entry.link and key is not None and \
+               (id(entry), key) not in tasks and \
+               not client.is_link_shortened(feed, entry):
+                tasks[(id(entry), key)] = (client, entry)
+        if not tasks:
+            return
+        logging.info("Shortening %d link(s)", len(tasks))
+        if self._shorten_workers < 2:
+            for client, entry in tasks.values():
+                client.shorten_entry_link(feed, entry)
+        else:
+            with ThreadPoolExecutor(max_workers=min(self._shorten_workers,
+                                                    len(tasks))) as executor:
+                list(executor.map(
+                    lambda task: task[0].shorten_entry_link(feed, task[1]),
+                    tasks.values()))
+        short_url_cache.get_cache().flush()
 
     def _process_feed(self, entry_count, feed):
         '''
@@ -204,18 +562,41 @@ class FeedSpora:
         '''
 
         entry_generator = feed.feed_generator()
+        if feed.is_not_modified():
+            self._stats['not_modified'] += 1
+        elif feed.is_unchanged():
+            self._stats['unchanged'] += 1
+            # The same content may come with new validators: keep them so
+            # that the server can answer 304 next time
+            self._save_feed_state(feed, [], True)
         if entry_generator:
+            entries = list(entry_generator)
+            self._prefetch_short_urls(entries, feed)
             feed_count = 0
-            for entry in entry_generator:
+            feed_settled = True
+            # Entries settled in a row, in publishing order
+            settled_entries = []
+            for entry in entries:
                 entry_count += 1
                 feed_count += 1
-                self._publish_entry(entry, entry_count, feed, feed_count)
+                if not self._publish_entry(entry, entry_count, feed,
+                                           feed_count):
+                    feed_settled = False
+                elif feed_settled:
+                    settled_entries.append(
+                        (self.entry_identifier(entry),
+                         date_timestamp(entry.published_date)))
                 if feed.max_posts_done():
                     # If feed limit reached, we're done here; break out
                     logging.info("Configured feed limit of %d reached.",
                                  feed.get_config()['max_posts'])
+                    feed_settled = False
                     break
 
+            # Only remember the feed validators if there's nothing left to
+            # publish from this version of the feed
+            self._save_feed_state(feed, settled_entries, feed_settled)
+
             if self._testing:
                 output = {
                     client.get_config()['name']: client.pop_testing_output()
@@ -225,6 +606,218 @@ class FeedSpora:
                 self._testing_accumulator[feed.get_path()] = output
         return entry_count
 
+    def _wait_in_turn(self, deferred, action):
+        '''
+        Apply an action to what the rate limits of clients waiting for them
+        deferred, in order for each client: the client with the nearest
+        token goes first, once it's available
+        :param deferred: (client, item) pairs
+        :param action: called with each client and item
+        '''
+        queues = collections.OrderedDict()
+        for client, item in deferred:
+            queues.setdefault(client, []).append(item)
+        while queues:
+            client = min(queues, key=lambda client:
+                         client.get_rate_limiter().wait_time())
+            client.wait_for_token()
+            action(client, queues[client].pop(0))
+            if not queues[client]:
+                del queues[client]
+
+    def _post_deferred(self, client, record):
+        '''
+        Post an entry deferred by the rate limit of a client, unless another
+        run claimed it meanwhile
+        :param client:
+        :param record: entry, its feed, and whether it counted for the feed
+        '''
+        entry, feed = record['entry'], record['feed']
+        if not self.claim_entry(entry, client, feed):
+            return
+        posted_to_client = self._post_to_client(entry, client, feed)
+        if not posted_to_client:
+            self.release_entry(entry, client)
+            return
+        if not record['counted']:
+            record['counted'] = True
+            feed.increment_posts_done()
+        # pylint: disable=broad-except
+        try:
+            self.add_to_published_entries(entry, client, feed)
+        except Exception as error:
+            logging.error(
+                "Error while storing '%s' to client"
+                "'%s' : %s",
+                entry.title,
+                client.__class__.__name__,
+                format(error),
+                exc_info=True)
+        # pylint: enable=broad-except
+
+    def _process_feeds(self):
+        '''
+        Retrieve all feeds and publish their new entries, then those
+        deferred by the rate limits clients wait for.
+        '''
+        for feed in self._feed:
+            self._load_feed_state(feed)
+        self._deferred = []
+
+        # Feeds are retrieved concurrently, but processed one at a time in
+        # their configured order
+        entry_count = 0
+        if self._publish_workers > 1 and len(self._client or []) > 1:
+            self._publish_executor = ThreadPoolExecutor(
+                max_workers=min(self._publish_workers, len(self._client)))
+        try:
+            with ThreadPoolExecutor(
+                    max_workers=self._fetch_workers) as executor:
+                fetches = [executor.submit(feed.fetch)
+                           for feed in self._feed]
+                for feed, fetch in zip(self._feed, fetches):
+                    fetch.result()
+                    entry_count = self._process_feed(entry_count, feed)
+            self._wait_in_turn(self._deferred, self._post_deferred)
+        finally:
+            if self._publish_executor is not None:
+                self._publish_executor.shutdown()
+                self._publish_executor = None
+
+    def _deliver_outbox(self):
+        '''
+        Deliver the entries queued in the outbox. Failed deliveries are
+        attempted again in later runs, with an exponential backoff, until
+        they're given up; they're kept in the outbox, to be retried on
+        demand.
+        '''
+        clients = {client.get_config()['name']: client
+                   for client in self._client}
+        if self._retry_failed:
+            logging.info("Retrying %d failed deliveries",
+                         self._storage.retry_failed_deliveries(list(clients)))
+        deliveries = self._storage.due_deliveries(list(clients))
+        logging.info("%d queued entries to deliver", len(deliveries))
+        deferred = []
+        for delivery in deliveries:
+            client = clients[delivery[1]]
+            if client.acquire_token():
+                self._deliver(client, delivery)
+            elif client.waits_for_token():
+                deferred.append((client, delivery))
+            else:
+                self._postpone(client, delivery)
+        self._wait_in_turn(deferred, self._deliver_deferred)
+
+        failed = self._storage.count_failed_deliveries(list(clients))
+        if failed:
+            logging.warning("%d failed deliveries kept in the outbox; run "
+                            "with --retry-failed to attempt them again",
+                            failed)
+
+    def _postpone(self, client, delivery):
+        '''
+        Make a delivery due again once the client has a token
+        :param client:
+        :param delivery: (delivery id, client name, payload, attempts)
+        '''
+        self._storage.postpone_delivery(
+            delivery[0], client.get_rate_limiter().wait_time(), failed=False)
+
+    def _deliver_deferred(self, client, delivery):
+        '''
+        Deliver a delivery deferred by the rate limit of a client
+        :param client:
+        :param delivery: (delivery id, client name, payload, attempts)
+        '''
+        if client.acquire_token():
+            self._deliver(client, delivery)
+        else:
+            self._postpone(client, delivery)
+
+    def _deliver(self, client, delivery):
+        '''
+        Deliver a queued entry, with a token of the client
+        :param client:
+        :param delivery: (delivery id, client name, payload, attempts)
+        '''
+        delivery_id, client_name, payload, attempts = delivery
+        # pylint: disable=broad-except
+        try:
+            delivered = client.deliver(payload)
+        except Exception as error:
+            logging.error("Error while delivering to client '%s' : %s",
+                          client_name, format(error), exc_info=True)
+            delivered = False
+        # pylint: enable=broad-except
+        attempts += 1
+        if delivered:
+            self._storage.remove_delivery(delivery_id)
+        elif attempts >= self._delivery_attempts:
+            logging.error("Giving up delivering to client '%s' after %d "
+                          "attempts", client_name, attempts)
+            self._storage.fail_delivery(delivery_id)
+        else:
+            self._storage.postpone_delivery(
+                delivery_id, min(self._retry_delay * 2 ** (attempts - 1),
+                                 self._max_retry_delay))
+
+    def deliver(self):
+        '''
+        Only deliver the entries queued in the outbox, without retrieving
+        the feeds
+        '''
+        if not self._client:
+            logging.error(
+                "No client found, aborting delivery", exc_info=True)
+            return
+
+        self._init_db(load_published=False)
+        try:
+            self._deliver_outbox()
+        finally:
+            self._close_db()
+
+    def compact(self, retention_days):
+        '''
+        Compact the database: record which published entries are still in
+        the feeds, delete those that haven't been seen in any feed for
+        retention_days, forget the state of unconfigured feeds, then VACUUM
+        and ANALYZE.
+        Nothing is deleted if a feed can't be read, as its entries would be
+        unknown.
+        :param retention_days:
+        '''
+        self._init_db(load_published=False)
+        try:
+            # Every entry is needed: nothing is loaded from the feed states
+            with ThreadPoolExecutor(
+                    max_workers=self._fetch_workers) as executor:
+                fetches = [executor.submit(feed.fetch)
+                           for feed in self._feed or []]
+                seen = set()
+                readable = True
+                for feed, fetch in zip(self._feed or [], fetches):
+                    fetch.result()
+                    entry_generator = feed.feed_generator()
+                    if entry_generator is None:
+                        logging.error("No entry read from %s, not pruning "
+                                      "the database", feed.get_path())
+                        readable = False
+                        continue
+                    seen.update(self.entry_identifier(entry)
+                                for entry in entry_generator)
+
+            logging.info("%d published entries still in the feeds",
+                         len(seen))
+            self._storage.compact(seen, retention_days,
+                                  [feed.get_path()
+                                   for feed in self._feed or []],
+                                  self._clients_signature(),
+                                  prune=readable)
+        finally:
+            self._close_db()
+
     def run(self):
         '''
         Run FeedSpora: initialize the database and process the list of
@@ -237,10 +830,19 @@ class FeedSpora:
             return
 
         self._init_db()
-
-        entry_count = 0
-        for feed in self._feed:
-            entry_count = self._process_feed(entry_count, feed)
+        self._stats = {'not_modified': 0, 'unchanged': 0}
+        try:
+            self._process_feeds()
+            if self._is_queuing():
+                self._deliver_outbox()
+        finally:
+            self._close_db()
+
+        logging.info("%d of %d feed(s) not modified since last run",
+                     self._stats['not_modified'], len(self._feed))
+        logging.info("%d of %d feed(s) retrieved again, with unchanged "
+                     "content", self._stats['unchanged'], len(self._feed))
+        self._storage.log_summary()
 
         if self._testing:
             print(json.dumps(self._testing_accumulator, indent=4))
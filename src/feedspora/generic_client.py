@@ -2,23 +2,78 @@
 GenericClient: baseclass providing features to specific clients.
 """
 
+import json
 import logging
 import os
-import posixpath
 import re
 import mimetypes
-import urllib.parse
-import urllib.request
+import time
 import lxml.html
-import pyshorteners
 
 from feedspora.common_config import CommonConfig
+from feedspora import http_session
+from feedspora import media_cache
+from feedspora.rate_limiter import TokenBucket
+from feedspora import short_url_cache
+from feedspora.tag_inserter import get_tag_inserter
+
+# Characters the HTML parser interprets or drops
+REPARSED_PATTERN = re.compile(
+    '[<&\r\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f\ud800-\udfff\ufeff\ufffe'
+    '\uffff]')
+SINGLE_TAG_PATTERN = re.compile(r'^\s*#[\w]+$')
+
+
+def _is_word(char):
+    '''
+    Is the character matched by \\w?
+    :param char:
+    '''
+    return char.isalnum() or char == '_'
+
+
+def strip_ending_tags(content):
+    '''
+    Remove the whitespace-separated tags ending the content, as repeatedly
+    removing r'\\s+#([\\w]+)$' would (including a tag ending the content
+    right before its final newline, which is kept), in a single backward
+    scan
+    :param content:
+    '''
+    # The content is reduced to content[:end], plus its final newline if
+    # a tag was removed before it
+    end = len(content)
+    newline = ''
+    while True:
+        tag_end = end
+        if not newline and content[end - 1:end] == '\n':
+            tag_end = end - 1
+        start = tag_end
+        while start > 0 and _is_word(content[start - 1]):
+            start -= 1
+        if start == tag_end or start == 0 or content[start - 1] != '#':
+            break
+        start -= 1
+        if start == 0 or not content[start - 1].isspace():
+            break
+        while start > 0 and content[start - 1].isspace():
+            start -= 1
+        if tag_end < end:
+            newline = '\n'
+        end = start
+
+    if end == len(content):
+        return content
+    return content[:end] + newline
+
 
 class GenericClient(CommonConfig):
     ''' Implements the base functionalities expected from clients '''
 
     _testing_root = None
     _testing_output = None
+    _rate_limiter = None
+    _rate_limited = False
 
     def set_testing_root(self, testing_root):
         '''
@@ -68,6 +123,69 @@ class GenericClient(CommonConfig):
 
         return {"client": self._config['name'], "content": kwargs['text']}
 
+    def set_common_opts(self, config, is_override=False):
+        '''
+        Set options common to all clients, including their rate limit:
+        rate_limit posts per hour, in bursts of up to rate_burst posts,
+        waited for at the end of the run if rate_wait is set
+        :param config:
+        :param is_override:
+        '''
+        super().set_common_opts(config, is_override)
+        if self._config.get('rate_limit'):
+            self._rate_limiter = TokenBucket(self._config['rate_limit'],
+                                             self._config.get('rate_burst',
+                                                              1))
+
+    def get_rate_limiter(self):
+        '''
+        Return the rate limiter of the client, if it's rate limited
+        '''
+        return self._rate_limiter
+
+    def acquire_token(self):
+        '''
+        Take a token from the rate limiter, if any, to post now. Once its
+        rate limit is reached, the client posts nothing more until it waits
+        for a token, so that entries are still posted in order later on.
+        '''
+        if self._rate_limiter is None or self.is_testing():
+            return True
+        if not self._rate_limited and self._rate_limiter.try_acquire():
+            return True
+        if not self._rate_limited:
+            logging.info("Rate limit of %s reached, next post possible in "
+                         "%d seconds", self._config['name'],
+                         self._rate_limiter.wait_time())
+            self._rate_limited = True
+        return False
+
+    def is_rate_limited(self):
+        '''
+        Has the client reached its rate limit during the run?
+        '''
+        return self._rate_limited
+
+    def waits_for_token(self):
+        '''
+        Does the client wait for its rate limit at the end of the run, to
+        post the entries it deferred, rather than leave them to a later run?
+        '''
+        return self._rate_limiter is not None and \
+            bool(self._config.get('rate_wait'))
+
+    def wait_for_token(self):
+        '''
+        Sleep until the rate limiter has a token, and let the client post
+        again
+        '''
+        wait = self._rate_limiter.wait_time()
+        if wait > 0:
+            logging.info("Waiting %d seconds for the rate limit of %s", wait,
+                         self._config['name'])
+            time.sleep(wait)
+        self._rate_limited = False
+
     def resolve_option(self, feed, option):
         '''
         Resolve a named option between a client and a feed and return the
@@ -81,14 +199,32 @@ class GenericClient(CommonConfig):
             to_return = self._config[option]
         return to_return
 
-    def post(self, feed, entry):
+    def render(self, feed, entry):
         '''
-        Placeholder for post, override it in subclasses
+        Placeholder for render, override it in subclasses: return the
+        payload posting the entry takes, as a dict of JSON-serializable
+        values, so that it can be stored and delivered later
         :param feed:
         :param entry:
         '''
         raise NotImplementedError("Please implement!")
 
+    def deliver(self, payload):
+        '''
+        Placeholder for deliver, override it in subclasses: post a rendered
+        payload, and return the result of the post
+        :param payload:
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def post(self, feed, entry):
+        '''
+        Post entry: render it, then deliver it at once
+        :param feed:
+        :param entry:
+        '''
+        return self.deliver(self.render(feed, entry))
+
     # pylint: disable=no-self-use
     def _trim_string(self, text, maxlen, etc='...', etc_if_shorter_than=None):
         '''
@@ -104,12 +240,10 @@ class GenericClient(CommonConfig):
             to_return = text
         else:
             tmpmaxlen = maxlen - len(etc)
-            space_pos = [
-                x for x in range(0, len(text))
-
-                if text[x] == ' ' and x < tmpmaxlen
-            ]
-            cut_at = space_pos[-1] if space_pos else tmpmaxlen
+            # Cut at the last space before the limit
+            cut_at = text.rfind(' ', 0, tmpmaxlen) if tmpmaxlen > 0 else -1
+            if cut_at < 0:
+                cut_at = tmpmaxlen
             to_return = text[:cut_at]
 
             if etc_if_shorter_than and cut_at < etc_if_shorter_than:
@@ -137,60 +271,26 @@ class GenericClient(CommonConfig):
         :param separator:
         '''
 
-        def repl(match):
-            return '%s#%s%s' % (match.group(1), match.group(2), match.group(3))
-
-        # Constants used in regex pattern generation
-        # pylint: disable=anomalous-backslash-in-string
-        before_tag = r'(\A|[\'"/([{\s])'
-        after_tag = r'(\Z|[\'"/\s)\]},.!?:])'
-        # pylint: enable=anomalous-backslash-in-string
-
-        to_return = text
+        # Remove any illegal characters from the tags, whose order needs to
+        # be observed
+        inserter = get_tag_inserter(
+            tuple(re.sub(r'[\-\.]', '', word) for word in tags))
 
-        # Tag order needs to be observed
-        # Set manipulations ignore that, so use lists instead!
-
-        # Find inline and extra tags
-        inline_kw = []
-        extra_kw = []
-
-        for word in tags:
-            # remove any illegal characters
-            word = re.sub(r'[\-\.]', '', word)
-
-            if re.search(
-                    r'%s#?(%s)%s' % (before_tag, re.escape('%s' % word),
-                                     after_tag), to_return, re.IGNORECASE):
-                inline_kw.append(word)
-            else:
-                extra_kw.append(word)
-
-        # Process inline tags
-        for word in inline_kw:
-            pattern = (
-                r'%s(%s)%s' % (before_tag, re.escape('%s' % word), after_tag))
-
-            if re.search(pattern, to_return, re.IGNORECASE):
-                to_return = re.sub(
-                    pattern, repl, to_return, flags=re.IGNORECASE)
+        # Turn inline tags into hashtags, and find extra tags. Once the text
+        # is maxlen long, the rest of it would be trimmed anyway, so it's
+        # neither built nor extended.
+        to_return, extra_kw = inserter.insert(text, maxlen)
 
         # Add separator and tags, if needed
         minlen_wo_xtra_kw = len(to_return)
 
         if extra_kw:
             fake_separator = separator.replace(' ', '_')
-            to_return += fake_separator
-            minlen_wo_xtra_kw = len(to_return)
-
-            # Add extra (ordered) tags
-            for word in extra_kw:
-                # prevent duplication
-                pattern = (r'%s#(%s)%s' % (before_tag, re.escape('%s' % word),
-                                           after_tag))
+            minlen_wo_xtra_kw = len(to_return) + len(fake_separator)
 
-                if re.search(pattern, to_return, re.IGNORECASE) is None:
-                    to_return += " #" + word
+            # Add extra (ordered) tags, preventing duplication
+            to_return = inserter.append(to_return, fake_separator, extra_kw,
+                                        maxlen)
 
         # If the text is too long, cut it and, if needed, add suffix
         if maxlen is not None:
@@ -240,62 +340,38 @@ class GenericClient(CommonConfig):
     # pylint: disable=no-self-use
     def download_media(self, the_url):
         '''
-        Download the media file referenced by the_url
+        Download the media file referenced by the_url, through the media
+        cache shared by all clients
         Returns the path to the downloaded file
         :param the_url:
         '''
+        return media_cache.get_cache().get(the_url)
+    # pylint: enable=no-self-use
 
-        def get_filename_from_cd(content_disp):
-            '''
-            Get filename from Content-Disposition
-            :param content_disp:
-            '''
-
-            to_return = None
-
-            if content_disp:
-                fname = re.findall('filename=(.+)', content_disp)
-
-                if fname:
-                    to_return = fname[0]
-
-            return to_return
-
-
-        def get_filename_from_response(the_response):
-            '''
-            Attempt to get the filename from the response
-            :param the_response:
-            '''
-
-            url_parts = urllib.parse.urlparse(the_response.geturl())
-            to_return = posixpath.basename(url_parts.path)
-            # Sanity check
-            if not re.match(r'^[\w-]+\.(jpg|jpeg|gif|png)$',
-                            to_return, re.IGNORECASE):
-                # Nope, "bad" filename
-                logging.error("Invalid media filename '%s' - ignoring",
-                              to_return)
-                to_return = ''
-
-            return to_return
-
-        request = urllib.request.Request(the_url)
-        request.add_header('User-Agent', 'Mozilla/5.0')
-        response = urllib.request.urlopen(request)
-        filename = get_filename_from_cd(
-            request.get_header('Content-Disposition')) or \
-            get_filename_from_response(response) or \
-            'random.jpg'
-
-        media_dir = os.getenv('MEDIA_DIR', '/tmp')
-        full_path = media_dir + '/' + filename
-        logging.info("Downloading %s as %s...", the_url, full_path)
-        with open(full_path, 'wb') as file_chunk:
-            file_chunk.write(response.read())
+    def refresh_media(self, media_path, media_url):
+        '''
+        Return the path of a media downloaded when rendering, downloading it
+        again if it's gone since (delivery may happen in a later run)
+        :param media_path:
+        :param media_url:
+        '''
+        if media_path and media_url and not os.path.exists(media_path):
+            media_path = self.download_media(media_url)
+        return media_path
 
-        return full_path
-    # pylint: enable=no-self-use
+    def is_within_limits(self, feed):
+        '''
+        Can entries of the feed still be posted, within specified limits of
+        both client and feed?
+        :param feed:
+        '''
+        # The client config and feed config need to be taken into
+        # consideration independently; don't use resolve_option
+        post_from_feed = not feed.is_post_limited() or \
+                         feed.get_posts_done() < feed.get_config()['max_posts']
+        post_to_client = not self.is_post_limited() or \
+                         self.get_posts_done() < self.get_config()['max_posts']
+        return post_from_feed and post_to_client
 
     def post_within_limits(self, entry_to_post, feed):
         '''
@@ -306,13 +382,7 @@ class GenericClient(CommonConfig):
         '''
         to_return = False
 
-        # The client config and feed config need to be taken into
-        # consideration independently; don't use resolve_option
-        post_from_feed = not feed.is_post_limited() or \
-                         feed.get_posts_done() < feed.get_config()['max_posts']
-        post_to_client = not self.is_post_limited() or \
-                         self.get_posts_done() < self.get_config()['max_posts']
-        if post_from_feed and post_to_client:
+        if self.is_within_limits(feed) and self.acquire_token():
             to_return = self.post(feed, entry_to_post)
 
             if to_return:
@@ -320,6 +390,20 @@ class GenericClient(CommonConfig):
 
         return to_return
 
+    def render_within_limits(self, entry_to_render, feed):
+        '''
+        Render entry for a later delivery, as long as within specified
+        limits of both client and feed: rendered entries count as posted.
+        Returns the payload, or None beyond limits
+        :param entry_to_render:
+        :param feed:
+        '''
+        if not self.is_within_limits(feed):
+            return None
+        payload = self.render(feed, entry_to_render)
+        self.increment_posts_done()
+        return payload
+
     def seeding_published_db(self, entry_count, feed, feed_count):
         '''
         Override to post not being published, but marking it as published
@@ -353,27 +437,35 @@ class GenericClient(CommonConfig):
 
         url_shortener = self.resolve_option(feed, 'url_shortener')
         if the_url and url_shortener and url_shortener != 'none':
+            available_shorteners = http_session.available_shorteners()
+            cache = short_url_cache.get_cache()
+            # Short URLs and failures depend on the options too
+            shortener_key = self.url_shortener_key(feed)
             try:
-                shortener = pyshorteners.Shortener(**short_options)
                 # Verify a legal choice
-                # pylint: disable=no-member
-                assert url_shortener in shortener.available_shorteners
-                # pylint: enable=no-member
-                to_return = getattr(shortener, url_shortener).short(the_url)
-                # Sanity check!
-
-                if len(to_return) > len(the_url):
-                    # Not shorter?  You're fired!
-                    raise RuntimeError(
-                        'Shortener %s produced a longer URL ' +
-                        'than the original!', url_shortener)
+                assert url_shortener in available_shorteners
+                # Empty if it failed recently
+                cached = cache.get(the_url, shortener_key)
+                if cached is not None:
+                    to_return = cached or the_url
+                else:
+                    to_return = http_session.get_shortener(
+                        url_shortener, short_options).short(the_url)
+                    # Sanity check!
+
+                    if len(to_return) > len(the_url):
+                        # Not shorter?  You're fired!
+                        raise RuntimeError(
+                            'Shortener %s produced a longer URL ' +
+                            'than the original!', url_shortener)
+                    cache.put(the_url, shortener_key, to_return)
             # pylint: disable=broad-except
             except Exception as exception:
                 # Shortening attempt failed somehow (we don't care how, except
                 # for messaging purposes) - revert to non-shortened link
 
                 if isinstance(exception, AssertionError):
-                    all_shorteners = ' '.join(shortener.available_shorteners)
+                    all_shorteners = ' '.join(available_shorteners)
                     logging.error('URL shortener %s is unimplemented!',
                                   url_shortener)
                     logging.info('Available URL shorteners: %s',
@@ -381,17 +473,91 @@ class GenericClient(CommonConfig):
                 else:
                     logging.error('Cannot shorten URL %s with %s: %s',
                                   the_url, url_shortener, str(exception))
+                    # Don't try again for every post
+                    cache.put(the_url, shortener_key, '')
                 to_return = the_url
             # pylint: enable=broad-except
 
         return to_return
 
+    def _options_key(self, feed, *options):
+        '''
+        Hashable values of the resolved options, on which a value derived
+        from an entry depends
+        :param feed:
+        :param options:
+        '''
+        return json.dumps([self.resolve_option(feed, option)
+                           for option in options], sort_keys=True,
+                          default=str)
+
+    def url_shortener_key(self, feed):
+        '''
+        Hashable configuration of the URL shortener links are shortened
+        with, None if they aren't
+        :param feed:
+        '''
+        url_shortener = self.resolve_option(feed, 'url_shortener')
+        if not url_shortener or url_shortener == 'none':
+            return None
+        return self._options_key(feed, 'url_shortener', 'url_shortener_opts')
+
+    def is_link_shortened(self, feed, entry):
+        '''
+        Has the link of the entry been shortened already with the configured
+        URL shortener, or failed to be recently? Its short URL is then kept
+        in memory, where it's found from any thread
+        :param feed:
+        :param entry:
+        '''
+        return short_url_cache.get_cache().get(
+            entry.link, self.url_shortener_key(feed)) is not None
+
+    def shorten_entry_link(self, feed, entry):
+        '''
+        Return the link of the entry shortened with the configured URL
+        shortener, shortening it once for all the clients configured alike
+        :param feed:
+        :param entry:
+        '''
+        return entry.derive(
+            ('shorten_url', self._options_key(feed, 'url_shortener',
+                                              'url_shortener_opts')),
+            lambda: self.shorten_url(feed, entry.link))
+
+    def strip_entry_content(self, feed, entry):
+        '''
+        Return the content of the entry stripped from HTML (None if it has
+        no content), stripping it once for all the clients configured alike
+        :param feed:
+        :param entry:
+        '''
+        if not entry.content:
+            return None
+        tag_filter_opts = self.resolve_option(feed, 'tag_filter_opts')
+        return entry.derive(
+            ('strip_html', bool(tag_filter_opts and
+                                'ignore_content' in tag_filter_opts)),
+            lambda: self.strip_html(feed, entry.content))
+
     def filter_tags(self, feed, entry):
         '''
         Filter the client/feed-specific tag list and entry tag lists
         (title, content, category) according to the client/feed-specific tag
         filtering options, producing an ordered and size-limited tag list
-        to be used during posting
+        to be used during posting. Tags are filtered once for all the
+        clients configured alike.
+        :param feed:
+        :param entry:
+        '''
+        return list(entry.derive(
+            ('filter_tags', self._options_key(feed, 'tags', 'tag_filter_opts',
+                                              'max_tags')),
+            lambda: self._filter_tags(feed, entry)))
+
+    def _filter_tags(self, feed, entry):
+        '''
+        Filter the tags of the entry
         :param feed:
         :param entry:
         '''
@@ -446,14 +612,9 @@ class GenericClient(CommonConfig):
         tag_filter_opts = self.resolve_option(feed, 'tag_filter_opts')
         if content and \
            (not (tag_filter_opts and 'ignore_content' in tag_filter_opts)):
-            tag_pattern = r'\s+#([\w]+)$'
-            match_result = re.search(tag_pattern, content)
-
-            while match_result:
-                content = re.sub(tag_pattern, '', content)
-                match_result = re.search(tag_pattern, content)
+            content = strip_ending_tags(content)
 
-            if re.match(r'^\s*#[\w]+$', content):
+            if SINGLE_TAG_PATTERN.match(content):
                 # Left with a single tag!
                 content = ''
 
@@ -466,15 +627,15 @@ class GenericClient(CommonConfig):
         :param before_strip:
         '''
 
-        to_return = None
-        # Getting the stripped HTML might take multiple attempts
-        done = False
-        while not done:
+        to_return = lxml.html.fromstring(before_strip).text_content().strip()
+        # Stripping again is needed for entity-escaped HTML, and stops once
+        # it doesn't change the text. It can't change text left without any
+        # markup, entity or character the parser would drop.
+        while to_return != before_strip and \
+              (not to_return or REPARSED_PATTERN.search(to_return)):
+            before_strip = to_return
             to_return = lxml.html.fromstring(
                 before_strip).text_content().strip()
-            done = to_return == before_strip
-            if not done:
-                before_strip = to_return
         # Remove all tags from end of content!
         to_return = self.remove_ending_tags(feed, to_return)
 
@@ -2,13 +2,60 @@
 GenericFeed: base class providing features to specific feeds.
 """
 
+import datetime
+import email.utils
+import hashlib
 import logging
 import re
+import threading
 import requests
 import lxml.html
+from lxml import etree
 from bs4 import BeautifulSoup
 
 from feedspora.common_config import CommonConfig
+from feedspora.feed_parser import UnsupportedFeed, iterparse_entries
+from feedspora.http_session import get_session
+
+ISO_DATE_PATTERN = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)(?:[Tt ](\d\d):(\d\d)(?::(\d\d)(\.\d+)?)?)?'
+    r'\s*(?:([Zz])|([+-])(\d\d):?(\d\d))?$')
+
+
+def date_timestamp(date):
+    '''
+    Return the POSIX timestamp of an RFC 822 (RSS) or ISO 8601 (Atom) date,
+    None if it can't be parsed
+    :param date:
+    '''
+    if not date:
+        return None
+    date = date.strip()
+    parsed = email.utils.parsedate_tz(date)
+    if parsed:
+        return email.utils.mktime_tz(parsed)
+    parsed = ISO_DATE_PATTERN.match(date)
+    if not parsed:
+        return None
+    fields = parsed.groups()
+    offset = datetime.timedelta()
+    if fields[8]:
+        offset = datetime.timedelta(hours=int(fields[9]),
+                                    minutes=int(fields[10]))
+        if fields[8] == '-':
+            offset = -offset
+    try:
+        return datetime.datetime(
+            *[int(field or 0) for field in fields[:6]],
+            microsecond=int(float(fields[6] or 0) * 1000000),
+            tzinfo=datetime.timezone(offset)).timestamp()
+    except ValueError:
+        return None
+
+
+# Guards the creation of the caches of derived values
+_DERIVED_LOCK = threading.Lock()
+
 
 # pylint: disable=too-few-public-methods
 class FeedSporaEntry:
@@ -23,6 +70,32 @@ class FeedSporaEntry:
     content = ''
     tags = None
     media_url = None
+
+    # Values derived from the entry, and their locks
+    _derived = None
+    _derived_locks = None
+
+    def derive(self, key, compute):
+        '''
+        Return a value derived from the entry when rendering it, such as its
+        stripped content or shortened link, computing it only the first time
+        it's needed: clients rendering the entry with the same options share
+        it, even when rendering concurrently
+        :param key: hashable description of the value and of the options it
+                    depends on
+        :param compute: function computing the value
+        '''
+        with _DERIVED_LOCK:
+            if self._derived is None:
+                self._derived = dict()
+                self._derived_locks = dict()
+            if key in self._derived:
+                return self._derived[key]
+            key_lock = self._derived_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self._derived:
+                self._derived[key] = compute()
+            return self._derived[key]
 # pylint: enable=too-few-public-methods
 
 
@@ -31,6 +104,16 @@ class GenericFeed(CommonConfig):
     Implements the base functionalities expected from feeds.
     '''
     _path = None
+    _etag = None
+    _last_modified = None
+    _not_modified = False
+    _content_hash = None
+    _unchanged = False
+    _high_water_mark = None
+    _seen = None
+    _identify = None
+    _entries = None
+    _fetched = False
     _ua = "Mozilla/5.0 (X11; Linux x86_64; rv:42.0) Gecko/20100101 " \
           "Firefox/42.0"
 
@@ -58,6 +141,85 @@ class GenericFeed(CommonConfig):
         '''
         return self._path
 
+    def set_validators(self, etag, last_modified):
+        '''
+        Set the HTTP cache validators (ETag and Last-Modified) remembered
+        from the last time this feed was entirely processed
+        :param etag:
+        :param last_modified:
+        '''
+        self._etag = etag
+        self._last_modified = last_modified
+
+    def get_validators(self):
+        '''
+        Get the HTTP cache validators (ETag and Last-Modified) returned by
+        the last retrieval of this feed
+        '''
+        return self._etag, self._last_modified
+
+    def is_not_modified(self):
+        '''
+        Return whether or not the server reported the feed as unchanged
+        since the last retrieval (HTTP 304)
+        '''
+        return self._not_modified
+
+    def set_content_hash(self, content_hash):
+        '''
+        Set the digest of the feed content the last time this feed was
+        entirely processed
+        :param content_hash:
+        '''
+        self._content_hash = content_hash
+
+    def get_content_hash(self):
+        '''
+        Get the digest of the last retrieved feed content
+        '''
+        return self._content_hash
+
+    def is_unchanged(self):
+        '''
+        Return whether or not the feed content is identical to the one
+        entirely processed the last time, though the server sent it again
+        '''
+        return self._unchanged
+
+    def set_high_water_mark(self, mark, identify):
+        '''
+        Set the newest entries entirely processed the last time this feed was
+        read. Parsing stops at the first of them found, the entries listed
+        after it having been processed already.
+        :param mark: (identifier, timestamp) of each entry, newest first
+        :param identify: function returning the identifier of an entry
+        '''
+        self._high_water_mark = list(mark)
+        self._seen = set(identifier for identifier, _ in mark)
+        self._identify = identify
+
+    def get_high_water_mark(self):
+        '''
+        Get the newest entries entirely processed the last time this feed was
+        read, as (identifier, timestamp), newest first
+        '''
+        return list(self._high_water_mark or [])
+
+    def get_high_water_mark_size(self):
+        '''
+        Get the number of entry identifiers to remember as high-water mark
+        (0 to always parse the whole feed)
+        '''
+        return max(0, self._config.get('high_water_mark', 10))
+
+    def is_already_seen(self, entry):
+        '''
+        Has this entry been entirely processed the last time this feed was
+        read, along with all the entries listed after it?
+        :param entry:
+        '''
+        return bool(self._seen) and self._identify(entry) in self._seen
+
     def max_posts_done(self):
         '''
         Return whether or not the specified number of posts (if existing)
@@ -66,12 +228,13 @@ class GenericFeed(CommonConfig):
         return self._config['max_posts'] > 0 and \
                self._posts_done >= self._config['max_posts']
 
-    def retrieve_feed_soup(self, feed_url):
+    def retrieve_feed_content(self, feed_url):
         '''
-        Retrieve and parse the specified feed.
+        Retrieve the specified feed, as text (None if not modified).
         :param feed_url: can either be a URL or a path to a local file
         '''
         feed_content = None
+        self._not_modified = False
         try:
             logging.info("Trying to read %s as a file.", feed_url)
             with open(feed_url, encoding='utf-8') as feed_file:
@@ -79,13 +242,36 @@ class GenericFeed(CommonConfig):
         except FileNotFoundError:
             logging.info("File not found.")
             logging.info("Trying to read %s as a URL.", feed_url)
-            response = requests.get(feed_url, headers={'User-Agent': self._ua})
-
+            headers = {'User-Agent': self._ua}
+            # Conditional GET, if this feed has already been retrieved
+            if self._etag:
+                headers['If-None-Match'] = self._etag
+            if self._last_modified:
+                headers['If-Modified-Since'] = self._last_modified
+            response = get_session().get(feed_url, headers=headers)
+
+            if response.status_code == 304:
+                logging.info("Feed not modified since last retrieval.")
+                self._not_modified = True
+                return None
             if not response.ok:
                 raise Exception(feed_content)
+            self._etag = response.headers.get('ETag')
+            self._last_modified = response.headers.get('Last-Modified')
             feed_content = response.text
         logging.info("Feed read.")
 
+        return feed_content
+
+    def retrieve_feed_soup(self, feed_url):
+        '''
+        Retrieve and parse the specified feed.
+        :param feed_url: can either be a URL or a path to a local file
+        '''
+        feed_content = self.retrieve_feed_content(feed_url)
+        if feed_content is None:
+            return None
+
         return BeautifulSoup(feed_content, 'html.parser')
 
     # pylint: disable=no-self-use
@@ -130,6 +316,34 @@ class GenericFeed(CommonConfig):
         return title_tags, content_tags
     # pylint: enable=no-self-use
 
+    # pylint: disable=no-self-use
+    def absolute_media_url(self, media_url, link):
+        '''
+        Make a media URL absolute, relative to the entry link
+        :param media_url:
+        :param link:
+        '''
+        to_return = media_url
+
+        if to_return and link:
+            tag_pattern = r'^(https?://[^/]+)/'
+            match_result = re.search(tag_pattern, to_return)
+
+            if not match_result:
+                # Not a full URL, need to adjust using link
+                match_result = re.search(tag_pattern, link)
+
+                if match_result:
+                    url_root = match_result.group(1)
+
+                    if to_return.startswith("/"):
+                        to_return = url_root + to_return
+                    else:
+                        to_return = url_root + "/" + to_return
+
+        return to_return
+    # pylint: enable=no-self-use
+
     # Define generator for Atom
     def parse_atom(self, soup):
         '''
@@ -214,23 +428,7 @@ class GenericFeed(CommonConfig):
         elif entry.find('description'):
             to_return = content_img_src(entry.find('description'))
 
-        if to_return and link:
-            tag_pattern = r'^(https?://[^/]+)/'
-            match_result = re.search(tag_pattern, to_return)
-
-            if not match_result:
-                # Not a full URL, need to adjust using link
-                match_result = re.search(tag_pattern, link)
-
-                if match_result:
-                    url_root = match_result.group(1)
-
-                    if to_return.startswith("/"):
-                        to_return = url_root + to_return
-                    else:
-                        to_return = url_root + "/" + to_return
-
-        return to_return
+        return self.absolute_media_url(to_return, link)
     # pylint: enable=no-self-use
 
     # Define generator for RSS
@@ -276,31 +474,214 @@ class GenericFeed(CommonConfig):
             fse.media_url = self.find_rss_image_url(entry, fse.link)
             yield fse
 
-    def feed_generator(self):
+    def _streamed_atom_entry(self, parsed):
         '''
-        Handle RSS/Atom feed
-        Sets up a generator for the feed content
-        :param feed:
+        Build a FeedSporaEntry out of a streamed Atom entry, the same way
+        parse_atom does
+        :param parsed:
         '''
+        fse = FeedSporaEntry()
+
+        # Title
+        fse.title = parsed.text('title')
+        if '<' in fse.title:
+            # Only HTML titles might hold a link
+            title_link = BeautifulSoup(fse.title, 'html.parser').find('a')
+            if title_link:
+                fse.title = title_link.text
+
+        # Link
+        fse.link = parsed.attribute('link', 'href')
+
+        # Content
+        if parsed.has('content'):
+            fse.content = parsed.text('content').strip()
+        # If no content, attempt to use summary
+
+        if not fse.content and parsed.has('summary'):
+            fse.content = parsed.text('summary').strip()
+
+        # Tags
+        fse.tags = dict()
+        # Tags from title and content, each in their own list
+        fse.tags['title'], fse.tags['content'] = self.get_tag_lists(
+            fse.title, fse.content)
+
+        # Add tags from category
+        fse.tags['category'] = []
+        for term in parsed.category_attributes('term'):
+            new_tag = term.replace(' ', '_').strip()
+            if new_tag not in fse.tags['category']:
+                fse.tags['category'].append(new_tag)
+
+        # Published_date implementation for Atom
+        if parsed.has('updated'):
+            fse.published_date = parsed.text('updated')
+        elif parsed.has('published'):
+            fse.published_date = parsed.text('published')
+        return fse
+
+    def _streamed_rss_entry(self, parsed):
+        '''
+        Build a FeedSporaEntry out of a streamed RSS item, the same way
+        parse_rss does
+        :param parsed:
+        '''
+        if parsed.has('content'):
+            # Not handled by parse_rss either
+            raise UnsupportedFeed("content in item")
+        fse = FeedSporaEntry()
+
+        fse.title = parsed.text('title')
+        fse.link = parsed.text('link')
+        fse.content = parsed.text('description').strip()
+        fse.published_date = parsed.text('pubdate')
+
+        fse.tags = dict()
+        # Tags from title and content, each in their own list
+        fse.tags['title'], fse.tags['content'] = self.get_tag_lists(
+            fse.title, fse.content)
+
+        # Add tags from category
+        fse.tags['category'] = []
+        for text in parsed.category_texts():
+            new_tag = text.replace(' ', '_').strip()
+
+            if new_tag not in fse.tags['category']:
+                fse.tags['category'].append(new_tag)
+
+        # And for our final act, media
+        media_url = None
+        if parsed.has('media:content') and \
+           parsed.attribute('media:content', 'medium') == 'image':
+            media_url = parsed.attribute('media:content', 'url')
+        elif parsed.has_children('description'):
+            raise UnsupportedFeed("markup in description")
+        else:
+            img_tag = re.search(r'<img [^>]*src=["\']([^"\']+)["\']',
+                                parsed.text('description'))
+            if img_tag:
+                media_url = img_tag.group(1)
+        fse.media_url = self.absolute_media_url(media_url, fse.link)
+        return fse
+
+    def parse_streamed(self, feed_content):
+        '''
+        Parse an RSS/Atom feed with the streaming parser, and return its
+        FeedSpora entries newer than the high-water mark, in publishing order
+        (None if the feed has no entry at all). Parsing stops at the
+        high-water mark.
+        Raises UnsupportedFeed or XMLSyntaxError if the feed should be
+        parsed with BeautifulSoup instead.
+        :param feed_content:
+        '''
+        atom_entries = []
+        rss_entries = []
+        stopped_at = None
+        for parsed in iterparse_entries(feed_content):
+            if parsed.kind == 'entry':
+                entries = atom_entries
+                fse = self._streamed_atom_entry(parsed)
+            elif atom_entries:
+                # Items are ignored as soon as there's an Atom entry
+                continue
+            else:
+                entries = rss_entries
+                fse = self._streamed_rss_entry(parsed)
+            if self.is_already_seen(fse):
+                # Older entries have been processed already
+                stopped_at = entries
+                break
+            entries.append(fse)
+
+        if stopped_at is not None:
+            logging.info("%d new entries in %s", len(stopped_at),
+                         self.get_path())
+            return stopped_at[::-1]
+        return (atom_entries or rss_entries)[::-1] or None
+
+    def unseen_entries(self, entries):
+        '''
+        Return the entries, in publishing order, that are newer than the
+        newest one already seen
+        :param entries:
+        '''
+        for index in range(len(entries) - 1, -1, -1):
+            if self.is_already_seen(entries[index]):
+                logging.info("%d new entries in %s",
+                             len(entries) - index - 1, self.get_path())
+                return entries[index + 1:]
+        return entries
+
+    def parse_entries(self, feed_content):
+        '''
+        Parse an RSS/Atom feed with the configured parser, and return its
+        FeedSpora entries newer than the high-water mark, in publishing order
+        (None if the feed has no entry at all).
+        :param feed_content:
+        '''
+        if self._config.get('parser', 'lxml') == 'lxml':
+            try:
+                to_return = self.parse_streamed(feed_content)
+                if to_return is not None:
+                    return to_return
+            except (etree.XMLSyntaxError, UnsupportedFeed) as error:
+                logging.info("Streaming parser unsuitable for %s (%s), "
+                             "using html.parser", self.get_path(),
+                             format(error))
+
         to_return = None
-        # get feed content
+        soup = BeautifulSoup(feed_content, 'html.parser')
+        # Choose which generator to use, or abort.
+        if soup.find('entry'):
+            to_return = self.unseen_entries(list(self.parse_atom(soup)))
+        elif soup.find('item'):
+            to_return = self.unseen_entries(list(self.parse_rss(soup)))
+        else:
+            print("No entry/item found in %s" % self.get_path())
+        return to_return
+
+    def fetch(self):
+        '''
+        Retrieve and parse the feed content, keeping the result for the next
+        call to feed_generator. Safe to call from a worker thread.
+        '''
         feed_url = self.get_path()
+        self._entries = None
+        self._unchanged = False
         try:
-            soup = self.retrieve_feed_soup(feed_url)
-        except (requests.exceptions.ConnectionError, ValueError,
-                OSError) as error:
+            feed_content = self.retrieve_feed_content(feed_url)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout, ValueError, OSError) as error:
             logging.error(
                 "Error while reading feed at %s: %s",
                 feed_url,
                 format(error),
                 exc_info=True)
-            return to_return
+            feed_content = None
+        if feed_content is not None:
+            content_hash = hashlib.blake2b(feed_content.encode('utf-8'),
+                                           digest_size=16).hexdigest()
+            if content_hash == self._content_hash:
+                logging.info("Feed content unchanged: %s", feed_url)
+                self._unchanged = True
+            else:
+                self._content_hash = content_hash
+                self._entries = self.parse_entries(feed_content)
+        self._fetched = True
 
-        # Choose which generator to use, or abort.
-        if soup.find('entry'):
-            to_return = self.parse_atom(soup)
-        elif soup.find('item'):
-            to_return = self.parse_rss(soup)
-        else:
-            print("No entry/item found in %s" % feed_url)
-        return to_return
+    def feed_generator(self):
+        '''
+        Handle RSS/Atom feed
+        Sets up a generator for the feed content, retrieving it first if
+        it hasn't been fetched already
+        :param feed:
+        '''
+        if not self._fetched:
+            self.fetch()
+        # The fetched content is only used once
+        entries = self._entries
+        self._entries = None
+        self._fetched = False
+
+        return iter(entries) if entries is not None else None
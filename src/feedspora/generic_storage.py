@@ -0,0 +1,250 @@
+"""
+GenericStorage: base class of the storages of the published entries and of
+the feed states.
+"""
+
+import hashlib
+import logging
+
+
+def entry_digest(identifier):
+    '''
+    Fixed-size (16 bytes) digest of an entry identifier, under which it's
+    stored
+    :param identifier:
+    '''
+    return hashlib.blake2b((identifier or '').encode('utf-8'),
+                           digest_size=16).digest()
+
+
+class GenericStorage:
+    '''
+    Implements the interface expected from storages. Published entries are
+    identified by their FeedSpora identifier and the name of the client
+    they were published to, and stored under the digest of the former.
+    Feed states are recorded per feed path, along with the set of clients
+    they were recorded with.
+    '''
+
+    def __init__(self, db_file):
+        '''
+        Initialize
+        :param db_file: path of the FeedSpora database
+        '''
+        self._db_file = db_file
+        self._debug_identifiers = False
+        self._client_names = []
+
+    def set_debug_identifiers(self, debug_identifiers):
+        '''
+        Also store the identifiers of published entries, not only their
+        digests, for debugging purposes
+        :param debug_identifiers:
+        '''
+        self._debug_identifiers = debug_identifiers
+
+    def set_bloom_filters(self, use_bloom_filters):
+        '''
+        Look up published entries through Bloom filters, if supported
+        :param use_bloom_filters:
+        '''
+        if use_bloom_filters:
+            logging.warning("Bloom filters aren't supported by %s",
+                            self.__class__.__name__)
+
+    def open(self, client_names, load_published=True):
+        '''
+        Open the storage
+        :param client_names: names of the connected clients
+        :param load_published: prepare the lookup of published entries
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def close(self):
+        '''
+        Make everything stored durable and close the storage
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def is_published(self, identifier, client_name):
+        '''
+        Has the entry been published to the client?
+        :param identifier:
+        :param client_name:
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def add_published(self, identifier, client_name, feed_path=None,
+                      posted=True):
+        '''
+        Record an entry as published to the client, turning its claim if
+        any into a publication. Entries actually posted must be durable once
+        this returns, so that they can't be posted again; seeded ones may be
+        made durable later.
+        :param identifier:
+        :param client_name:
+        :param feed_path: path of the feed the entry comes from
+        :param posted: was the entry posted, rather than seeded?
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def claim(self, identifier, client_name, feed_path=None):
+        '''
+        Claim an unpublished entry before publishing it to the client, so
+        that concurrent runs don't publish it too. Returns False if it has
+        been published or claimed by another run meanwhile. Storages that
+        can't be shared between runs only check that it isn't published.
+        :param identifier:
+        :param client_name:
+        :param feed_path: path of the feed the entry comes from
+        '''
+        return not self.is_published(identifier, client_name)
+
+    def release(self, identifier, client_name):
+        '''
+        Release the claim on an entry that hasn't been published after all
+        :param identifier:
+        :param client_name:
+        '''
+
+    def enqueue(self, identifier, client_name, payload, feed_path=None):
+        '''
+        Queue an entry rendered for the client in the outbox, durably, until
+        it's delivered, and record it as published to the client like
+        add_published, in a single transaction. Only one payload is queued
+        per entry and client.
+        :param identifier:
+        :param client_name:
+        :param payload: JSON-serializable rendering of the entry
+        :param feed_path: path of the feed the entry comes from
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def due_deliveries(self, client_names):
+        '''
+        Return the deliveries due to the clients, in the order they were
+        queued, as (delivery id, client name, payload, attempts) tuples.
+        They are held until removed or postponed, so that concurrent runs
+        don't deliver them too.
+        :param client_names:
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def remove_delivery(self, delivery_id):
+        '''
+        Remove a delivery from the outbox, once delivered
+        :param delivery_id:
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def fail_delivery(self, delivery_id):
+        '''
+        Give up a delivery, counting a failed attempt: it's kept in the
+        outbox, no longer due, so that it can be retried
+        :param delivery_id:
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def count_failed_deliveries(self, client_names):
+        '''
+        Return the number of deliveries to the clients given up
+        :param client_names:
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def retry_failed_deliveries(self, client_names):
+        '''
+        Make the deliveries to the clients given up due again, with no
+        attempt counted, and return their number
+        :param client_names:
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def postpone_delivery(self, delivery_id, delay, failed=True):
+        '''
+        Make a delivery due again later, counting a failed attempt
+        :param delivery_id:
+        :param delay: seconds before the next attempt
+        :param failed: was it attempted, rather than deferred?
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def load_client_state(self, client_name):
+        '''
+        Return the state of a client recorded by an earlier run, as a dict,
+        or None if there's none
+        :param client_name:
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def save_client_state(self, client_name, state):
+        '''
+        Record the state of a client, such as its rate limiter
+        :param client_name:
+        :param state: JSON-serializable dict
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def load_short_url(self, url, shortener):
+        '''
+        Return the short URL recorded for the URL and URL shortener, empty
+        if shortening failed, along with when it was recorded (POSIX
+        timestamp), or None if there's none
+        :param url:
+        :param shortener: digest of the URL shortener configuration
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def save_short_url(self, url, shortener, short_url, stored_at):
+        '''
+        Record the short URL of the URL, empty if shortening failed
+        :param url:
+        :param shortener: digest of the URL shortener configuration
+        :param short_url:
+        :param stored_at: POSIX timestamp
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def load_feed_state(self, path, clients):
+        '''
+        Return the state of a feed recorded with the same clients, as a dict
+        with etag, last_modified, content_hash and seen (high-water mark)
+        keys, or None if there's none
+        :param path:
+        :param clients: signature of the connected clients
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def save_feed_state(self, path, clients, seen, validators=None):
+        '''
+        Record the state of a processed feed, making the entries seeded so
+        far durable
+        :param path:
+        :param clients: signature of the connected clients
+        :param seen: high-water mark of the feed
+        :param validators: (etag, last_modified, content_hash) of an
+                           entirely processed feed, None to keep the ones
+                           previously recorded
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def compact(self, current_identifiers, retention_days, feed_paths,
+                clients, prune=True):
+        '''
+        Record which published entries are still in the feeds, then delete
+        those of the connected clients that haven't been seen in any feed
+        for retention_days, and the state of unconfigured feeds recorded
+        with the same clients. Stored identifiers are dropped unless they're
+        kept for debugging.
+        :param current_identifiers: identifiers of all the feed entries
+        :param retention_days:
+        :param feed_paths: paths of all configured feeds
+        :param clients: set of clients the feed states were recorded with
+        :param prune: delete entries, or only record the current ones
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def log_summary(self):
+        '''
+        Log statistics about the storage at the end of a run
+        '''
@@ -0,0 +1,128 @@
+"""
+HTTP layer shared by feeds and clients: one process-wide requests session,
+keeping connections alive in per-host pools, with a global default timeout.
+"""
+
+import json
+import threading
+
+import pyshorteners
+import requests
+from requests.adapters import HTTPAdapter
+
+_settings = {'timeout': 30,
+             'pool_connections': 16,
+             'pool_maxsize': 16,
+            }
+_session = None
+_shorteners = dict()
+_lock = threading.Lock()
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    ''' HTTPAdapter applying a default timeout to every request '''
+
+    def __init__(self, timeout, **kwargs):
+        '''
+        Initialize
+        :param timeout:
+        :param kwargs:
+        '''
+        self._timeout = timeout
+        super().__init__(**kwargs)
+
+    # pylint: disable=arguments-differ
+    def send(self, request, **kwargs):
+        '''
+        Send the request, with the default timeout if none was specified
+        :param request:
+        :param kwargs:
+        '''
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self._timeout
+        return super().send(request, **kwargs)
+    # pylint: enable=arguments-differ
+
+
+def configure(timeout=None, pool_maxsize=None):
+    '''
+    Change the settings of the shared session; only effective if called
+    before its first use
+    :param timeout: default timeout of every request, in seconds
+    :param pool_maxsize: number of connections kept alive per host
+    '''
+    if timeout is not None:
+        _settings['timeout'] = timeout
+    if pool_maxsize is not None:
+        _settings['pool_maxsize'] = pool_maxsize
+
+
+def get_session():
+    '''
+    Return the shared session, creating it on first use
+    '''
+    global _session  # pylint: disable=global-statement
+    with _lock:
+        if _session is None:
+            adapter = TimeoutHTTPAdapter(
+                _settings['timeout'],
+                pool_connections=_settings['pool_connections'],
+                pool_maxsize=_settings['pool_maxsize'])
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+    return _session
+
+
+def available_shorteners():
+    '''
+    Return the names of the URL shorteners provided by pyshorteners
+    '''
+    # pylint: disable=no-member
+    return pyshorteners.Shortener().available_shorteners
+    # pylint: enable=no-member
+
+
+def get_shortener(name, options):
+    '''
+    Return the pyshorteners implementation of the named URL shortener,
+    configured with options, and issuing its requests through the shared
+    session. Implementations are built once per name and options.
+    :param name:
+    :param options:
+    '''
+    key = (name, json.dumps(options, sort_keys=True, default=str))
+    with _lock:
+        if key not in _shorteners:
+            shortener = getattr(pyshorteners.Shortener(**options), name)
+
+            def pooled_request(method, url, **kwargs):
+                '''
+                Request on behalf of the shortener, as pyshorteners would
+                '''
+                return get_session().request(
+                    method, shortener.clean_url(url),
+                    timeout=shortener.timeout, verify=shortener.verify,
+                    proxies=shortener.proxies, **kwargs)
+
+            def pooled_get(url, params=None, headers=None):
+                '''
+                Replacement for BaseShortener._get
+                '''
+                return pooled_request('GET', url, params=params,
+                                      headers=headers)
+
+            def pooled_post(url, data=None, **kwargs):
+                '''
+                Replacement for BaseShortener._post
+                '''
+                return pooled_request('POST', url, data=data, **kwargs)
+
+            # pyshorteners has no public way to pass a session: its private
+            # request methods are replaced, so its version is pinned
+            # pylint: disable=protected-access
+            shortener._get = pooled_get
+            shortener._post = pooled_post
+            # pylint: enable=protected-access
+            _shorteners[key] = shortener
+    return _shorteners[key]
@@ -0,0 +1,410 @@
+"""
+Key-value storages of the published entries and of the feed states: in a
+dbm file, or in memory only.
+"""
+
+import dbm
+import json
+import logging
+import os
+import time
+
+from feedspora.generic_storage import GenericStorage, entry_digest
+
+
+def utc_now(offset_days=0):
+    '''
+    Current UTC time, in SQLite's datetime format
+    :param offset_days:
+    '''
+    return time.strftime('%Y-%m-%d %H:%M:%S',
+                         time.gmtime(time.time() + offset_days * 86400))
+
+
+class KeyValueStorage(GenericStorage):
+    '''
+    Storage in a mapping of byte strings. A published entry is stored under
+    "p", its client name and the digest of its identifier, with its
+    publication time, the last time it was seen in a feed, its feed path
+    and its identifier (only kept for debugging purposes). A feed state is
+    stored under "f" and its path, a client state under "c" and its name,
+    a short URL under "s", the digest of its URL shortener configuration
+    and the digest of the original URL, and the outbox under "outbox", all
+    as JSON. Deliveries given up are kept in the outbox with no next
+    attempt.
+    '''
+    _separator = '\0'
+    # Version of the layout, stored under "version"
+    _version = b'2'
+
+    def __init__(self, db_file):
+        '''
+        Initialize
+        :param db_file:
+        '''
+        super().__init__(db_file)
+        self._db = None
+
+    def _open_mapping(self):
+        '''
+        Return the mapping the storage is backed by
+        '''
+        raise NotImplementedError("Please implement!")
+
+    def _sync(self):
+        '''
+        Make the mapping durable
+        '''
+
+    def open(self, client_names, load_published=True):
+        '''
+        Open the storage
+        :param client_names:
+        :param load_published:
+        '''
+        self._client_names = list(client_names)
+        self._db = self._open_mapping()
+        if self._db.get(b'version') != self._version:
+            self._upgrade()
+
+    def _upgrade(self):
+        '''
+        Store published entries under the digest of their identifier, rather
+        than the identifier itself
+        '''
+        for key in list(self._db.keys()):
+            fields = key.split(b'\0', 2)
+            if fields[0] == b'p':
+                value = self._db[key]
+                del self._db[key]
+                identifier = fields[2].decode('utf-8')
+                self._db[self._published_key(fields[1].decode('utf-8'),
+                                             identifier)] = \
+                    value + (self._separator + identifier).encode('utf-8')
+        self._db[b'version'] = self._version
+        self._sync()
+
+    def close(self):
+        '''
+        Make everything stored durable and close the storage
+        '''
+        if self._db is not None:
+            self._sync()
+            if hasattr(self._db, 'close'):
+                self._db.close()
+            self._db = None
+
+    def _key(self, *fields):
+        '''
+        Key or value of a record
+        :param fields:
+        '''
+        return self._separator.join(fields).encode('utf-8')
+
+    def _published_key(self, client_name, identifier):
+        '''
+        Key of a published entry
+        :param client_name:
+        :param identifier:
+        '''
+        return self._key('p', client_name, '') + entry_digest(identifier)
+
+    def is_published(self, identifier, client_name):
+        '''
+        Has the entry been published to the client?
+        :param identifier:
+        :param client_name:
+        '''
+        return self._published_key(client_name, identifier) in self._db
+
+    def add_published(self, identifier, client_name, feed_path=None,
+                      posted=True):
+        '''
+        Record an entry as published to the client
+        :param identifier:
+        :param client_name:
+        :param feed_path:
+        :param posted:
+        '''
+        key = self._published_key(client_name, identifier)
+        if key in self._db:
+            return
+        now = utc_now()
+        self._db[key] = self._key(
+            now, now, feed_path or '',
+            identifier if self._debug_identifiers else '')
+        if posted:
+            self._sync()
+
+    def _load_outbox(self):
+        '''
+        Return the outbox, as a dict of deliveries in the order they were
+        queued
+        '''
+        if b'outbox' not in self._db:
+            return dict()
+        return json.loads(self._db[b'outbox'].decode('utf-8'))
+
+    def _save_outbox(self, outbox):
+        '''
+        Store the outbox durably
+        :param outbox:
+        '''
+        self._db[b'outbox'] = json.dumps(outbox).encode('utf-8')
+        self._sync()
+
+    def enqueue(self, identifier, client_name, payload, feed_path=None):
+        '''
+        Queue an entry rendered for the client in the outbox, then record it
+        as published: a run interrupted in between leaves the entry to be
+        rendered again, and queued under the same delivery id
+        :param identifier:
+        :param client_name:
+        :param payload:
+        :param feed_path:
+        '''
+        outbox = self._load_outbox()
+        delivery_id = '%s:%s' % (client_name, entry_digest(identifier).hex())
+        if delivery_id not in outbox:
+            outbox[delivery_id] = {'client': client_name,
+                                   'payload': payload,
+                                   'attempts': 0,
+                                   'next_attempt': utc_now()}
+            self._save_outbox(outbox)
+        self.add_published(identifier, client_name, feed_path)
+
+    def due_deliveries(self, client_names):
+        '''
+        Return the deliveries due to the clients
+        :param client_names:
+        '''
+        now = utc_now()
+        return [(delivery_id, delivery['client'], delivery['payload'],
+                 delivery['attempts'])
+                for delivery_id, delivery in self._load_outbox().items()
+                if delivery['client'] in client_names and
+                delivery['next_attempt'] is not None and
+                delivery['next_attempt'] <= now]
+
+    def remove_delivery(self, delivery_id):
+        '''
+        Remove a delivery from the outbox
+        :param delivery_id:
+        '''
+        outbox = self._load_outbox()
+        outbox.pop(delivery_id, None)
+        self._save_outbox(outbox)
+
+    def fail_delivery(self, delivery_id):
+        '''
+        Keep a delivery given up in the outbox, with no next attempt
+        :param delivery_id:
+        '''
+        outbox = self._load_outbox()
+        outbox[delivery_id]['attempts'] += 1
+        outbox[delivery_id]['next_attempt'] = None
+        self._save_outbox(outbox)
+
+    def count_failed_deliveries(self, client_names):
+        '''
+        Return the number of deliveries to the clients given up
+        :param client_names:
+        '''
+        return sum(1 for delivery in self._load_outbox().values()
+                   if delivery['client'] in client_names and
+                   delivery['next_attempt'] is None)
+
+    def retry_failed_deliveries(self, client_names):
+        '''
+        Make the deliveries to the clients given up due again
+        :param client_names:
+        '''
+        outbox = self._load_outbox()
+        retried = 0
+        for delivery in outbox.values():
+            if delivery['client'] in client_names and \
+               delivery['next_attempt'] is None:
+                delivery['attempts'] = 0
+                delivery['next_attempt'] = utc_now()
+                retried += 1
+        if retried:
+            self._save_outbox(outbox)
+        return retried
+
+    def postpone_delivery(self, delivery_id, delay, failed=True):
+        '''
+        Make a delivery due again later, counting a failed attempt
+        :param delivery_id:
+        :param delay:
+        :param failed:
+        '''
+        outbox = self._load_outbox()
+        if failed:
+            outbox[delivery_id]['attempts'] += 1
+        outbox[delivery_id]['next_attempt'] = utc_now(delay / 86400.0)
+        self._save_outbox(outbox)
+
+    def load_client_state(self, client_name):
+        '''
+        Return the state of a client recorded by an earlier run
+        :param client_name:
+        '''
+        key = self._key('c', client_name)
+        if key not in self._db:
+            return None
+        return json.loads(self._db[key].decode('utf-8'))
+
+    def save_client_state(self, client_name, state):
+        '''
+        Record the state of a client
+        :param client_name:
+        :param state:
+        '''
+        self._db[self._key('c', client_name)] = \
+            json.dumps(state).encode('utf-8')
+        self._sync()
+
+    def _short_url_key(self, url, shortener):
+        '''
+        Key of a short URL
+        :param url:
+        :param shortener:
+        '''
+        return self._key('s', shortener, '') + entry_digest(url)
+
+    def load_short_url(self, url, shortener):
+        '''
+        Return the short URL recorded for the URL and URL shortener
+        :param url:
+        :param shortener:
+        '''
+        key = self._short_url_key(url, shortener)
+        if key not in self._db:
+            return None
+        return tuple(json.loads(self._db[key].decode('utf-8')))
+
+    def save_short_url(self, url, shortener, short_url, stored_at):
+        '''
+        Record the short URL of the URL
+        :param url:
+        :param shortener:
+        :param short_url:
+        :param stored_at:
+        '''
+        self._db[self._short_url_key(url, shortener)] = \
+            json.dumps([short_url, stored_at]).encode('utf-8')
+
+    def load_feed_state(self, path, clients):
+        '''
+        Return the state of a feed recorded with the same clients
+        :param path:
+        :param clients:
+        '''
+        key = self._key('f', path)
+        if key not in self._db:
+            return None
+        state = json.loads(self._db[key].decode('utf-8'))
+        if state.pop('clients') != clients:
+            return None
+        return state
+
+    def save_feed_state(self, path, clients, seen, validators=None):
+        '''
+        Record the state of a processed feed
+        :param path:
+        :param clients:
+        :param seen:
+        :param validators:
+        '''
+        state = None
+        if validators is None:
+            # Keep the validators of the last complete processing
+            state = self.load_feed_state(path, clients)
+        if state is None:
+            state = dict(zip(['etag', 'last_modified', 'content_hash'],
+                             validators or (None, None, None)))
+        state.update({'clients': clients, 'seen': seen})
+        self._db[self._key('f', path)] = json.dumps(state).encode('utf-8')
+        self._sync()
+
+    def compact(self, current_identifiers, retention_days, feed_paths,
+                clients, prune=True):
+        '''
+        Delete old published entries and unconfigured feed states
+        :param current_identifiers:
+        :param retention_days:
+        :param feed_paths:
+        :param clients:
+        :param prune:
+        '''
+        now = utc_now()
+        horizon = utc_now(-retention_days)
+        current_digests = set(entry_digest(identifier)
+                              for identifier in current_identifiers)
+        client_names = set(name.encode('utf-8')
+                           for name in self._client_names)
+        deleted = 0
+        for key in list(self._db.keys()):
+            fields = key.split(b'\0', 2)
+            if fields[0] == b'p':
+                value = self._db[key]
+                published_at, last_seen, feed_path, identifier = \
+                    value.decode('utf-8').split(self._separator)
+                if not self._debug_identifiers:
+                    identifier = ''
+                if fields[2] in current_digests:
+                    last_seen = now
+                elif prune and last_seen < horizon and \
+                        fields[1] in client_names:
+                    del self._db[key]
+                    deleted += 1
+                    continue
+                new_value = self._key(published_at, last_seen, feed_path,
+                                      identifier)
+                if new_value != value:
+                    self._db[key] = new_value
+            elif fields[0] == b'f' and prune:
+                path = key[2:].decode('utf-8')
+                if path not in feed_paths and \
+                        self.load_feed_state(path, clients) is not None:
+                    del self._db[key]
+        if prune:
+            logging.info("Deleted %d published entries not seen for %d "
+                         "days", deleted, retention_days)
+        if hasattr(self._db, 'reorganize'):
+            self._db.reorganize()
+        self._sync()
+
+
+class DbmStorage(KeyValueStorage):
+    '''
+    Storage in a dbm file, next to where the SQLite database would be
+    '''
+
+    def _open_mapping(self):
+        '''
+        Open the dbm file
+        '''
+        path = os.path.splitext(self._db_file)[0] + '.dbm'
+        logging.info("Opening dbm file %s (%s)", path, dbm.whichdb(path) or
+                     "new")
+        return dbm.open(path, 'c')
+
+    def _sync(self):
+        '''
+        Write the dbm file to disk
+        '''
+        if hasattr(self._db, 'sync'):
+            self._db.sync()
+
+
+class MemoryStorage(KeyValueStorage):
+    '''
+    Storage in memory only, lost when the run ends: for testing
+    '''
+
+    def _open_mapping(self):
+        '''
+        Return an empty mapping
+        '''
+        return dict()
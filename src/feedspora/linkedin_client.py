@@ -42,14 +42,13 @@ class LinkedInClient(GenericClient):
             "visibility": self._visibility
         }
 
-    def post(self, feed, entry):
+    def render(self, feed, entry):
         '''
-        Post entry to LinkedIn
+        Render entry for LinkedIn
         :param feed:
         :param entry:
         '''
-        stripped_html = self.strip_html(feed, entry.content) \
-                        if entry.content else None
+        stripped_html = self.strip_entry_content(feed, entry)
         raw_contents = entry.title
         if self.resolve_option(feed, 'post_include_content') and stripped_html:
             raw_contents += ': '+stripped_html
@@ -63,19 +62,26 @@ class LinkedInClient(GenericClient):
         post_args = {'comment': comment,
                      'title': self._trim_string(entry.title, 200),
                      'description': self._trim_string(entry.title, 256),
-                     'submitted_url': self.shorten_url(feed, entry.link),
+                     'submitted_url': self.shorten_entry_link(feed, entry),
                      'submitted_image_url': None,
                      'visibility_code': self._visibility
                      }
         if self.resolve_option(feed, 'post_include_media') and entry.media_url:
             post_args['submitted_image_url'] = entry.media_url
 
+        return post_args
+
+    def deliver(self, payload):
+        '''
+        Post rendered entry to LinkedIn
+        :param payload:
+        '''
         to_return = False
         if self.is_testing():
             self.accumulate_testing_output(
-                self.get_dict_output(**post_args))
+                self.get_dict_output(**payload))
         else:
-            to_return = self._linkedin.submit_share(**post_args)
+            to_return = self._linkedin.submit_share(**payload)
             if 'updateUrl' not in to_return:
                 # Failure - pass it on
                 to_return = {}
@@ -3,7 +3,6 @@ Mastodon client
 """
 
 import logging
-import time
 
 from mastodon import Mastodon
 from mastodon.Mastodon import MastodonIllegalArgumentError, MastodonAPIError
@@ -14,7 +13,6 @@ from feedspora.generic_client import GenericClient
 class MastodonClient(GenericClient):
     ''' The MastodonClient handles the connection to Mastodon. '''
     _mastodon = None
-    _invoke_delay = False
 
     def __init__(self, config, testing):
         '''
@@ -36,6 +34,10 @@ class MastodonClient(GenericClient):
                 access_token=access_token,
                 api_base_url=api_base_url)
         self._delay = 0 if 'delay' not in config else config['delay']
+        if self._delay > 0 and 'rate_limit' not in config:
+            # One post per delay, every new entry being posted during the run
+            config['rate_limit'] = 3600.0 / self._delay
+            config.setdefault('rate_wait', True)
         self._visibility = 'unlisted' if 'visibility' not in config or \
             config['visibility'] not in ['public', 'unlisted', 'private'] \
             else config['visibility']
@@ -55,13 +57,13 @@ class MastodonClient(GenericClient):
             "media": kwargs['media_path']
         }
 
-    def post(self, feed, entry):
+    def render(self, feed, entry):
         '''
-        Post entry to Mastodon
+        Render entry for Mastodon
         :param feed:
         :param entry:
         '''
-        use_link = self.shorten_url(feed, entry.link)
+        use_link = self.shorten_entry_link(feed, entry)
         maxlen = 500 - len(use_link) - \
                  len(self.resolve_option(feed, 'post_prefix')) - \
                  len(self.resolve_option(feed, 'post_suffix')) - 1
@@ -69,8 +71,7 @@ class MastodonClient(GenericClient):
 
         # Process contents (title and perhaps stripped item entry contents)
         raw_contents = entry.title
-        stripped_html = self.strip_html(feed, entry.content) \
-                        if entry.content else None
+        stripped_html = self.strip_entry_content(feed, entry)
         if self.resolve_option(feed, 'post_include_content') and stripped_html:
             raw_contents += ": " + stripped_html
         text += self._mkrichtext(raw_contents, self.filter_tags(feed, entry),
@@ -84,9 +85,22 @@ class MastodonClient(GenericClient):
 
         # Add media if appropriate
         media_path = None
+        media_url = None
         if self.resolve_option(feed, 'post_include_media') and entry.media_url:
             # Need to download image from that URL in order to post it!
             media_path = self.download_media(entry.media_url)
+            media_url = entry.media_url
+
+        return {'text': text, 'media_path': media_path,
+                'media_url': media_url}
+
+    def deliver(self, payload):
+        '''
+        Post rendered entry to Mastodon
+        :param payload:
+        '''
+        text = payload['text']
+        media_path = payload['media_path']
 
         to_return = False
         if self.is_testing():
@@ -94,12 +108,9 @@ class MastodonClient(GenericClient):
                 self.get_dict_output(text=text,
                                      media_path=media_path))
         else:
-            if self._delay > 0 and self._invoke_delay:
-                logging.info("Delaying post for %d seconds...", self._delay)
-                time.sleep(self._delay)
-
             # Post media first (if appropriate)
             media_id = 0
+            media_path = self.refresh_media(media_path, payload['media_url'])
             if media_path:
                 try:
                     media_result = self._mastodon.media_post(media_path)
@@ -115,8 +126,4 @@ class MastodonClient(GenericClient):
                 text, media_ids=([media_id] if media_id else None),
                 visibility=self._visibility)
 
-        if to_return and 'id' in to_return:
-            # Enable the posting delay for the next post attempt
-            self._invoke_delay = True
-
         return to_return
@@ -0,0 +1,300 @@
+"""
+MediaCache: on-disk cache of the media downloaded for the clients, shared by
+all of them and kept across runs.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import re
+import threading
+import time
+import urllib.parse
+
+from feedspora import http_session
+
+_settings = {'max_size': 100 * 1024 * 1024,
+             'max_media_size': 20 * 1024 * 1024}
+_cache = None
+_lock = threading.Lock()
+
+
+def is_valid_filename(filename):
+    '''
+    Is the filename a plain image file name, safe to store media under?
+    :param filename:
+    '''
+    return re.match(r'^[\w-]+\.(jpg|jpeg|gif|png)$', filename,
+                    re.IGNORECASE) is not None
+
+
+def get_filename_from_cd(content_disp):
+    '''
+    Get filename from Content-Disposition, None if it has none or an invalid
+    one
+    :param content_disp:
+    '''
+
+    to_return = None
+
+    if content_disp:
+        fname = re.findall('filename=([^;]+)', content_disp)
+
+        if fname:
+            to_return = os.path.basename(fname[0].strip().strip('"\''))
+            if not is_valid_filename(to_return):
+                logging.error("Invalid media filename '%s' - ignoring",
+                              fname[0])
+                to_return = None
+
+    return to_return
+
+
+def get_filename_from_response(the_response):
+    '''
+    Attempt to get the filename from the response
+    :param the_response:
+    '''
+
+    url_parts = urllib.parse.urlparse(the_response.url)
+    to_return = posixpath.basename(url_parts.path)
+    # Sanity check
+    if not is_valid_filename(to_return):
+        # Nope, "bad" filename
+        logging.error("Invalid media filename '%s' - ignoring",
+                      to_return)
+        to_return = ''
+
+    return to_return
+
+
+def file_digest(path):
+    '''
+    Return the SHA-256 digest of the content of a file, None if it's gone
+    :param path:
+    '''
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as media_file:
+            for chunk in iter(lambda: media_file.read(65536), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+class MediaCache:
+    '''
+    Media are stored in a directory named after the digest of their URL, so
+    that unrelated media with the same file name don't overwrite each other.
+    An index records, per URL, the path of the media, its HTTP cache
+    validators, the digest of its content and when it was last used. A
+    media is downloaded at most once per run, whatever the number of clients
+    posting it, and only revalidated in later runs. The least recently used
+    media are evicted once the cache exceeds its maximum size. Media are
+    streamed to disk, and larger ones than the maximum media size are
+    ignored.
+    '''
+    _index_name = 'feedspora_media.json'
+
+    def __init__(self, media_dir, max_size, max_media_size=None):
+        '''
+        Initialize
+        :param media_dir: directory of the cache
+        :param max_size: maximum size of the cached media, in bytes
+        :param max_media_size: maximum size of a media, in bytes
+        '''
+        self._media_dir = media_dir
+        self._max_size = max_size
+        self._max_media_size = max_media_size
+        self._index = None
+        # URLs downloaded or revalidated during this run
+        self._fresh = set()
+        self._lock = threading.Lock()
+        self._url_locks = dict()
+
+    def _index_path(self):
+        '''
+        Path of the index
+        '''
+        return os.path.join(self._media_dir, self._index_name)
+
+    def _load_index(self):
+        '''
+        Return the index, reading it on first use
+        '''
+        if self._index is None:
+            try:
+                with open(self._index_path()) as index_file:
+                    self._index = json.load(index_file)
+            except (OSError, ValueError):
+                self._index = dict()
+        return self._index
+
+    def _save_index(self):
+        '''
+        Write the index, atomically
+        '''
+        temp_path = '%s.%d' % (self._index_path(), os.getpid())
+        with open(temp_path, 'w') as index_file:
+            json.dump(self._index, index_file)
+        os.replace(temp_path, self._index_path())
+
+    def _url_lock(self, url):
+        '''
+        Return the lock serializing the downloads of a URL
+        :param url:
+        '''
+        with self._lock:
+            return self._url_locks.setdefault(url, threading.Lock())
+
+    def get(self, url):
+        '''
+        Return the path of the media at the URL, downloading it if it isn't
+        cached or has changed, or None if it's too large
+        :param url:
+        '''
+        with self._url_lock(url):
+            with self._lock:
+                record = self._load_index().get(url)
+            intact = record is not None and \
+                file_digest(record['path']) == record['digest']
+            if not (intact and url in self._fresh):
+                record = self._fetch(url, record if intact else None)
+            if record is None:
+                return None
+            record['used'] = time.time()
+            with self._lock:
+                self._fresh.add(url)
+                self._index[url] = record
+                self._evict()
+                self._save_index()
+            return record['path']
+
+    def _fetch(self, url, record):
+        '''
+        Download the media at the URL, unless the cached one is still valid,
+        and return its record, or None if it's too large
+        :param url:
+        :param record: record of the intact cached media, if any
+        '''
+        headers = {'User-Agent': 'Mozilla/5.0'}
+        if record is not None:
+            if record.get('etag'):
+                headers['If-None-Match'] = record['etag']
+            if record.get('last_modified'):
+                headers['If-Modified-Since'] = record['last_modified']
+        response = http_session.get_session().get(url, headers=headers,
+                                                   stream=True)
+        try:
+            if response.status_code == 304 and record is not None:
+                logging.info("Media %s not modified, using %s", url,
+                             record['path'])
+                return record
+            response.raise_for_status()
+            if self._is_too_large(
+                    int(response.headers.get('Content-Length') or 0)):
+                logging.error("Media %s is too large (%s bytes) - ignoring",
+                              url, response.headers['Content-Length'])
+                return None
+
+            filename = get_filename_from_cd(
+                response.headers.get('Content-Disposition')) or \
+                get_filename_from_response(response) or \
+                'random.jpg'
+            url_digest = hashlib.blake2b(url.encode('utf-8'),
+                                         digest_size=8).hexdigest()
+            full_path = self._media_dir + '/' + url_digest + '/' + filename
+            logging.info("Downloading %s as %s...", url, full_path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            temp_path = '%s.%d' % (full_path, os.getpid())
+            digest = hashlib.sha256()
+            size = 0
+            with open(temp_path, 'wb') as file_chunk:
+                for chunk in response.iter_content(65536):
+                    size += len(chunk)
+                    if self._is_too_large(size):
+                        break
+                    digest.update(chunk)
+                    file_chunk.write(chunk)
+        finally:
+            response.close()
+
+        if self._is_too_large(size):
+            logging.error("Media %s is too large (over %d bytes) - ignoring",
+                          url, self._max_media_size)
+            self._remove(temp_path)
+            return None
+        os.replace(temp_path, full_path)
+        if record is not None and record['path'] != full_path:
+            self._remove(record['path'])
+
+        return {'path': full_path,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'digest': digest.hexdigest(),
+                'size': size}
+
+    def _is_too_large(self, size):
+        '''
+        Is a media of that size too large?
+        :param size: in bytes
+        '''
+        return self._max_media_size is not None and \
+            size > self._max_media_size
+
+    def _evict(self):
+        '''
+        Remove the least recently used media, not used during this run,
+        until the cache fits its maximum size
+        '''
+        size = sum(record['size'] for record in self._index.values())
+        for url, record in sorted(self._index.items(),
+                                  key=lambda item: item[1]['used']):
+            if size <= self._max_size:
+                break
+            if url in self._fresh:
+                continue
+            logging.info("Evicting media %s from the cache", url)
+            self._remove(record['path'])
+            del self._index[url]
+            size -= record['size']
+
+    def _remove(self, path):
+        '''
+        Remove a cached media, and its directory if it's left empty
+        :param path:
+        '''
+        try:
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+
+def configure(max_size=None, max_media_size=None):
+    '''
+    Change the settings of the media cache; only effective if called before
+    its first use
+    :param max_size: maximum size of the cached media, in bytes
+    :param max_media_size: maximum size of a media, in bytes
+    '''
+    if max_size is not None:
+        _settings['max_size'] = max_size
+    if max_media_size is not None:
+        _settings['max_media_size'] = max_media_size
+
+
+def get_cache():
+    '''
+    Return the media cache, in MEDIA_DIR, creating it on first use
+    '''
+    global _cache  # pylint: disable=global-statement
+    with _lock:
+        if _cache is None:
+            _cache = MediaCache(os.getenv('MEDIA_DIR', '/tmp'),
+                                _settings['max_size'],
+                                _settings['max_media_size'])
+    return _cache
@@ -0,0 +1,192 @@
+"""
+Versioned schema of the FeedSpora database.
+
+The schema version is stored in the database itself (PRAGMA user_version).
+Each migration upgrades the schema by one version and runs in its own
+transaction, so that existing databases are upgraded in place, without
+losing their published entries.
+"""
+
+import logging
+
+from feedspora.generic_storage import entry_digest
+
+
+def _create_posts(cursor):
+    '''
+    Version 1: table of published entries, as created by earlier releases
+    :param cursor:
+    '''
+    cursor.execute("CREATE TABLE IF NOT EXISTS posts (id INTEGER PRIMARY "
+                   "KEY, feedspora_id, client_id TEXT)")
+
+
+def _create_feeds(cursor):
+    '''
+    Version 2: state of the feeds, as of their last processing: HTTP cache
+    validators, high-water mark and content digest
+    :param cursor:
+    '''
+    cursor.execute("CREATE TABLE IF NOT EXISTS feeds (path TEXT PRIMARY KEY, "
+                   "clients TEXT, etag TEXT, last_modified TEXT, seen TEXT, "
+                   "content_hash TEXT)")
+    # The table may have been created without its latest columns
+    cursor.execute("PRAGMA table_info(feeds)")
+    columns = [column[1] for column in cursor.fetchall()]
+    for column in ['seen', 'content_hash']:
+        if column not in columns:
+            cursor.execute("ALTER TABLE feeds ADD COLUMN %s TEXT" % column)
+
+
+def _index_posts(cursor):
+    '''
+    Version 3: typed columns, publication date and feed of the published
+    entries, and a unique index on (feedspora_id, client_id). Duplicate rows
+    are merged into the oldest one.
+    :param cursor:
+    '''
+    cursor.execute("CREATE TABLE posts_v3 (id INTEGER PRIMARY KEY, "
+                   "feedspora_id TEXT, client_id TEXT, published_at TEXT, "
+                   "feed_path TEXT)")
+    cursor.execute("INSERT INTO posts_v3 (id, feedspora_id, client_id) "
+                   "SELECT MIN(id), feedspora_id, client_id FROM posts "
+                   "GROUP BY feedspora_id, client_id")
+    cursor.execute("DROP TABLE posts")
+    cursor.execute("ALTER TABLE posts_v3 RENAME TO posts")
+    cursor.execute("CREATE UNIQUE INDEX posts_entry ON posts "
+                   "(feedspora_id, client_id)")
+
+
+def _add_last_seen(cursor):
+    '''
+    Version 4: last time each published entry was seen in a feed, used to
+    prune entries that left every feed. Existing entries are considered
+    seen when published, or now if that's unknown.
+    :param cursor:
+    '''
+    cursor.execute("ALTER TABLE posts ADD COLUMN last_seen TEXT")
+    cursor.execute("UPDATE posts SET published_at=datetime(published_at)")
+    cursor.execute("UPDATE posts SET last_seen=COALESCE(published_at, "
+                   "datetime('now'))")
+
+
+def _hash_identifiers(cursor):
+    '''
+    Version 5: published entries stored under the 16-byte digest of their
+    identifier, uniquely indexed with their client. Identifiers are kept
+    in the feedspora_id column, which is only filled for debugging
+    purposes from then on.
+    :param cursor:
+    '''
+    cursor.connection.create_function('entry_digest', 1, entry_digest)
+    cursor.execute("CREATE TABLE posts_v5 (id INTEGER PRIMARY KEY, "
+                   "entry_hash BLOB NOT NULL, client_id TEXT, "
+                   "published_at TEXT, last_seen TEXT, feed_path TEXT, "
+                   "feedspora_id TEXT)")
+    cursor.execute("INSERT INTO posts_v5 (id, entry_hash, client_id, "
+                   "published_at, last_seen, feed_path, feedspora_id) "
+                   "SELECT id, entry_digest(feedspora_id), client_id, "
+                   "published_at, last_seen, feed_path, feedspora_id "
+                   "FROM posts")
+    cursor.execute("DROP TABLE posts")
+    cursor.execute("ALTER TABLE posts_v5 RENAME TO posts")
+    cursor.execute("CREATE UNIQUE INDEX posts_entry ON posts "
+                   "(entry_hash, client_id)")
+
+
+def _add_claims(cursor):
+    '''
+    Version 6: entries claimed by a run, until it has published them or
+    until the claim expires, so that concurrent runs don't publish the same
+    entry. Published entries have no claim.
+    :param cursor:
+    '''
+    cursor.execute("ALTER TABLE posts ADD COLUMN claimed_until TEXT")
+
+
+def _create_outbox(cursor):
+    '''
+    Version 7: outbox of the entries rendered for a client, until they're
+    delivered: at most one per entry and client, attempted again later
+    if delivery fails, and held by the run delivering it
+    :param cursor:
+    '''
+    cursor.execute("CREATE TABLE outbox (id INTEGER PRIMARY KEY, "
+                   "entry_hash BLOB NOT NULL, client_id TEXT, payload TEXT, "
+                   "attempts INTEGER NOT NULL DEFAULT 0, next_attempt TEXT, "
+                   "lease_token TEXT)")
+    cursor.execute("CREATE UNIQUE INDEX outbox_entry ON outbox "
+                   "(entry_hash, client_id)")
+    cursor.execute("CREATE INDEX outbox_due ON outbox (next_attempt)")
+
+
+def _create_client_states(cursor):
+    '''
+    Version 8: state of the clients, such as their rate limiters, kept
+    across runs
+    :param cursor:
+    '''
+    cursor.execute("CREATE TABLE client_states (client_id TEXT PRIMARY KEY, "
+                   "state TEXT)")
+
+
+def _create_short_urls(cursor):
+    '''
+    Version 9: URLs shortened by each URL shortener configuration (the
+    digest of its name and options), under the digest of the original URL,
+    along with when they were; failed attempts have no short URL
+    :param cursor:
+    '''
+    cursor.execute("CREATE TABLE short_urls (url_hash BLOB NOT NULL, "
+                   "shortener TEXT NOT NULL, short_url TEXT, stored_at REAL, "
+                   "PRIMARY KEY (url_hash, shortener))")
+
+
+MIGRATIONS = [_create_posts, _create_feeds, _index_posts, _add_last_seen,
+              _hash_identifiers, _add_claims, _create_outbox,
+              _create_client_states, _create_short_urls]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_version(conn):
+    '''
+    Return the schema version of a database
+    :param conn:
+    '''
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    '''
+    Upgrade the schema of a database to the latest version
+    :param conn:
+    '''
+    version = get_version(conn)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError("Database schema version %d is newer than the "
+                           "supported one (%d)" % (version, SCHEMA_VERSION))
+
+    # Transactions are handled explicitly, so that schema changes are
+    # rolled back along with the data if a migration fails. They are
+    # immediate, so that concurrent runs upgrade the schema one at a time.
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        cursor = conn.cursor()
+        while version < SCHEMA_VERSION:
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                # Another run may have upgraded the schema meanwhile
+                version = get_version(conn)
+                if version < SCHEMA_VERSION:
+                    logging.info("Upgrading database schema to version %d",
+                                 version + 1)
+                    MIGRATIONS[version](cursor)
+                    version += 1
+                    cursor.execute("PRAGMA user_version = %d" % version)
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+    finally:
+        conn.isolation_level = isolation_level
@@ -0,0 +1,72 @@
+"""
+TokenBucket: rate limiter letting a client post in bursts, then at a steady
+rate, without ever waiting for it.
+"""
+
+import math
+import time
+
+
+class TokenBucket:
+    '''
+    Token bucket holding up to burst tokens, refilled at rate tokens per
+    hour. Posting takes a token; when there's none left, posting is
+    deferred rather than waited for. Its state can be stored, so that
+    limits hold across runs.
+    '''
+
+    def __init__(self, rate, burst=1):
+        '''
+        Initialize a full bucket
+        :param rate: tokens per hour
+        :param burst: capacity of the bucket
+        '''
+        self.rate = rate / 3600.0
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+
+    def _refill(self, now):
+        '''
+        Add the tokens earned since the last update
+        :param now:
+        '''
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, now=None):
+        '''
+        Take a token if there's one, and return whether there was
+        :param now: current time (POSIX timestamp)
+        '''
+        self._refill(time.time() if now is None else now)
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def wait_time(self, now=None):
+        '''
+        Return how many seconds until a token is available
+        :param now: current time (POSIX timestamp)
+        '''
+        self._refill(time.time() if now is None else now)
+        if self._tokens >= 1 or self.rate <= 0:
+            return 0
+        return int(math.ceil((1 - self._tokens) / self.rate))
+
+    def get_state(self):
+        '''
+        Return the state of the bucket, as a JSON-serializable list
+        '''
+        return [self._tokens, self._updated]
+
+    def set_state(self, state):
+        '''
+        Restore the state of the bucket, as returned by get_state
+        :param state:
+        '''
+        self._tokens = min(self.burst, float(state[0]))
+        self._updated = float(state[1])
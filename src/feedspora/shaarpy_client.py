@@ -46,15 +46,15 @@ class ShaarpyClient(GenericClient):
             "audience": kwargs['audience']
         }
 
-    def post(self, feed, entry):
+    def render(self, feed, entry):
         '''
-        Post entry to Shaarli
+        Render entry for Shaarli
         :param feed:
         :param entry:
         '''
         title = self.resolve_option(feed, 'post_prefix') + \
                 entry.title+self.resolve_option(feed, 'post_suffix')
-        link = self.shorten_url(feed, entry.link)
+        link = self.shorten_entry_link(feed, entry)
         tags = self.filter_tags(feed, entry)
         content = ''
         if self.resolve_option(feed, 'post_include_content') and entry.content:
@@ -70,22 +70,27 @@ class ShaarpyClient(GenericClient):
 
             content = self.remove_ending_tags(feed, content)
 
+        return {'link': link,
+                'tags': tags,
+                'title': title,
+                'content': content,
+                'audience': 'private' if self._post_private else 'public'
+                }
+
+    def deliver(self, payload):
+        '''
+        Post rendered entry to Shaarli
+        :param payload:
+        '''
         to_return = False
         if self.is_testing():
-            post_args = {'link': link,
-                         'tags': tags,
-                         'title': title,
-                         'content': content,
-                         'audience': 'private' if self._post_private else \
-                                     'public'
-                         }
-            self.accumulate_testing_output(self.get_dict_output(**post_args))
+            self.accumulate_testing_output(self.get_dict_output(**payload))
         else:
             # pylint: disable=broad-except
             try:
-                to_return = self._shaarpy.post_link(link, tags,
-                                                    title=title, desc=content,
-                                                    private=self._post_private)
+                to_return = self._shaarpy.post_link(
+                    payload['link'], payload['tags'], title=payload['title'],
+                    desc=payload['content'], private=self._post_private)
             except Exception as broad_exception:
                 logging.error(str(broad_exception), exc_info=True)
             # pylint: enable=broad-except
@@ -0,0 +1,160 @@
+"""
+ShortUrlCache: memo of the URLs shortened for the clients, in memory and in
+the FeedSpora database.
+"""
+
+import collections
+import hashlib
+import threading
+import time
+
+_settings = {'ttl': None}
+_cache = None
+_lock = threading.Lock()
+
+
+class ShortUrlCache:
+    '''
+    Short URLs by original URL and URL shortener configuration, in a least
+    recently used memo in front of the storage of the run, if any. URL
+    shortener configurations are only stored as digests, so that their API
+    keys aren't. Short URLs are kept for ttl seconds, or forever. Failed
+    attempts at shortening are kept for failure_ttl seconds, so that a
+    broken URL shortener isn't tried again for every post.
+    The storage is only used from the thread that set it: other threads
+    only look short URLs up in memory, and the ones they record are saved
+    when that thread flushes them.
+    '''
+    _failure_ttl = 3600
+
+    def __init__(self, ttl=None, max_entries=1024):
+        '''
+        Initialize
+        :param ttl: seconds short URLs are kept, None for ever
+        :param max_entries: number of short URLs kept in memory
+        '''
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._storage = None
+        self._storage_thread = None
+        # Records to be saved to the storage
+        self._unsaved = dict()
+        self._lock = threading.Lock()
+
+    def set_storage(self, storage):
+        '''
+        Record short URLs in the storage of the run, from the calling thread
+        only; None when it's closed, once the unsaved ones are saved
+        :param storage:
+        '''
+        if storage is None:
+            self.flush()
+        with self._lock:
+            self._storage = storage
+            self._storage_thread = threading.get_ident() \
+                if storage is not None else None
+
+    def _owns_storage(self):
+        '''
+        May the calling thread use the storage?
+        '''
+        return self._storage is not None and \
+            self._storage_thread == threading.get_ident()
+
+    @staticmethod
+    def _key(url, shortener):
+        '''
+        Key of a short URL, in memory and in the storage
+        :param url:
+        :param shortener:
+        '''
+        return (url, hashlib.blake2b(shortener.encode('utf-8'),
+                                     digest_size=16).hexdigest())
+
+    def _is_expired(self, short_url, stored_at):
+        '''
+        Has a short URL (empty for a failed attempt) been kept long enough?
+        :param short_url:
+        :param stored_at: POSIX timestamp
+        '''
+        ttl = self._ttl if short_url else self._failure_ttl
+        return ttl is not None and stored_at + ttl < time.time()
+
+    def get(self, url, shortener):
+        '''
+        Return the short URL of the URL, empty if shortening it failed
+        recently, or None if it has to be shortened
+        :param url:
+        :param shortener: configuration of the URL shortener, as a string
+        '''
+        key = self._key(url, shortener)
+        with self._lock:
+            record = self._entries.get(key)
+            if record is None and self._owns_storage():
+                record = self._storage.load_short_url(*key)
+            if record is None or self._is_expired(*record):
+                self._entries.pop(key, None)
+                return None
+            self._remember(key, record)
+            return record[0]
+
+    def put(self, url, shortener, short_url):
+        '''
+        Record the short URL of the URL, empty if shortening it failed
+        :param url:
+        :param shortener: configuration of the URL shortener, as a string
+        :param short_url:
+        '''
+        key = self._key(url, shortener)
+        record = (short_url, time.time())
+        with self._lock:
+            self._remember(key, record)
+            if self._owns_storage():
+                self._storage.save_short_url(*(key + record))
+            else:
+                self._unsaved[key] = record
+
+    def flush(self):
+        '''
+        Save the short URLs recorded by other threads, from the thread using
+        the storage
+        '''
+        with self._lock:
+            if not self._owns_storage():
+                return
+            for key, record in self._unsaved.items():
+                self._storage.save_short_url(*(key + record))
+            self._unsaved.clear()
+
+    def _remember(self, key, record):
+        '''
+        Keep a record in memory, as the most recently used
+        :param key:
+        :param record:
+        '''
+        self._entries[key] = record
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+
+def configure(ttl=None):
+    '''
+    Change the settings of the short URL cache; only effective if called
+    before its first use
+    :param ttl: seconds short URLs are kept, None for ever
+    '''
+    if ttl is not None:
+        _settings['ttl'] = ttl
+
+
+def get_cache():
+    '''
+    Return the short URL cache, creating it on first use
+    '''
+    global _cache  # pylint: disable=global-statement
+    with _lock:
+        if _cache is None:
+            _cache = ShortUrlCache(_settings['ttl'])
+    return _cache
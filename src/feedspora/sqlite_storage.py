@@ -0,0 +1,563 @@
+"""
+SqliteStorage: published entries and feed states in a SQLite database.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import uuid
+
+from feedspora import migrations
+from feedspora.bloom_filter import BloomFilter
+from feedspora.generic_storage import GenericStorage, entry_digest
+
+
+class SqliteStorage(GenericStorage):
+    '''
+    Storage in a SQLite database, whose schema is upgraded on opening.
+    Published entries are looked up in memory, or through Bloom filters
+    stored next to the database, by digest. Entries are claimed in the
+    database before being posted, so that concurrent runs sharing it don't
+    post them twice. Deliveries given up are kept in the outbox with no
+    next attempt.
+    '''
+    _conn = None
+    _cur = None
+    _use_bloom_filters = False
+    # Number of seeded entries stored per transaction
+    _commit_batch = 500
+    # Seconds to wait for a concurrent run to release the database
+    _busy_timeout = 30
+    # Seconds after which a claim not turned into a publication expires,
+    # in case the run holding it died
+    _claim_lease = 3600
+
+    def __init__(self, db_file):
+        '''
+        Initialize
+        :param db_file:
+        '''
+        super().__init__(db_file)
+        self._published = None
+        self._bloom_filters = None
+        self._bloom_stats = None
+        self._uncommitted = 0
+        self._claims = set()
+
+    def set_bloom_filters(self, use_bloom_filters):
+        '''
+        Look up published entries through Bloom filters stored next to the
+        database, rather than loading them all in memory
+        :param use_bloom_filters:
+        '''
+        self._use_bloom_filters = use_bloom_filters
+
+    def open(self, client_names, load_published=True):
+        '''
+        Initialize the connection to the database.
+        It also creates the tables if the file does not exist yet, and
+        upgrades their schema otherwise.
+        :param client_names:
+        :param load_published:
+        '''
+        if not os.path.exists(self._db_file):
+            logging.info("Creating new database file %s", self._db_file)
+        else:
+            logging.info("Found database file %s", self._db_file)
+        self._client_names = list(client_names)
+        self._conn = sqlite3.connect(self._db_file,
+                                     timeout=self._busy_timeout)
+        self._cur = self._conn.cursor()
+        # Readers don't block writers, and a commit takes a single fsync
+        self._cur.execute("PRAGMA journal_mode=WAL").fetchall()
+        migrations.migrate(self._conn)
+        if not load_published:
+            return
+        if self._use_bloom_filters:
+            self._load_bloom_filters(client_names)
+        else:
+            self._load_published_entries(client_names)
+
+    def _commit(self):
+        '''
+        Commit the current transaction
+        '''
+        self._conn.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        '''
+        Commit what's left to commit and close the connection to the
+        database.
+        '''
+        if self._conn is not None:
+            self._commit()
+            if self._bloom_filters:
+                self._save_bloom_filters()
+            self._conn.close()
+            self._conn = None
+            self._cur = None
+
+    def _load_published_entries(self, client_names):
+        '''
+        Load the digests of the entries already published to each
+        connected client, so that they can be looked up in memory.
+        :param client_names:
+        '''
+        self._published = {name: set() for name in client_names}
+        if not self._published:
+            return
+        names = list(self._published)
+        self._cur.execute(
+            "SELECT entry_hash, client_id FROM posts WHERE claimed_until IS "
+            "NULL AND client_id IN (%s)" % ','.join('?' * len(names)), names)
+        for entry_hash, client_id in self._cur:
+            self._published[client_id].add(entry_hash)
+        logging.info("Loaded %d published entries",
+                     sum(len(ids) for ids in self._published.values()))
+
+    def bloom_filter_path(self, client_name):
+        '''
+        Path of the Bloom filter file of a client
+        :param client_name:
+        '''
+        return "%s.%s.bloom" % (self._db_file, hashlib.blake2b(
+            client_name.encode('utf-8'), digest_size=8).hexdigest())
+
+    def _update_bloom_filter(self, client_name, bloom_filter):
+        '''
+        Add to a Bloom filter the entries stored since it was last updated
+        :param client_name:
+        :param bloom_filter:
+        '''
+        self._cur.execute(
+            "SELECT id, entry_hash FROM posts WHERE client_id=? AND id>? "
+            "ORDER BY id", (client_name, bloom_filter.last_id))
+        for row_id, entry_hash in self._cur:
+            bloom_filter.add(entry_hash)
+            bloom_filter.set_last_row(row_id, entry_hash)
+
+    def _load_bloom_filters(self, client_names):
+        '''
+        Load the Bloom filter of each connected client, rebuilding it from
+        the database if it's missing, saturated, or doesn't match the
+        database.
+        :param client_names:
+        '''
+        self._bloom_filters = dict()
+        self._bloom_stats = {'negatives': 0, 'false_positives': 0}
+        for name in client_names:
+            bloom_filter = BloomFilter.load(self.bloom_filter_path(name))
+            if bloom_filter is not None and bloom_filter.last_id:
+                self._cur.execute(
+                    "SELECT entry_hash FROM posts WHERE id=? AND "
+                    "client_id=?", (bloom_filter.last_id, name))
+                row = self._cur.fetchone()
+                if row is None or not bloom_filter.is_last_row(row[0]):
+                    bloom_filter = None
+            if bloom_filter is None or bloom_filter.is_saturated():
+                logging.info("Building Bloom filter of %s", name)
+                self._cur.execute(
+                    "SELECT COUNT(*) FROM posts WHERE client_id=?", (name,))
+                bloom_filter = BloomFilter(2 * self._cur.fetchone()[0])
+            self._update_bloom_filter(name, bloom_filter)
+            self._bloom_filters[name] = bloom_filter
+
+    def _save_bloom_filters(self):
+        '''
+        Save the Bloom filters, up to date with the database
+        '''
+        for name, bloom_filter in self._bloom_filters.items():
+            self._update_bloom_filter(name, bloom_filter)
+            bloom_filter.save(self.bloom_filter_path(name))
+
+    def is_published(self, identifier, client_name):
+        '''
+        Is the identifier in the database of published items?
+        :param identifier:
+        :param client_name:
+        '''
+        digest = entry_digest(identifier)
+        if self._bloom_filters is None:
+            return digest in self._published.get(client_name, ())
+
+        # Only entries possibly published are looked up in the database
+        if digest not in self._bloom_filters[client_name]:
+            self._bloom_stats['negatives'] += 1
+            return False
+        self._cur.execute(
+            "SELECT id FROM posts WHERE entry_hash=? AND client_id=? AND "
+            "claimed_until IS NULL", (digest, client_name))
+        if self._cur.fetchone() is None:
+            self._bloom_stats['false_positives'] += 1
+            return False
+        return True
+
+    def add_published(self, identifier, client_name, feed_path=None,
+                      posted=True):
+        '''
+        Add an entry to the database of published items.
+        Entries actually posted are committed at once; seeded ones are
+        committed in batches.
+        :param identifier:
+        :param client_name:
+        :param feed_path:
+        :param posted:
+        '''
+        digest = entry_digest(identifier)
+        self._record_published(identifier, digest, client_name, feed_path)
+        self._uncommitted += 1
+        if posted or self._uncommitted >= self._commit_batch:
+            self._commit()
+        self._index_published(digest, client_name)
+
+    def _record_published(self, identifier, digest, client_name, feed_path):
+        '''
+        Insert a published entry, or turn its claim into a publication,
+        without committing
+        :param identifier:
+        :param digest:
+        :param client_name:
+        :param feed_path:
+        '''
+        debug_identifier = identifier if self._debug_identifiers else None
+        if (digest, client_name) in self._claims:
+            self._claims.remove((digest, client_name))
+            self._cur.execute(
+                "UPDATE posts SET claimed_until=NULL, "
+                "published_at=datetime('now'), feedspora_id=? WHERE "
+                "entry_hash=? AND client_id=?",
+                (debug_identifier, digest, client_name))
+        else:
+            self._cur.execute(
+                "INSERT OR IGNORE INTO posts (entry_hash, client_id, "
+                "published_at, last_seen, feed_path, feedspora_id) values "
+                "(?, ?, datetime('now'), datetime('now'), ?, ?)",
+                (digest, client_name, feed_path, debug_identifier))
+
+    def _index_published(self, digest, client_name):
+        '''
+        Make a published entry found by lookups
+        :param digest:
+        :param client_name:
+        '''
+        if self._bloom_filters is not None:
+            self._bloom_filters[client_name].add(digest)
+        else:
+            self._published.setdefault(client_name, set()).add(digest)
+
+    def claim(self, identifier, client_name, feed_path=None):
+        '''
+        Claim an unpublished entry in the database, taking over an expired
+        claim if need be. The claim is committed at once, so that concurrent
+        runs see it.
+        :param identifier:
+        :param client_name:
+        :param feed_path:
+        '''
+        digest = entry_digest(identifier)
+        self._cur.execute(
+            "DELETE FROM posts WHERE entry_hash=? AND client_id=? AND "
+            "claimed_until < datetime('now')", (digest, client_name))
+        if self._cur.rowcount:
+            logging.warning("Taking over an expired claim on %s", identifier)
+        # The unique index makes the insertion fail if the entry has been
+        # published or claimed by another run meanwhile
+        self._cur.execute(
+            "INSERT OR IGNORE INTO posts (entry_hash, client_id, last_seen, "
+            "feed_path, claimed_until) values (?, ?, datetime('now'), ?, "
+            "datetime('now', ?))",
+            (digest, client_name, feed_path,
+             '+%d seconds' % self._claim_lease))
+        claimed = self._cur.rowcount == 1
+        if claimed:
+            self._claims.add((digest, client_name))
+        else:
+            self._cur.execute(
+                "SELECT claimed_until FROM posts WHERE entry_hash=? AND "
+                "client_id=?", (digest, client_name))
+            claimed_until = self._cur.fetchone()[0]
+            if claimed_until is None:
+                logging.info("Entry published by another run: %s",
+                             identifier)
+                self._index_published(digest, client_name)
+            else:
+                logging.info("Entry claimed by another run until %s: %s",
+                             claimed_until, identifier)
+        self._commit()
+        return claimed
+
+    def release(self, identifier, client_name):
+        '''
+        Delete the claim on an entry
+        :param identifier:
+        :param client_name:
+        '''
+        digest = entry_digest(identifier)
+        if (digest, client_name) in self._claims:
+            self._claims.remove((digest, client_name))
+            self._cur.execute(
+                "DELETE FROM posts WHERE entry_hash=? AND client_id=? AND "
+                "claimed_until IS NOT NULL", (digest, client_name))
+            self._commit()
+
+    def enqueue(self, identifier, client_name, payload, feed_path=None):
+        '''
+        Queue an entry rendered for the client in the outbox, and record it
+        as published, in a single transaction: an entry can't be left
+        claimed with its payload queued, and rendered again once its claim
+        has expired
+        :param identifier:
+        :param client_name:
+        :param payload:
+        :param feed_path:
+        '''
+        digest = entry_digest(identifier)
+        # Seeded entries aren't to be rolled back along with the entry
+        if self._uncommitted:
+            self._commit()
+        claimed = (digest, client_name) in self._claims
+        try:
+            self._cur.execute(
+                "INSERT OR IGNORE INTO outbox (entry_hash, client_id, "
+                "payload, next_attempt) values (?, ?, ?, datetime('now'))",
+                (digest, client_name, json.dumps(payload)))
+            self._record_published(identifier, digest, client_name,
+                                   feed_path)
+            self._commit()
+        except Exception:
+            self._conn.rollback()
+            if claimed:
+                self._claims.add((digest, client_name))
+            raise
+        self._index_published(digest, client_name)
+
+    def due_deliveries(self, client_names):
+        '''
+        Hold the deliveries due to the clients for a lease, and return them
+        :param client_names:
+        '''
+        if not client_names:
+            return []
+        token = uuid.uuid4().hex
+        self._cur.execute(
+            "UPDATE outbox SET lease_token=?, next_attempt=datetime('now', "
+            "?) WHERE next_attempt <= datetime('now') AND client_id IN "
+            "(%s)" % ','.join('?' * len(client_names)),
+            [token, '+%d seconds' % self._claim_lease] + list(client_names))
+        self._commit()
+        self._cur.execute(
+            "SELECT id, client_id, payload, attempts FROM outbox WHERE "
+            "lease_token=? ORDER BY id", (token,))
+        return [(row_id, client_id, json.loads(payload), attempts)
+                for row_id, client_id, payload, attempts
+                in self._cur.fetchall()]
+
+    def remove_delivery(self, delivery_id):
+        '''
+        Remove a delivery from the outbox
+        :param delivery_id:
+        '''
+        self._cur.execute("DELETE FROM outbox WHERE id=?", (delivery_id,))
+        self._commit()
+
+    def fail_delivery(self, delivery_id):
+        '''
+        Keep a delivery given up in the outbox, with no next attempt
+        :param delivery_id:
+        '''
+        self._cur.execute(
+            "UPDATE outbox SET attempts=attempts+1, lease_token=NULL, "
+            "next_attempt=NULL WHERE id=?", (delivery_id,))
+        self._commit()
+
+    def count_failed_deliveries(self, client_names):
+        '''
+        Return the number of deliveries to the clients given up
+        :param client_names:
+        '''
+        if not client_names:
+            return 0
+        self._cur.execute(
+            "SELECT COUNT(*) FROM outbox WHERE next_attempt IS NULL AND "
+            "client_id IN (%s)" % ','.join('?' * len(client_names)),
+            list(client_names))
+        return self._cur.fetchone()[0]
+
+    def retry_failed_deliveries(self, client_names):
+        '''
+        Make the deliveries to the clients given up due again
+        :param client_names:
+        '''
+        if not client_names:
+            return 0
+        self._cur.execute(
+            "UPDATE outbox SET attempts=0, next_attempt=datetime('now') "
+            "WHERE next_attempt IS NULL AND client_id IN (%s)" %
+            ','.join('?' * len(client_names)), list(client_names))
+        retried = self._cur.rowcount
+        self._commit()
+        return retried
+
+    def postpone_delivery(self, delivery_id, delay, failed=True):
+        '''
+        Release a delivery until later, counting a failed attempt
+        :param delivery_id:
+        :param delay:
+        :param failed:
+        '''
+        self._cur.execute(
+            "UPDATE outbox SET attempts=attempts+?, lease_token=NULL, "
+            "next_attempt=datetime('now', ?) WHERE id=?",
+            (1 if failed else 0, '+%d seconds' % delay, delivery_id))
+        self._commit()
+
+    def load_client_state(self, client_name):
+        '''
+        Return the state of a client recorded by an earlier run
+        :param client_name:
+        '''
+        self._cur.execute(
+            "SELECT state FROM client_states WHERE client_id=?",
+            (client_name,))
+        row = self._cur.fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_client_state(self, client_name, state):
+        '''
+        Record the state of a client
+        :param client_name:
+        :param state:
+        '''
+        self._cur.execute(
+            "INSERT OR REPLACE INTO client_states (client_id, state) values "
+            "(?, ?)", (client_name, json.dumps(state)))
+        self._commit()
+
+    def load_short_url(self, url, shortener):
+        '''
+        Return the short URL recorded for the URL and URL shortener
+        :param url:
+        :param shortener:
+        '''
+        self._cur.execute(
+            "SELECT short_url, stored_at FROM short_urls WHERE url_hash=? "
+            "AND shortener=?", (entry_digest(url), shortener))
+        row = self._cur.fetchone()
+        return (row[0] or '', row[1]) if row else None
+
+    def save_short_url(self, url, shortener, short_url, stored_at):
+        '''
+        Record the short URL of the URL
+        :param url:
+        :param shortener:
+        :param short_url:
+        :param stored_at:
+        '''
+        self._cur.execute(
+            "INSERT OR REPLACE INTO short_urls (url_hash, shortener, "
+            "short_url, stored_at) VALUES (?, ?, ?, ?)",
+            (entry_digest(url), shortener, short_url or None, stored_at))
+        self._commit()
+
+    def load_feed_state(self, path, clients):
+        '''
+        Return the state of a feed recorded with the same clients
+        :param path:
+        :param clients:
+        '''
+        self._cur.execute(
+            "SELECT etag, last_modified, seen, content_hash FROM feeds "
+            "WHERE path=:path AND clients=:clients", {
+                "path": path,
+                "clients": clients
+            })
+        row = self._cur.fetchone()
+        if not row:
+            return None
+        return {'etag': row[0],
+                'last_modified': row[1],
+                'seen': json.loads(row[2]) if row[2] else [],
+                'content_hash': row[3],
+               }
+
+    def save_feed_state(self, path, clients, seen, validators=None):
+        '''
+        Record the state of a processed feed
+        :param path:
+        :param clients:
+        :param seen:
+        :param validators:
+        '''
+        seen = json.dumps(seen)
+        if validators is None:
+            # Keep the validators of the last complete processing
+            self._cur.execute(
+                "UPDATE feeds SET seen=? WHERE path=? AND clients=?",
+                (seen, path, clients))
+            if self._cur.rowcount:
+                self._commit()
+                return
+            validators = (None, None, None)
+        self._cur.execute(
+            "INSERT OR REPLACE INTO feeds (path, clients, etag, "
+            "last_modified, seen, content_hash) values (?,?,?,?,?,?)",
+            (path, clients, validators[0], validators[1], seen,
+             validators[2]))
+        # Also flushes the entries seeded from this feed
+        self._commit()
+
+    def compact(self, current_identifiers, retention_days, feed_paths,
+                clients, prune=True):
+        '''
+        Delete old published entries and unconfigured feed states, then
+        VACUUM and ANALYZE
+        :param current_identifiers:
+        :param retention_days:
+        :param feed_paths:
+        :param clients:
+        :param prune:
+        '''
+        self._cur.executemany(
+            "UPDATE posts SET last_seen=datetime('now') WHERE "
+            "entry_hash=?", ((entry_digest(identifier),)
+                             for identifier in current_identifiers))
+        if not self._debug_identifiers:
+            self._cur.execute("UPDATE posts SET feedspora_id=NULL WHERE "
+                              "feedspora_id IS NOT NULL")
+        if prune:
+            # Other configurations may share the database: only their own
+            # entries and feed states are known to have left the feeds
+            in_clients = "client_id IN (%s)" % ','.join(
+                '?' * len(self._client_names))
+            self._cur.execute(
+                "DELETE FROM posts WHERE last_seen < datetime('now', ?) "
+                "AND " + in_clients,
+                ['-%d days' % retention_days] + self._client_names)
+            logging.info("Deleted %d published entries not seen for %d "
+                         "days", self._cur.rowcount, retention_days)
+            self._cur.execute(
+                "DELETE FROM posts WHERE claimed_until < datetime('now') "
+                "AND " + in_clients, self._client_names)
+            self._cur.execute(
+                "DELETE FROM feeds WHERE clients=? AND path NOT IN (%s)" %
+                ','.join('?' * len(feed_paths)),
+                [clients] + list(feed_paths))
+        self._commit()
+        self._cur.execute("VACUUM")
+        self._cur.execute("ANALYZE")
+
+    def log_summary(self):
+        '''
+        Log the false positive rate of the Bloom filters
+        '''
+        if self._bloom_stats:
+            lookups = self._bloom_stats['negatives'] + \
+                self._bloom_stats['false_positives']
+            logging.info("Bloom filter false positive rate: %.2f%% (%d of %d "
+                         "unpublished entries)",
+                         100.0 * self._bloom_stats['false_positives'] /
+                         max(1, lookups),
+                         self._bloom_stats['false_positives'], lookups)
@@ -0,0 +1,186 @@
+"""
+TagInserter: turns the mentions of tags in a text into hashtags, and appends
+the tags it doesn't mention.
+"""
+
+import functools
+import re
+
+# Characters a tag must be preceded or followed by, to be mentioned
+BEFORE_CHARS = r'[\'"/([{\s]'
+AFTER_CHARS = r'[\'"/\s)\]},.!?:]'
+BEFORE_TAG = r'(\A|%s)' % BEFORE_CHARS
+AFTER_TAG = r'(\Z|%s)' % AFTER_CHARS
+WORD_PATTERN = re.compile(r'\w+')
+
+
+class TagInserter:
+    '''
+    Inserts tags into texts, the same way whatever the tags. Tags made of
+    word characters, none of them matching another one, are compiled once
+    into a single case-insensitive pattern, so that a text is scanned once
+    whatever the number of tags. Other tags are searched one at a time.
+    '''
+
+    def __init__(self, tags):
+        '''
+        Compile the tags
+        :param tags: tags, in order, without illegal characters
+        '''
+        self.tags = tags
+        self._indexes = dict((tag, index) for index, tag in enumerate(tags))
+        self._pattern = None
+        if tags and all(WORD_PATTERN.fullmatch(tag) for tag in tags):
+            pattern = re.compile(
+                r'(?:(?<=%s)|\A)(#?)(?:%s)(?=%s|\Z)' %
+                (BEFORE_CHARS,
+                 '|'.join('(%s)' % re.escape(tag) for tag in tags),
+                 AFTER_CHARS), re.IGNORECASE)
+            # Each mention must be attributed to a single tag
+            if all(pattern.fullmatch(tag).lastindex == index + 2
+                   for index, tag in enumerate(tags)):
+                self._pattern = pattern
+
+    def insert(self, text, budget=None):
+        '''
+        Turn the mentions of the tags into hashtags, and return the text
+        along with the tags it doesn't mention
+        :param text:
+        :param budget: length past which the returned text may be truncated
+        '''
+        if self._pattern is None:
+            return self._insert_slowly(text)
+        if budget is None or budget > len(text):
+            budget = len(text)
+
+        mentioned = set()
+        mentions = dict()
+        for match in self._pattern.finditer(text):
+            if match.start() >= budget and len(mentioned) == len(self.tags):
+                # Only whether the tags are mentioned matters past the budget
+                break
+            index = match.lastindex - 2
+            mentioned.add(index)
+            if not match.group(1):
+                mentions.setdefault(index, []).append(match.span())
+
+        # Like a substitution of the tag would, skip the mentions preceded by
+        # the character following the previous substituted mention
+        starts = []
+        for spans in mentions.values():
+            consumed = -1
+            for start, end in spans:
+                if start - 1 >= consumed:
+                    starts.append(start)
+                    consumed = min(end + 1, len(text))
+        starts.sort()
+
+        pieces = []
+        previous = 0
+        for start in starts:
+            if start >= budget:
+                break
+            pieces.append(text[previous:start])
+            pieces.append('#')
+            previous = start
+        pieces.append(text[previous:budget])
+
+        return ''.join(pieces), [tag for index, tag in enumerate(self.tags)
+                                 if index not in mentioned]
+
+    def append(self, text, separator, tags, budget=None):
+        '''
+        Append the separator and the tags to the text, except those already
+        there as hashtags
+        :param text: text returned by insert
+        :param separator:
+        :param tags: tags returned by insert
+        :param budget: length past which no more tags are appended
+        '''
+        to_return = text + separator
+        if self._pattern is None:
+            return self._append_slowly(to_return, tags, budget)
+
+        # The tags weren't mentioned in the text, so they may only be
+        # hashtags where it's joined with the separator
+        tail = len(text)
+        while tail and WORD_PATTERN.match(text, tail - 1):
+            tail -= 1
+        if tail and text[tail - 1] == '#':
+            tail -= 1
+        hashtags = set(match.lastindex - 2 for match in
+                       self._pattern.finditer(to_return, tail)
+                       if match.group(1))
+
+        pieces = [to_return]
+        length = len(to_return)
+        for tag in tags:
+            if budget is not None and length >= budget:
+                break
+            if self._indexes[tag] not in hashtags:
+                pieces.append(' #' + tag)
+                length += len(tag) + 2
+
+        return ''.join(pieces)
+
+    def _insert_slowly(self, text):
+        '''
+        Insert the tags one at a time
+        :param text:
+        '''
+
+        def repl(match):
+            return '%s#%s%s' % (match.group(1), match.group(2), match.group(3))
+
+        to_return = text
+        # Find inline and extra tags
+        inline_kw = []
+        extra_kw = []
+
+        for word in self.tags:
+            if re.search(
+                    r'%s#?(%s)%s' % (BEFORE_TAG, re.escape('%s' % word),
+                                     AFTER_TAG), to_return, re.IGNORECASE):
+                inline_kw.append(word)
+            else:
+                extra_kw.append(word)
+
+        # Process inline tags
+        for word in inline_kw:
+            pattern = (
+                r'%s(%s)%s' % (BEFORE_TAG, re.escape('%s' % word), AFTER_TAG))
+
+            if re.search(pattern, to_return, re.IGNORECASE):
+                to_return = re.sub(
+                    pattern, repl, to_return, flags=re.IGNORECASE)
+
+        return to_return, extra_kw
+
+    def _append_slowly(self, text, tags, budget):
+        '''
+        Append the tags one at a time
+        :param text:
+        :param tags:
+        :param budget:
+        '''
+        to_return = text
+        for word in tags:
+            if budget is not None and len(to_return) >= budget:
+                break
+            # prevent duplication
+            pattern = (r'%s#(%s)%s' % (BEFORE_TAG, re.escape('%s' % word),
+                                       AFTER_TAG))
+
+            if re.search(pattern, to_return, re.IGNORECASE) is None:
+                to_return += " #" + word
+
+        return to_return
+
+
+@functools.lru_cache(maxsize=64)
+def get_tag_inserter(tags):
+    '''
+    Return the inserter of the tags, compiled once
+    :param tags: tuple of tags
+    '''
+    return TagInserter(tags)
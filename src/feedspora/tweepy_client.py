@@ -48,9 +48,10 @@ class TweepyClient(GenericClient):
             "media": kwargs['media_path'] if kwargs['media_path'] else None
         }
 
-    def post(self, feed, entry):
+    def render(self, feed, entry):
         '''
-        Post entry to Twitter.
+        Render entry for Twitter.
+        :param feed:
         :param entry:
         '''
 
@@ -66,8 +67,7 @@ class TweepyClient(GenericClient):
         # Process contents
         raw_contents = entry.title
 
-        stripped_html = self.strip_html(feed, entry.content) \
-                        if entry.content else None
+        stripped_html = self.strip_entry_content(feed, entry)
         if self.resolve_option(feed, 'post_include_content') and stripped_html:
             raw_contents += ": " + stripped_html
         text += self._mkrichtext(raw_contents, self.filter_tags(feed, entry),
@@ -77,20 +77,34 @@ class TweepyClient(GenericClient):
         text += self.resolve_option(feed, 'post_suffix')
 
         # Shorten the link URL if configured/possible
-        text += " " + self.shorten_url(feed, entry.link)
+        text += " " + self.shorten_entry_link(feed, entry)
 
         # Finally ready to post.  Let's find out how (media/text)
         media_path = None
+        media_url = None
         if self.resolve_option(feed, 'post_include_media') and entry.media_url:
             # Need to download image from that URL in order to post it!
             media_path = self.download_media(entry.media_url)
+            media_url = entry.media_url
+
+        return {'text': text, 'media_path': media_path,
+                'media_url': media_url}
+
+    def deliver(self, payload):
+        '''
+        Post rendered entry to Twitter.
+        :param payload:
+        '''
+        text = payload['text']
+        media_path = payload['media_path']
 
         to_return = False
         if self.is_testing():
             self.accumulate_testing_output(
                 self.get_dict_output(text=text, media_path=media_path))
         elif media_path:
-            to_return = self._api.update_with_media(media_path, text)
+            to_return = self._api.update_with_media(
+                self.refresh_media(media_path, payload['media_url']), text)
         else:
             to_return = self._api.update_status(text)
 
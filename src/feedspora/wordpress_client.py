@@ -4,6 +4,7 @@ Wordpress client
 
 from urllib.parse import urlparse
 
+import base64
 import os.path
 import requests
 from readability.readability import Document, Unparseable
@@ -12,11 +13,76 @@ from wordpress_xmlrpc.compat import xmlrpc_client
 from wordpress_xmlrpc.methods import media, posts
 
 from feedspora.generic_client import GenericClient
+from feedspora.http_session import get_session
+
+
+class MediaTransportMixin:
+    '''
+    XML-RPC transport streaming a media file into requests, encoded in
+    base64 one chunk at a time, in place of a placeholder
+    '''
+    # base64.encodebytes encodes 57 bytes per line
+    _chunk_size = 57 * 1024
+
+    def __init__(self, *args, **kwargs):
+        '''
+        Initialize
+        :param args:
+        :param kwargs:
+        '''
+        super().__init__(*args, **kwargs)
+        self._media = None
+
+    def set_media(self, media_path):
+        '''
+        Stream the media file into the following requests, and return the
+        placeholder to send instead of its content; None to stop streaming
+        :param media_path:
+        '''
+        if media_path is None:
+            self._media = None
+            return None
+        placeholder = os.urandom(48)
+        self._media = (base64.encodebytes(placeholder), media_path)
+        return xmlrpc_client.Binary(placeholder)
+
+    def send_content(self, connection, request_body):
+        '''
+        Send the request body, with the media in place of its placeholder
+        :param connection:
+        :param request_body:
+        '''
+        if self._media is None or self._media[0] not in request_body:
+            super().send_content(connection, request_body)
+            return
+
+        placeholder, media_path = self._media
+        before, after = request_body.split(placeholder, 1)
+        size = os.path.getsize(media_path)
+        lines, rest = divmod(size, 57)
+        encoded_size = lines * 77 + ((rest + 2) // 3 * 4 + 1 if rest else 0)
+        connection.putheader("Content-Length",
+                             str(len(before) + encoded_size + len(after)))
+        connection.endheaders()
+        connection.send(before)
+        with open(media_path, 'rb') as media_file:
+            for chunk in iter(lambda: media_file.read(self._chunk_size), b''):
+                connection.send(base64.encodebytes(chunk))
+        connection.send(after)
+
+
+class MediaTransport(MediaTransportMixin, xmlrpc_client.Transport):
+    ''' HTTP transport streaming media '''
+
+
+class SafeMediaTransport(MediaTransportMixin, xmlrpc_client.SafeTransport):
+    ''' HTTPS transport streaming media '''
 
 
 class WPClient(GenericClient):
     ''' The WPClient handles the connection to Wordpress. '''
     client = None
+    transport = None
 
     def __init__(self, config, testing):
         '''
@@ -27,8 +93,13 @@ class WPClient(GenericClient):
         self._config = config
 
         if not testing:
+            if urlparse(config['wpurl']).scheme == 'https':
+                self.transport = SafeMediaTransport()
+            else:
+                self.transport = MediaTransport()
             self.client = Client(config['wpurl'], config['username'],
-                                 config['password'])
+                                 config['password'],
+                                 transport=self.transport)
         self.set_common_opts(config)
 
     # pylint: disable=no-self-use
@@ -37,7 +108,7 @@ class WPClient(GenericClient):
         Retrieve URL content and parse it w/ readability if it's HTML
         :param url:
         '''
-        request = requests.get(url)
+        request = get_session().get(url)
         content = ''
 
         # pylint: disable=no-member
@@ -61,42 +132,20 @@ class WPClient(GenericClient):
 
         return {
             "client": self._config['name'],
-            "title": self.resolve_option(kwargs['feed'], 'post_prefix') + \
-                     kwargs['entry'].title + \
-                     self.resolve_option(kwargs['feed'], 'post_suffix'),
-            "post_tag": self.filter_tags(kwargs['feed'], kwargs['entry']),
+            "title": kwargs['title'],
+            "post_tag": kwargs['post_tag'],
             "media_path": kwargs['media_path'],
-            "content": kwargs['content'],
-            "url": self.shorten_url(kwargs['feed'], kwargs['entry'].link)
+            "content": kwargs['testing_content'],
+            "url": kwargs['url']
         }
 
-    def post(self, feed, entry):
+    def render(self, feed, entry):
         '''
-        Post entry to Wordpress.
+        Render entry for Wordpress.
         :param feed:
         :param entry:
         '''
 
-        def upload_media(media_path):
-            '''
-            Upload the media using XML-RPC mechanisms
-            :param media_path:
-            '''
-            # prepare metadata
-            upload_data = {'name': os.path.basename(media_path),
-                           'type': self.get_mimetype(media_path)
-                           }
-
-            # Read the binary file and let the XMLRPC library encode it
-            # into base64
-            with open(media_path, 'rb') as img:
-                upload_data['bits'] = xmlrpc_client.Binary(img.read())
-
-            response = self.client.call(media.UploadFile(upload_data))
-
-            return response['id']
-
-
         article_content = ''
         if 'post_link_content' in self._config and \
            self._config['post_link_content']:
@@ -104,42 +153,78 @@ class WPClient(GenericClient):
         else:
             if self.resolve_option(feed, 'post_include_content') and \
                entry.content:
-                article_content = self.strip_html(feed, entry.content)
+                article_content = self.strip_entry_content(feed, entry)
 
+        url = self.shorten_entry_link(feed, entry)
         post_content = r"Source: <a href='{}'>{}</a><hr\>{}".format(
-            self.shorten_url(feed, entry.link),
-            urlparse(entry.link).netloc, article_content)
+            url, urlparse(entry.link).netloc, article_content)
 
         # Resolve media, if appropriate and possible
         media_path = None
+        media_url = None
         if self.resolve_option(feed, 'post_include_media') and entry.media_url:
             # Need to download image from that URL in order to post it!
             media_path = self.download_media(entry.media_url)
+            media_url = entry.media_url
+
+        testing_content = article_content
+        if 'post_link_content' in self._config and \
+           self._config['post_link_content']:
+            testing_content = "From "+url
+
+        return {'title': self.resolve_option(feed, 'post_prefix') + \
+                         entry.title + \
+                         self.resolve_option(feed, 'post_suffix'),
+                'content': post_content,
+                'testing_content': testing_content,
+                'post_tag': self.filter_tags(feed, entry),
+                'url': url,
+                'media_path': media_path,
+                'media_url': media_url}
+
+    def deliver(self, payload):
+        '''
+        Post rendered entry to Wordpress.
+        :param payload:
+        '''
+
+        def upload_media(media_path):
+            '''
+            Upload the media using XML-RPC mechanisms
+            :param media_path:
+            '''
+            # prepare metadata
+            upload_data = {'name': os.path.basename(media_path),
+                           'type': self.get_mimetype(media_path)
+                           }
+
+            # Let the transport stream the binary file, encoded into base64
+            upload_data['bits'] = self.transport.set_media(media_path)
+            try:
+                response = self.client.call(media.UploadFile(upload_data))
+            finally:
+                self.transport.set_media(None)
+
+            return response['id']
+
 
         to_return = False
         if self.is_testing():
-            content = article_content
-            if 'post_link_content' in self._config and \
-               self._config['post_link_content']:
-                content = "From "+self.shorten_url(feed, entry.link)
-
-            self.accumulate_testing_output(
-                self.get_dict_output(feed=feed, entry=entry, content=content,
-                                     media_path=media_path))
+            self.accumulate_testing_output(self.get_dict_output(**payload))
         else:
             # Upload media, if appropriate
             attachment_id = 0
+            media_path = self.refresh_media(payload['media_path'],
+                                            payload['media_url'])
             if media_path:
                 attachment_id = upload_media(media_path)
 
             # get text with readability
             post = WordPressPost()
-            post.title = self.resolve_option(feed, 'post_prefix') + \
-                         entry.title + \
-                         self.resolve_option(feed, 'post_suffix')
-            post.content = post_content
+            post.title = payload['title']
+            post.content = payload['content']
             post.terms_names = {
-                'post_tag': self.filter_tags(feed, entry),
+                'post_tag': payload['post_tag'],
                 'category': ["AutomatedPost"]
             }
             post.post_status = 'publish'
@@ -3,17 +3,22 @@
 
 import json
 import re
+import xmlrpc.client
 
 import pytest
 
+from feedspora import http_session
+from feedspora import short_url_cache
 from feedspora.diaspora_client import DiaspyClient
 from feedspora.facebook_client import FacebookClient
+from feedspora.generic_client import GenericClient
 from feedspora.generic_feed import GenericFeed
 from feedspora.linkedin_client import LinkedInClient
 from feedspora.mastodon_client import MastodonClient
 from feedspora.shaarpy_client import ShaarpyClient
+from feedspora.short_url_cache import ShortUrlCache
 from feedspora.tweepy_client import TweepyClient
-from feedspora.wordpress_client import WPClient
+from feedspora.wordpress_client import MediaTransport, WPClient
 
 
 @pytest.fixture
@@ -243,9 +248,122 @@ def test_FacebookClient(entry_generator, expected):
                  expected['tags']['content'] + \
                  expected['tags']['category']:
             assert returned['message'].index(' #{}'.format(k)) > -1, \
-                "{} not found in {}".format(' #{}'.format(k), returned['message'])
+                "{} not found in {}".format(' #{}'.format(k),
+                                            returned['message'])
 
     old_init = FacebookClient.__init__
     FacebookClient.__init__ = new_init
     check(FacebookClient(), entry_generator, expected, check_entry)
     FacebookClient.__init__ = old_init
+
+
+def test_derived_values(entry_generator, monkeypatch):
+    class DerivingClient(GenericClient):
+        def __init__(self, config):
+            self._config = config
+            self.set_common_opts(config)
+
+    calls = []
+
+    def shorten_url(obj, feed, the_url):
+        calls.append(obj.get_config()['url_shortener'])
+        return 'http://short/'
+
+    def strip_html(obj, feed, before_strip):
+        calls.append('strip')
+        return 'stripped'
+
+    monkeypatch.setattr(GenericClient, 'shorten_url', shorten_url)
+    monkeypatch.setattr(GenericClient, 'strip_html', strip_html)
+    clients = [DerivingClient({'name': name, 'url_shortener': shortener})
+               for name, shortener in [('a', 'tinyurl'), ('b', 'tinyurl'),
+                                       ('c', 'isgd')]]
+    entry = next(entry_generator)
+    entry.content = '<p>Content</p>'
+    for client in clients:
+        assert client.shorten_entry_link(None, entry) == 'http://short/'
+        assert client.strip_entry_content(None, entry) == 'stripped'
+        tags = client.filter_tags(None, entry)
+        assert tags == clients[0].filter_tags(None, entry)
+        tags.append('modified')
+    assert calls == ['tinyurl', 'strip', 'isgd']
+
+
+def test_short_url_options(monkeypatch):
+    class ShorteningClient(GenericClient):
+        def __init__(self, config):
+            self._config = config
+            self.set_common_opts(config)
+
+    class Shortener:
+        def __init__(self, options):
+            self.options = options
+
+        def short(self, url):
+            if self.options.get('api_key') != 'good':
+                raise ValueError('Bad API key')
+            return 'http://t/%s' % self.options['api_key']
+
+    calls = []
+
+    def get_shortener(name, options):
+        calls.append(options.get('api_key'))
+        return Shortener(options)
+
+    monkeypatch.setattr(http_session, 'get_shortener', get_shortener)
+    monkeypatch.setattr(short_url_cache, '_cache', ShortUrlCache())
+    url = 'http://example.org/a/rather/long/link'
+    clients = [ShorteningClient({'name': name, 'url_shortener': 'tinyurl',
+                                 'url_shortener_opts': {'api_key': key}})
+               for name, key in [('a', 'bad'), ('b', 'good'),
+                                 ('c', 'good')]]
+    # A client's failure isn't remembered for clients configured otherwise
+    assert clients[0].shorten_url(None, url) == url
+    assert clients[1].shorten_url(None, url) == 'http://t/good'
+    assert clients[2].shorten_url(None, url) == 'http://t/good'
+    assert clients[0].shorten_url(None, url) == url
+    assert calls == ['bad', 'good']
+
+
+def test_strip_html_and_ending_tags():
+    client = GenericClient()
+    client.resolve_option = lambda feed, option: None
+    assert client.strip_html(None, '&lt;b&gt;Bold&lt;/b&gt; #a #b') == 'Bold'
+    assert client.strip_html(None, '<p>Text &amp;amp; more</p>') == \
+        'Text & more'
+    assert client.remove_ending_tags(None, 'x #a\n') == 'x\n'
+    assert client.remove_ending_tags(None, 'x #b\n #a\n') == 'x\n'
+    assert client.remove_ending_tags(None, 'x #a\n\n') == 'x #a\n\n'
+    assert client.remove_ending_tags(None, 'x#a #b') == 'x#a'
+    assert client.remove_ending_tags(None, ' #a') == ''
+
+
+def test_wordpress_media_transport(tmp_path):
+    class Connection:
+        def __init__(self):
+            self.headers = {}
+            self.body = b''
+
+        def putheader(self, header, value):
+            self.headers[header] = value
+
+        def endheaders(self, body=None):
+            self.body += body or b''
+
+        def send(self, data):
+            self.body += data
+
+    for size in [0, 1, 57, 100, 57 * 1024 + 3]:
+        media_path = tmp_path / 'media.jpg'
+        media_path.write_bytes(bytes(range(256)) * (size // 256) +
+                               bytes(size % 256))
+        expected = xmlrpc.client.dumps(
+            ({'bits': xmlrpc.client.Binary(media_path.read_bytes())},),
+            'wp.uploadFile').encode('utf-8')
+        transport = MediaTransport()
+        placeholder = transport.set_media(str(media_path))
+        connection = Connection()
+        transport.send_content(connection, xmlrpc.client.dumps(
+            ({'bits': placeholder},), 'wp.uploadFile').encode('utf-8'))
+        assert connection.body == expected
+        assert connection.headers['Content-Length'] == str(len(expected))
@@ -0,0 +1,655 @@
+"""
+Test the FeedSpora runner and its database of published entries
+"""
+
+import sqlite3
+import threading
+
+import requests_cache
+import responses
+
+from feedspora import http_session, migrations
+from feedspora.bloom_filter import BloomFilter
+from feedspora.feedspora_runner import FeedSpora
+from feedspora.generic_client import GenericClient
+from feedspora.generic_feed import FeedSporaEntry, GenericFeed
+from feedspora.generic_storage import entry_digest
+from feedspora.rate_limiter import TokenBucket
+
+
+class RecordingClient:
+    """
+    Client recording the links of the entries it posts
+    """
+
+    def __init__(self, name):
+        """
+        Initialize
+        """
+        self.name = name
+        self.posted = []
+        self.rate_limiter = None
+        self.rate_limited = False
+
+    def get_config(self):
+        """
+        Minimal client configuration
+        """
+        return {'name': self.name, 'max_posts': 0}
+
+    def get_rate_limiter(self):
+        """
+        Rate limiter, if any
+        """
+        return self.rate_limiter
+
+    def acquire_token(self):
+        """
+        Never rate limited
+        """
+        return True
+
+    def is_rate_limited(self):
+        """
+        Has the client been set as rate limited?
+        """
+        return self.rate_limited
+
+    def is_within_limits(self, feed):
+        """
+        Never limited
+        """
+        return True
+
+    def post_within_limits(self, entry, feed):
+        """
+        Record the entry as posted
+        """
+        self.posted.append(entry.link)
+        return True
+
+    def render_within_limits(self, entry, feed):
+        """
+        Render the entry as its link
+        """
+        return {'link': entry.link}
+
+    def deliver(self, payload):
+        """
+        Record the rendered entry as posted
+        """
+        self.posted.append(payload['link'])
+        return True
+
+    def seeding_published_db(self, entry_count, feed, feed_count):
+        """
+        Never seed
+        """
+        return False
+
+    def url_shortener_key(self, feed):
+        """
+        Links aren't shortened
+        """
+        return None
+
+
+def make_entry(link):
+    """
+    Build an entry with a link only
+    """
+    entry = FeedSporaEntry()
+    entry.link = link
+    return entry
+
+
+def make_runner(db_file, *clients):
+    """
+    Build a runner with an initialized database
+    """
+    runner = FeedSpora()
+    runner.set_db_file(str(db_file))
+    for client in clients:
+        runner.connect_client(client)
+    # pylint: disable=protected-access
+    runner._init_db()
+    # pylint: enable=protected-access
+    return runner
+
+
+def test_published_index(tmpdir):
+    """
+    Test that published entries are looked up in memory, and written
+    through to the database
+    """
+    db_file = tmpdir.join("feedspora.db")
+    client, other_client = RecordingClient('a'), RecordingClient('b')
+    runner = make_runner(db_file, client, other_client)
+    runner.add_to_published_entries(make_entry('http://x/1'), client)
+    assert runner.is_already_published(make_entry('http://x/1'), client)
+    assert not runner.is_already_published(make_entry('http://x/1'),
+                                           other_client)
+
+    conn = sqlite3.connect(str(db_file))
+    assert conn.execute("SELECT entry_hash, feedspora_id, client_id FROM "
+                        "posts").fetchall() == [(entry_digest('http://x/1'),
+                                                 None, 'a')]
+    conn.close()
+
+    runner = make_runner(db_file, client, other_client)
+    assert runner.is_already_published(make_entry('http://x/1'), client)
+    assert not runner.is_already_published(make_entry('http://x/2'), client)
+
+
+def test_schema_migration(tmpdir):
+    """
+    Test that a database created by an earlier release is upgraded in place
+    """
+    db_file = tmpdir.join("feedspora.db")
+    conn = sqlite3.connect(str(db_file))
+    conn.execute("CREATE table posts (id INTEGER PRIMARY KEY, "
+                 "feedspora_id, client_id TEXT)")
+    conn.executemany("INSERT INTO posts (feedspora_id, client_id) "
+                     "values (?,?)", [('http://x/1', 'a'),
+                                      ('http://x/2', 'a'),
+                                      ('http://x/1', 'a'),
+                                      ('http://x/1', 'b')])
+    conn.commit()
+    conn.close()
+
+    client = RecordingClient('a')
+    runner = make_runner(db_file, client)
+    assert runner.is_already_published(make_entry('http://x/2'), client)
+    runner.add_to_published_entries(make_entry('http://x/3'), client)
+
+    conn = sqlite3.connect(str(db_file))
+    assert migrations.get_version(conn) == migrations.SCHEMA_VERSION
+    assert conn.execute("SELECT id, entry_hash, feedspora_id, client_id, "
+                        "feed_path FROM posts ORDER BY id").fetchall() == [
+                            (1, entry_digest('http://x/1'), 'http://x/1',
+                             'a', None),
+                            (2, entry_digest('http://x/2'), 'http://x/2',
+                             'a', None),
+                            (4, entry_digest('http://x/1'), 'http://x/1',
+                             'b', None),
+                            (5, entry_digest('http://x/3'), None, 'a', None)]
+    assert conn.execute("SELECT published_at FROM posts WHERE id=5"
+                       ).fetchone()[0]
+    assert ('posts_entry',) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='index'").fetchall()
+    conn.close()
+
+
+def test_batched_seeding(tmpdir):
+    """
+    Test that seeded entries are committed in batches, and posted ones at
+    once
+    """
+    db_file = tmpdir.join("feedspora.db")
+    client = RecordingClient('a')
+    runner = make_runner(db_file, client)
+    conn = sqlite3.connect(str(db_file))
+
+    runner.add_to_published_entries(make_entry('http://x/1'), client,
+                                    posted=False)
+    assert conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0] == 0
+    runner.add_to_published_entries(make_entry('http://x/2'), client)
+    assert conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0] == 2
+    conn.close()
+
+
+def test_bloom_filters(tmpdir):
+    """
+    Test that Bloom filters are built from the database, kept up to date
+    and saved
+    """
+    db_file = tmpdir.join("feedspora.db")
+    client = RecordingClient('a')
+    runner = make_runner(db_file, client)
+    runner.add_to_published_entries(make_entry('http://x/1'), client)
+    # pylint: disable=protected-access
+    runner._close_db()
+
+    runner = FeedSpora()
+    runner.set_db_file(str(db_file))
+    runner.set_bloom_filters(True)
+    runner.connect_client(client)
+    runner._init_db()
+    assert runner.is_already_published(make_entry('http://x/1'), client)
+    assert not runner.is_already_published(make_entry('http://x/2'), client)
+    runner.add_to_published_entries(make_entry('http://x/2'), client)
+    assert runner.is_already_published(make_entry('http://x/2'), client)
+    runner._close_db()
+
+    bloom_filter = BloomFilter.load(runner._storage.bloom_filter_path('a'))
+    # pylint: enable=protected-access
+    assert entry_digest('http://x/1') in bloom_filter
+    assert entry_digest('http://x/2') in bloom_filter
+    assert bloom_filter.count == 2
+    assert not any('http://y/%d' % index in bloom_filter
+                   for index in range(100))
+
+
+def test_compact(tmpdir):
+    """
+    Test that compaction only deletes the published entries of the
+    connected clients that left the feeds before the retention horizon
+    """
+    db_file = tmpdir.join("feedspora.db")
+    client = RecordingClient('a')
+    other_client = RecordingClient('b')
+    runner = make_runner(db_file, client, other_client)
+    feed = GenericFeed("feed.rss")
+    in_feed = runner.entry_identifier(next(feed.feed_generator()))
+    for link in [in_feed, 'http://x/old', 'http://x/recent']:
+        runner.add_to_published_entries(make_entry(link), client)
+    runner.add_to_published_entries(make_entry('http://x/old'), other_client)
+    # pylint: disable=protected-access
+    runner._close_db()
+    # pylint: enable=protected-access
+    conn = sqlite3.connect(str(db_file))
+    conn.execute("UPDATE posts SET last_seen=datetime('now', '-400 days') "
+                 "WHERE entry_hash!=?", (entry_digest('http://x/recent'),))
+    conn.commit()
+    conn.close()
+
+    runner = FeedSpora()
+    runner.set_db_file(str(db_file))
+    runner.connect_client(client)
+    runner.connect_feed(GenericFeed("feed.rss"))
+    runner.compact(365)
+
+    conn = sqlite3.connect(str(db_file))
+    assert sorted(conn.execute(
+        "SELECT entry_hash, client_id FROM posts")) == sorted(
+            [(entry_digest(in_feed), 'a'),
+             (entry_digest('http://x/recent'), 'a'),
+             (entry_digest('http://x/old'), 'b')])
+    conn.close()
+
+
+def test_concurrent_claims(tmpdir):
+    """
+    Test that runs sharing the database don't publish the same entry, and
+    that expired claims are taken over
+    """
+    db_file = tmpdir.join("feedspora.db")
+    client, other_client = RecordingClient('a'), RecordingClient('a')
+    runner = make_runner(db_file, client)
+    other_runner = make_runner(db_file, other_client)
+    feed = GenericFeed("feed.rss")
+
+    entry = make_entry('http://x/1')
+    assert runner.claim_entry(entry, client, feed)
+    # pylint: disable=protected-access
+    assert not other_runner._publish_entry(entry, 1, feed, 1)
+    assert other_client.posted == []
+    runner.add_to_published_entries(entry, client, feed)
+    assert not other_runner.claim_entry(entry, other_client, feed)
+    assert other_runner.is_already_published(entry, other_client)
+
+    entry = make_entry('http://x/2')
+    assert runner.claim_entry(entry, client, feed)
+    conn = sqlite3.connect(str(db_file))
+    conn.execute("UPDATE posts SET claimed_until=datetime('now', '-1 hour') "
+                 "WHERE claimed_until IS NOT NULL")
+    conn.commit()
+    assert other_runner._publish_entry(entry, 2, feed, 2)
+    # pylint: enable=protected-access
+    assert other_client.posted == ['http://x/2']
+    runner.release_entry(entry, client)
+    assert conn.execute("SELECT COUNT(*) FROM posts WHERE claimed_until IS "
+                        "NULL").fetchone()[0] == 2
+    conn.close()
+
+
+def test_concurrent_publishing(tmpdir):
+    """
+    Test that an entry is posted to clients concurrently, and that each
+    client gets the entries in order
+    """
+    barrier = threading.Barrier(2, timeout=5)
+
+    class WaitingClient(RecordingClient):
+        """
+        Client only posting once the other one is posting too
+        """
+
+        def post_within_limits(self, entry, feed):
+            """
+            Wait for the other client, then record the entry as posted
+            """
+            barrier.wait()
+            return super().post_within_limits(entry, feed)
+
+    clients = [WaitingClient('a'), WaitingClient('b')]
+    runner = make_runner(tmpdir.join("feedspora.db"), *clients)
+    runner.set_publish_workers(2)
+    runner.connect_feed(GenericFeed("feed.rss"))
+    # pylint: disable=protected-access
+    runner._process_feeds()
+    # pylint: enable=protected-access
+    links = [entry.link for entry in GenericFeed("feed.rss").feed_generator()]
+    assert clients[0].posted == clients[1].posted == links
+
+
+def test_prefetch_short_urls(tmpdir):
+    """
+    Test that the links to be posted are shortened concurrently, once per
+    URL shortener, before posting
+    """
+    barrier = threading.Barrier(2, timeout=5)
+    shortened = []
+
+    class ShorteningClient(RecordingClient):
+        """
+        Client shortening links, with a limit on posts
+        """
+
+        def __init__(self, name, max_posts, url_shortener):
+            """
+            Initialize
+            """
+            super().__init__(name)
+            self.max_posts = max_posts
+            self.url_shortener = url_shortener
+
+        def get_config(self):
+            """
+            Client configuration, with a limit on posts
+            """
+            return {'name': self.name, 'max_posts': self.max_posts}
+
+        def get_posts_done(self):
+            """
+            Number of posts done
+            """
+            return len(self.posted)
+
+        def url_shortener_key(self, feed):
+            """
+            URL shortener, if any
+            """
+            return self.url_shortener
+
+        def is_link_shortened(self, feed, entry):
+            """
+            Links aren't shortened yet
+            """
+            return False
+
+        def shorten_entry_link(self, feed, entry):
+            """
+            Record the link as shortened, once the other one is too
+            """
+            assert not self.posted
+            barrier.wait()
+            shortened.append((self.url_shortener, entry.link))
+
+    clients = [ShorteningClient('a', 1, 'tinyurl'),
+               ShorteningClient('b', 1, 'tinyurl'),
+               ShorteningClient('c', 0, None)]
+    runner = make_runner(tmpdir.join("feedspora.db"), *clients)
+    runner.connect_feed(GenericFeed("feed.rss"))
+    entries = list(GenericFeed("feed.rss").feed_generator())
+    runner.add_to_published_entries(entries[0], clients[1])
+    links = [entry.link for entry in entries]
+    # pylint: disable=protected-access
+    runner._process_feeds()
+    # pylint: enable=protected-access
+    assert sorted(shortened) == sorted([('tinyurl', links[0]),
+                                        ('tinyurl', links[1])])
+
+
+# pylint: disable=no-member
+@responses.activate
+# pylint: enable=no-member
+def test_unchanged_validators(tmpdir, monkeypatch):
+    """
+    Test that the new validators of a feed retrieved again with the same
+    content are kept for the next run
+    """
+    url = "http://aurelien.latitude77.org/unchanged.rss"
+    sent = []
+
+    def callback(request):
+        sent.append(request.headers.get('If-None-Match'))
+        etag = '"v1"' if len(sent) == 1 else '"v2"'
+        if sent[-1] == etag:
+            return (304, {}, '')
+        with open("feed.rss") as fhandler:
+            return (200, {'ETag': etag}, fhandler.read())
+
+    responses.add_callback(responses.GET, url, callback=callback)
+    # The cache installed by the post tests would answer in place of the
+    # server: use a session of its own
+    with requests_cache.disabled():
+        monkeypatch.setattr(http_session, '_session', None)
+        for _ in range(3):
+            runner = make_runner(tmpdir.join("feedspora.db"),
+                                 RecordingClient('a'))
+            runner.connect_feed(GenericFeed(url))
+            runner.run()
+    assert sent == [None, '"v1"', '"v2"']
+
+
+def test_plan_rate_limited(tmpdir):
+    """
+    Test that no entry is planned for clients that reached their rate limit
+    """
+    clients = [RecordingClient('a'), RecordingClient('b')]
+    clients[0].rate_limited = True
+    runner = make_runner(tmpdir.join("feedspora.db"), *clients)
+    feed = GenericFeed("feed.rss")
+    entries = list(feed.feed_generator())
+    # pylint: disable=protected-access
+    planned = runner._plan_posts(entries, feed)
+    # pylint: enable=protected-access
+    assert planned == [(entry, clients[1]) for entry in entries]
+
+
+def test_prefetch_one_worker(tmpdir):
+    """
+    Test that with a single shortening worker, links are still looked up
+    and shortened from the runner thread before being posted concurrently
+    """
+    threads = []
+
+    class ShorteningClient(RecordingClient):
+        """
+        Client recording the threads links are shortened from
+        """
+
+        def url_shortener_key(self, feed):
+            """
+            Links are shortened
+            """
+            return 'tinyurl'
+
+        def is_link_shortened(self, feed, entry):
+            """
+            Record the lookup, links aren't shortened yet
+            """
+            threads.append(threading.current_thread())
+            return False
+
+        def shorten_entry_link(self, feed, entry):
+            """
+            Record the shortening
+            """
+            assert not self.posted
+            threads.append(threading.current_thread())
+
+    clients = [ShorteningClient('a'), ShorteningClient('b')]
+    runner = make_runner(tmpdir.join("feedspora.db"), *clients)
+    runner.set_shorten_workers(1)
+    runner.set_publish_workers(2)
+    runner.connect_feed(GenericFeed("feed.rss"))
+    # pylint: disable=protected-access
+    runner._process_feeds()
+    # pylint: enable=protected-access
+    assert threads and set(threads) == {threading.current_thread()}
+    assert clients[0].posted
+
+
+def test_outbox(tmpdir):
+    """
+    Test that entries are queued, then delivered, and attempted again later
+    if delivery fails
+    """
+
+    class FailingClient(RecordingClient):
+        """
+        Client failing to deliver the first time
+        """
+
+        def deliver(self, payload):
+            """
+            Fail, then record the rendered entry as posted
+            """
+            if not self.posted:
+                self.posted.append(None)
+                raise IOError("Unavailable")
+            return super().deliver(payload)
+
+    db_file = tmpdir.join("feedspora.db")
+    client, failing_client = RecordingClient('a'), FailingClient('b')
+    runner = make_runner(db_file, client, failing_client)
+    runner.set_outbox(True)
+    feed = GenericFeed("feed.rss")
+    # pylint: disable=protected-access
+    assert runner._publish_entry(make_entry('http://x/1'), 1, feed, 1)
+    assert client.posted == failing_client.posted == []
+    assert runner.is_already_published(make_entry('http://x/1'), client)
+
+    runner._deliver_outbox()
+    runner._close_db()
+    # pylint: enable=protected-access
+    assert client.posted == ['http://x/1']
+    assert failing_client.posted == [None]
+
+    conn = sqlite3.connect(str(db_file))
+    assert conn.execute("SELECT client_id, attempts FROM outbox").fetchall() \
+        == [('b', 1)]
+    conn.execute("UPDATE outbox SET next_attempt=datetime('now')")
+    conn.commit()
+    runner.deliver()
+    assert failing_client.posted == [None, 'http://x/1']
+    assert conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 0
+    conn.close()
+
+
+def test_outbox_given_up(tmpdir):
+    """
+    Test that deliveries given up are kept in the outbox, and attempted
+    again on demand
+    """
+
+    class BrokenClient(RecordingClient):
+        """
+        Client failing to deliver until repaired
+        """
+        broken = True
+
+        def deliver(self, payload):
+            """
+            Fail, unless repaired
+            """
+            if self.broken:
+                raise IOError("Unavailable")
+            return super().deliver(payload)
+
+    db_file = tmpdir.join("feedspora.db")
+    client = BrokenClient('a')
+    runner = make_runner(db_file, client)
+    runner.set_outbox(True)
+    # pylint: disable=protected-access
+    runner._delivery_attempts = 1
+    assert runner._publish_entry(make_entry('http://x/1'), 1,
+                                 GenericFeed("feed.rss"), 1)
+    runner._deliver_outbox()
+    runner._close_db()
+    # pylint: enable=protected-access
+    conn = sqlite3.connect(str(db_file))
+    assert conn.execute("SELECT attempts, next_attempt FROM outbox") \
+        .fetchall() == [(1, None)]
+
+    client.broken = False
+    runner.deliver()
+    assert client.posted == []
+    runner.set_retry_failed(True)
+    runner.deliver()
+    assert client.posted == ['http://x/1']
+    assert conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 0
+    conn.close()
+
+
+def test_rate_limiter_state(tmpdir):
+    """
+    Test that rate limiters are restored from the state of the previous run
+    """
+    db_file = tmpdir.join("feedspora.db")
+    client = RecordingClient('a')
+    client.rate_limiter = TokenBucket(1)
+    runner = make_runner(db_file, client)
+    assert client.rate_limiter.try_acquire()
+    # pylint: disable=protected-access
+    runner._close_db()
+    # pylint: enable=protected-access
+
+    client.rate_limiter = TokenBucket(1)
+    make_runner(db_file, client)
+    assert not client.rate_limiter.try_acquire()
+
+
+def test_rate_wait(tmpdir, monkeypatch):
+    """
+    Test that the entries deferred by the rate limit of a client waiting for
+    it are posted at the end of the run, in order
+    """
+
+    class WaitingClient(GenericClient):
+        """
+        Client posting one entry per minute, waiting for its rate limit
+        """
+
+        def __init__(self, name):
+            """
+            Initialize
+            """
+            self._config = {'name': name, 'rate_limit': 60,
+                            'rate_wait': True}
+            self.set_common_opts(self._config)
+            self.posted = []
+
+        def post(self, feed, entry):
+            """
+            Record the entry as posted, and when
+            """
+            self.posted.append((clock[0], entry.link))
+            return True
+
+    clock = [1000.0]
+    monkeypatch.setattr('time.time', lambda: clock[0])
+    monkeypatch.setattr('time.sleep',
+                        lambda seconds: clock.__setitem__(0, clock[0] +
+                                                          seconds))
+    db_file = tmpdir.join("feedspora.db")
+    client, other_client = WaitingClient('a'), RecordingClient('b')
+    runner = make_runner(db_file, client, other_client)
+    feed = GenericFeed("feed.rss")
+    links = ['http://x/1', 'http://x/2', 'http://x/3']
+    # pylint: disable=protected-access
+    settled = [runner._publish_entry(make_entry(link), index + 1, feed,
+                                     index + 1)
+               for index, link in enumerate(links)]
+    assert settled == [True, False, False]
+    assert other_client.posted == links
+    assert client.posted == [(1000.0, links[0])]
+
+    runner._wait_in_turn(runner._deferred, runner._post_deferred)
+    # pylint: enable=protected-access
+    assert client.posted == [(1000.0, links[0]), (1060.0, links[1]),
+                             (1120.0, links[2])]
+    assert runner.is_already_published(make_entry(links[2]), client)
+    assert feed.get_posts_done() == 3
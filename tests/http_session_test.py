@@ -0,0 +1,53 @@
+"""
+Test the shared HTTP session
+"""
+
+import responses
+
+from feedspora import http_session
+
+
+def test_shared_session():
+    """
+    Test that a single session is used process-wide
+    """
+    assert http_session.get_session() is http_session.get_session()
+
+
+# pylint: disable=no-member
+@responses.activate
+# pylint: enable=no-member
+def test_pooled_shortener():
+    """
+    Test that URL shorteners are built once, and go through the session
+    """
+    responses.add(responses.GET, "http://tinyurl.com/api-create.php",
+                  body="http://tinyurl.com/short", status=200)
+    shortener = http_session.get_shortener('tinyurl', {'timeout': 3})
+    assert shortener is http_session.get_shortener('tinyurl', {'timeout': 3})
+    assert shortener.short("http://aurelien.latitude77.org/a/long/path") \
+        == "http://tinyurl.com/short"
+
+
+def test_shortener_session(monkeypatch):
+    """
+    Test that URL shorteners issue their requests through the shared
+    session, with their own timeout
+    """
+    calls = []
+
+    class FakeResponse:
+        status_code = 200
+        ok = True
+        text = "http://tinyurl.com/other"
+
+    class FakeSession:
+        def request(self, method, url, **kwargs):
+            calls.append((method, url, kwargs['timeout']))
+            return FakeResponse()
+
+    monkeypatch.setattr(http_session, 'get_session', FakeSession)
+    shortener = http_session.get_shortener('tinyurl', {'timeout': 5})
+    assert shortener.short("http://aurelien.latitude77.org/other") \
+        == "http://tinyurl.com/other"
+    assert calls == [('GET', 'http://tinyurl.com/api-create.php', 5)]
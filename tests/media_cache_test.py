@@ -0,0 +1,108 @@
+import os
+
+from feedspora import http_session
+from feedspora.media_cache import MediaCache
+
+
+class FakeResponse:
+    def __init__(self, url, status_code, content=b'', headers=None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.read = 0
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            self.read += chunk_size
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, sizes=None):
+        self.sizes = sizes or {}
+        self.requests = []
+        self.responses = []
+        self.extra_headers = {}
+
+    def get(self, url, headers, stream):
+        assert stream
+        self.requests.append((url, headers.get('If-None-Match')))
+        if headers.get('If-None-Match'):
+            response = FakeResponse(url, 304)
+        else:
+            size, content_length = self.sizes.get(url, (100, None))
+            response = FakeResponse(url, 200, b'x' * size,
+                                    {'ETag': '"%d"' % size})
+            if content_length:
+                response.headers['Content-Length'] = str(content_length)
+        response.headers.update(self.extra_headers)
+        self.responses.append(response)
+        return response
+
+
+def test_media_cache(tmp_path, monkeypatch):
+    session = FakeSession()
+    monkeypatch.setattr(http_session, 'get_session', lambda: session)
+    urls = ['http://a.org/image.jpg', 'http://b.org/image.jpg']
+
+    # Posting to several clients downloads the media once
+    cache = MediaCache(str(tmp_path), 250)
+    paths = [cache.get(urls[0]) for _ in range(4)]
+    assert len(set(paths)) == 1
+    assert session.requests == [(urls[0], None)]
+    # Unrelated media with the same name don't overwrite each other
+    other_path = cache.get(urls[1])
+    assert other_path != paths[0]
+    assert os.path.basename(other_path) == 'image.jpg'
+
+    # Later runs revalidate it, and evict the least recently used
+    cache = MediaCache(str(tmp_path), 250)
+    assert cache.get(urls[1]) == other_path
+    assert session.requests[-1] == (urls[1], '"100"')
+    cache.get('http://c.org/image.jpg')
+    cache.get('http://d.org/image.jpg')
+    assert not os.path.exists(paths[0])
+    assert os.path.exists(other_path)
+
+
+def test_media_size(tmp_path, monkeypatch):
+    session = FakeSession({'http://a.org/large.jpg': (200000, None),
+                           'http://a.org/announced.jpg': (200000, 200000)})
+    monkeypatch.setattr(http_session, 'get_session', lambda: session)
+    cache = MediaCache(str(tmp_path), 1000000, 150000)
+    path = cache.get('http://a.org/image.jpg')
+    assert os.path.getsize(path) == 100
+
+    # Too large media are ignored, without being read entirely
+    assert cache.get('http://a.org/large.jpg') is None
+    assert session.responses[-1].read < 200000
+    assert cache.get('http://a.org/announced.jpg') is None
+    assert session.responses[-1].read == 0
+    assert sorted(os.listdir(str(tmp_path))) == \
+        sorted([os.path.basename(os.path.dirname(path)),
+                'feedspora_media.json'])
+
+
+def test_media_filename(tmp_path, monkeypatch):
+    session = FakeSession()
+    monkeypatch.setattr(http_session, 'get_session', lambda: session)
+    cache = MediaCache(str(tmp_path / 'media'), 1000000)
+    for disposition, filename in [
+            ('attachment; filename="photo.png"; size=100', 'photo.png'),
+            ('attachment; filename=../../escaped.jpg', 'escaped.jpg'),
+            ('attachment; filename=../../escaped.txt', 'image.jpg'),
+            ('attachment; filename="/etc/cron.d/x"', 'image.jpg')]:
+        url = 'http://a.org/%d/image.jpg' % len(session.requests)
+        session.extra_headers['Content-Disposition'] = disposition
+        path = cache.get(url)
+        assert os.path.basename(path) == filename
+        assert os.path.dirname(os.path.dirname(path)) == \
+            str(tmp_path / 'media')
+    assert sorted(os.listdir(str(tmp_path))) == ['media']
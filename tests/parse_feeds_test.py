@@ -4,7 +4,7 @@ Test Atom/RSS feed retrieval and parsing
 
 import responses
 
-from feedspora.generic_feed import GenericFeed
+from feedspora.generic_feed import GenericFeed, date_timestamp
 
 
 # pylint: disable=no-member
@@ -54,3 +54,104 @@ def test_rss_parser():
     soup = generic_feed.retrieve_feed_soup(filename)
     generated = generic_feed.parse_rss(soup)
     assert [_ for _ in generated]
+
+
+# pylint: disable=no-member
+@responses.activate
+# pylint: enable=no-member
+def test_conditional_retrieval():
+    """
+    Test that HTTP cache validators are sent back, and that a 304 response
+    short-circuits the feed
+    """
+    first_url = "http://aurelien.latitude77.org/conditional.atom"
+    second_url = "http://aurelien.latitude77.org/unchanged.atom"
+
+    def callback(request):
+        if request.headers.get('If-None-Match') == '"v1"':
+            return (304, {}, '')
+        with open("feed.atom") as fhandler:
+            return (200, {'ETag': '"v1"'}, fhandler.read())
+
+    responses.add_callback(responses.GET, first_url, callback=callback)
+    responses.add_callback(responses.GET, second_url, callback=callback)
+
+    generic_feed = GenericFeed(first_url)
+    assert generic_feed.retrieve_feed_soup(first_url) is not None
+    assert not generic_feed.is_not_modified()
+    assert generic_feed.get_validators() == ('"v1"', None)
+
+    generic_feed = GenericFeed(second_url)
+    generic_feed.set_validators('"v1"', None)
+    assert generic_feed.feed_generator() is None
+    assert generic_feed.is_not_modified()
+
+
+def test_prefetched_feed():
+    """
+    Test that a fetched feed is parsed from the fetched content only once
+    """
+    generic_feed = GenericFeed("feed.rss")
+    generic_feed.fetch()
+    assert [_ for _ in generic_feed.feed_generator()]
+
+
+def test_streamed_parser():
+    """
+    Test that the streaming parser generates the same entries as the
+    BeautifulSoup one
+    """
+    for filename in ["feed.atom", "feed.rss", "content_tags.rss",
+                     "tag_opts.atom", "title_tags.atom"]:
+        soup_feed = GenericFeed({'path': filename, 'parser': 'html.parser'})
+        lxml_feed = GenericFeed({'path': filename})
+        feed_content = soup_feed.retrieve_feed_content(filename)
+        assert [vars(entry) for entry in lxml_feed.parse_streamed(
+            feed_content)] == [vars(entry) for entry in
+                               soup_feed.parse_entries(feed_content)]
+
+
+def test_high_water_mark():
+    """
+    Test that parsing stops at the newest entry already seen, with both
+    parsers
+    """
+    for filename in ["feed.atom", "feed.rss"]:
+        for parser in ["lxml", "html.parser"]:
+            generic_feed = GenericFeed({'path': filename, 'parser': parser})
+            feed_content = generic_feed.retrieve_feed_content(filename)
+            entries = generic_feed.parse_entries(feed_content)
+
+            generic_feed.set_high_water_mark([(entries[-3].link, 0)],
+                                             lambda entry: entry.link)
+            assert [vars(entry) for entry in generic_feed.parse_entries(
+                feed_content)] == [vars(entry) for entry in entries[-2:]]
+
+            generic_feed.set_high_water_mark([(entries[-1].link, 0)],
+                                             lambda entry: entry.link)
+            assert generic_feed.parse_entries(feed_content) == []
+
+
+def test_date_timestamp():
+    """
+    Test the parsing of RSS and Atom dates
+    """
+    assert date_timestamp("Sat, 28 Oct 2017 11:21:29 +0200") == \
+        date_timestamp("2017-10-28T09:21:29Z") == \
+        date_timestamp("2017-10-28T11:21:29.000+02:00") == 1509182489
+    assert date_timestamp("yesterday") is None
+
+
+def test_content_hash():
+    """
+    Test that a feed with the same content as the last time isn't parsed
+    """
+    generic_feed = GenericFeed("feed.rss")
+    generic_feed.fetch()
+    content_hash = generic_feed.get_content_hash()
+    assert content_hash and not generic_feed.is_unchanged()
+
+    generic_feed = GenericFeed("feed.rss")
+    generic_feed.set_content_hash(content_hash)
+    assert generic_feed.feed_generator() is None
+    assert generic_feed.is_unchanged()
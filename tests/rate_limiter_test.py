@@ -0,0 +1,49 @@
+"""
+Test the rate limiting of clients
+"""
+
+from feedspora.generic_client import GenericClient
+from feedspora.rate_limiter import TokenBucket
+
+
+class LimitedClient(GenericClient):
+    """
+    Client configured with a rate limit
+    """
+
+    def __init__(self, config):
+        """
+        Initialize
+        """
+        self._config = config
+        self.set_common_opts(config)
+
+
+def test_token_bucket():
+    """
+    Test that tokens are taken in bursts, then refilled at the given rate
+    """
+    bucket = TokenBucket(3600, burst=2)
+    assert bucket.try_acquire(now=0) and bucket.try_acquire(now=0)
+    assert not bucket.try_acquire(now=0.5)
+    assert bucket.wait_time(now=0.5) == 1
+    assert bucket.try_acquire(now=1)
+    assert not bucket.try_acquire(now=1)
+
+    restored = TokenBucket(3600, burst=2)
+    restored.set_state(bucket.get_state())
+    assert not restored.try_acquire(now=1)
+    assert restored.try_acquire(now=10) and restored.try_acquire(now=10)
+    assert not restored.try_acquire(now=10)
+
+
+def test_client_rate_limit():
+    """
+    Test that a client posts nothing more once its rate limit is reached
+    """
+    client = LimitedClient({'name': 'limited', 'rate_limit': 1,
+                            'rate_burst': 2})
+    assert client.acquire_token() and client.acquire_token()
+    assert not client.acquire_token()
+    assert 3500 < client.get_rate_limiter().wait_time() <= 3600
+    assert LimitedClient({'name': 'unlimited'}).acquire_token()
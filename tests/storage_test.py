@@ -0,0 +1,149 @@
+"""
+Test the storages of published entries and feed states
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from feedspora.key_value_storage import DbmStorage, MemoryStorage
+from feedspora.short_url_cache import ShortUrlCache
+from feedspora.sqlite_storage import SqliteStorage
+
+
+@pytest.mark.parametrize("storage_class",
+                         [SqliteStorage, DbmStorage, MemoryStorage])
+def test_storage(tmpdir, storage_class):
+    """
+    Test that every storage records published entries and feed states
+    """
+    db_file = str(tmpdir.join("feedspora.db"))
+    storage = storage_class(db_file)
+    storage.open(['a', 'b'])
+    storage.add_published('http://x/1', 'a', 'feed.rss')
+    storage.add_published('http://x/2', 'a', posted=False)
+    assert storage.is_published('http://x/1', 'a')
+    assert storage.is_published('http://x/2', 'a')
+    assert not storage.is_published('http://x/1', 'b')
+
+    assert storage.load_feed_state('feed.rss', '["a"]') is None
+    storage.save_feed_state('feed.rss', '["a"]', [['http://x/1', 0]],
+                            ('"v1"', None, 'digest'))
+    storage.save_feed_state('feed.rss', '["a"]', [['http://x/2', 1]])
+    assert storage.load_feed_state('feed.rss', '["a"]') == {
+        'etag': '"v1"', 'last_modified': None, 'content_hash': 'digest',
+        'seen': [['http://x/2', 1]]}
+    assert storage.load_feed_state('feed.rss', '["a", "b"]') is None
+
+    assert storage.load_client_state('a') is None
+    storage.save_client_state('a', {'rate_limiter': [0.5, 1000.0]})
+    assert storage.load_client_state('a') == {'rate_limiter': [0.5, 1000.0]}
+
+    assert storage.load_short_url('http://x/1', 'tinyurl') is None
+    storage.save_short_url('http://x/1', 'tinyurl', 'http://t/1', 1000.0)
+    storage.save_short_url('http://x/2', 'tinyurl', '', 1000.0)
+    assert storage.load_short_url('http://x/1', 'tinyurl') == \
+        ('http://t/1', 1000.0)
+    assert storage.load_short_url('http://x/2', 'tinyurl') == ('', 1000.0)
+    assert storage.load_short_url('http://x/1', 'isgd') is None
+
+    storage.save_feed_state('feed.xml', '["c"]', [])
+    storage.compact({'http://x/2'}, 0, ['feed.atom'], '["a"]')
+    assert storage.load_feed_state('feed.rss', '["a"]') is None
+    # Feed states recorded by another configuration are left alone
+    assert storage.load_feed_state('feed.xml', '["c"]') is not None
+    storage.close()
+
+    if storage_class is not MemoryStorage:
+        storage = storage_class(db_file)
+        storage.open(['a', 'b'])
+        assert storage.is_published('http://x/2', 'a')
+        assert storage.load_short_url('http://x/1', 'tinyurl') == \
+            ('http://t/1', 1000.0)
+        storage.close()
+
+
+@pytest.mark.parametrize("storage_class",
+                         [SqliteStorage, DbmStorage, MemoryStorage])
+def test_outbox(tmpdir, storage_class):
+    """
+    Test that every storage queues rendered entries until they're delivered
+    """
+    storage = storage_class(str(tmpdir.join("feedspora.db")))
+    storage.open(['a', 'b'])
+    storage.enqueue('http://x/1', 'a', {'text': 'one'})
+    storage.enqueue('http://x/2', 'a', {'text': 'two'})
+    storage.enqueue('http://x/2', 'a', {'text': 'two again'})
+    storage.enqueue('http://x/1', 'b', {'text': 'one'})
+    # Queued entries are recorded as published at the same time
+    assert storage.is_published('http://x/2', 'a')
+    deliveries = storage.due_deliveries(['a'])
+    assert [(payload, attempts) for _, _, payload, attempts
+            in deliveries] == [({'text': 'one'}, 0), ({'text': 'two'}, 0)]
+
+    storage.remove_delivery(deliveries[0][0])
+    storage.postpone_delivery(deliveries[1][0], 3600)
+    assert storage.due_deliveries(['a']) == []
+    deliveries = storage.due_deliveries(['a', 'b'])
+    assert [client_name for _, client_name, _, _ in deliveries] == ['b']
+
+    # Deliveries given up are kept, until retried
+    storage.fail_delivery(deliveries[0][0])
+    assert storage.due_deliveries(['b']) == []
+    assert storage.count_failed_deliveries(['a', 'b']) == 1
+    assert storage.retry_failed_deliveries(['a']) == 0
+    assert storage.retry_failed_deliveries(['b']) == 1
+    assert [(payload, attempts) for _, _, payload, attempts
+            in storage.due_deliveries(['b'])] == [({'text': 'one'}, 0)]
+    assert storage.count_failed_deliveries(['a', 'b']) == 0
+    storage.close()
+
+
+def test_short_url_cache(monkeypatch):
+    """
+    Test that short URLs and failures are kept in memory and in the storage
+    until they expire
+    """
+    storage = MemoryStorage('feedspora.db')
+    storage.open([])
+    cache = ShortUrlCache(ttl=100, max_entries=1)
+    cache.set_storage(storage)
+    now = 1000.0
+    monkeypatch.setattr('time.time', lambda: now)
+    assert cache.get('http://x/1', 'tinyurl') is None
+    cache.put('http://x/1', 'tinyurl', 'http://t/1')
+    cache.put('http://x/2', 'tinyurl', '')
+    # Evicted from memory, still in the storage
+    assert cache.get('http://x/1', 'tinyurl') == 'http://t/1'
+    assert cache.get('http://x/2', 'tinyurl') == ''
+    now += 200
+    assert cache.get('http://x/1', 'tinyurl') is None
+    assert cache.get('http://x/2', 'tinyurl') == ''
+    now += 3600
+    assert cache.get('http://x/2', 'tinyurl') is None
+
+
+def test_short_url_cache_threads(tmpdir):
+    """
+    Test that short URLs recorded by other threads are only saved to the
+    storage from the thread using it
+    """
+    storage = SqliteStorage(str(tmpdir.join("feedspora.db")))
+    storage.open([])
+    cache = ShortUrlCache()
+    cache.set_storage(storage)
+    cache.put('http://x/1', 'tinyurl', 'http://t/1')
+    # Looked up in the storage once, then found in memory from any thread
+    stored_cache = ShortUrlCache()
+    stored_cache.set_storage(storage)
+    assert stored_cache.get('http://x/1', 'tinyurl') == 'http://t/1'
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert executor.submit(stored_cache.get, 'http://x/1',
+                               'tinyurl').result() == 'http://t/1'
+        executor.submit(cache.put, 'http://x/2', 'tinyurl',
+                        'http://t/2').result()
+    assert stored_cache.get('http://x/2', 'tinyurl') is None
+    cache.flush()
+    assert stored_cache.get('http://x/2', 'tinyurl') == 'http://t/2'
+    cache.set_storage(None)
+    storage.close()
@@ -0,0 +1,80 @@
+"""
+Test the insertion of tags in texts
+"""
+
+import random
+import string
+
+from feedspora.tag_inserter import TagInserter
+
+
+def slow_inserter(tags):
+    """
+    Build an inserter looking for its tags one at a time, without the
+    compiled pattern
+    """
+    inserter = TagInserter(tags)
+    # pylint: disable=protected-access
+    inserter._pattern = None
+    # pylint: enable=protected-access
+    return inserter
+
+
+def insert(inserter, text):
+    """
+    Insert the tags in the text, then append those not found
+    """
+    to_return, extra_tags = inserter.insert(text)
+    return inserter.append(to_return, '_|', extra_tags)
+
+
+def test_compiled_tags():
+    """
+    Test that the compiled pattern inserts tags as looking for them one at
+    a time does, on random texts
+    """
+    words = ['red', 'Red', 'blue', 'été', 'a_b', 'c++', '(x)', '', '#']
+    delimiters = [' ', '/', '(', ')', '#', '"', ',', '.', '_', '|', '-']
+    rng = random.Random(0)
+    for _ in range(2000):
+        text = ''.join(rng.choice(words + delimiters * 2)
+                       for _ in range(rng.randint(0, 12)))
+        tags = tuple(rng.sample(words, rng.randint(0, 4)))
+        assert insert(TagInserter(tags), text) == \
+            insert(slow_inserter(tags), text)
+
+
+def test_compiled_tags_many():
+    """
+    Test that the compiled pattern is used, and gives the same result, with
+    many tags and a long text
+    """
+    rng = random.Random(0)
+    tags = tuple(''.join(rng.choice(string.ascii_lowercase)
+                         for _ in range(rng.randint(3, 10)))
+                 for _ in range(100))
+    words = list(tags) + ['lorem', 'ipsum', 'dolor', 'sit', 'amet']
+    text = ''
+    while len(text) < 10000:
+        text += rng.choice(words) + rng.choice([' ', ', ', '. '])
+    compiled = TagInserter(tags)
+    # pylint: disable=protected-access
+    assert compiled._pattern is not None
+    # pylint: enable=protected-access
+    assert insert(compiled, text) == insert(slow_inserter(tags), text)
+
+
+def test_budget():
+    """
+    Test that insertion stops once the text is long enough, and that tags
+    aren't appended beyond the budget
+    """
+    inserter = TagInserter(('lorem', 'tail', 'extra'))
+    text = 'lorem ipsum ' * 500 + 'tail'
+    full, extra_tags = inserter.insert(text)
+    truncated, truncated_extra_tags = inserter.insert(text, 100)
+    assert len(truncated) >= 100
+    assert full.startswith(truncated)
+    assert truncated_extra_tags == extra_tags == ['extra']
+    assert inserter.append(truncated, '_|', extra_tags, 100) == \
+        truncated + '_|'